@@ -0,0 +1,105 @@
+# batching.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - MicroBatcher: gom việc của nhiều request đồng thời thành 1 lô rồi chạy 1 lần
+#     (vd. 1 lần reranker.predict cho cặp của nhiều câu hỏi), sau đó trả kết quả về
+#     đúng request đã gửi
+#   - Lô được chạy khi đủ max_batch phần tử hoặc hết cửa sổ chờ window_ms (tính từ
+#     request đầu tiên của lô) -> latency mỗi request tăng thêm tối đa window_ms
+#   - Trong lúc 1 lô đang chạy, request mới xếp hàng và được gom vào lô kế tiếp
+#   - window_ms = 0: tắt gom lô, gọi thẳng hàm trong thread của request
+# ------------------------------------------------------------
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, fn, window_ms=5, max_batch=64, name="batcher"):
+        """fn(items) -> danh sách kết quả cùng độ dài và thứ tự với items"""
+        self._fn = fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._items = 0
+        self._largest = 0
+
+    def submit(self, items):
+        """Gửi các phần tử của 1 request, chờ lô chạy xong rồi trả về kết quả tương ứng"""
+        items = list(items)
+        if not items:
+            return []
+        if self.window <= 0:
+            results = list(self._fn(items))
+            self._record(1, len(items))
+            return results
+        self._ensure_started()
+        future = Future()
+        self._queue.put((items, future))
+        return future.result()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.window
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._run(batch)
+
+    def _run(self, batch):
+        items = [item for request_items, _ in batch for item in request_items]
+        try:
+            results = list(self._fn(items))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self._record(len(batch), len(items))
+        offset = 0
+        for request_items, future in batch:
+            future.set_result(results[offset:offset + len(request_items)])
+            offset += len(request_items)
+
+    def _record(self, requests, items):
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += requests
+            self._items += items
+            self._largest = max(self._largest, items)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "window_ms": round(self.window * 1000, 2),
+                "max_batch": self.max_batch,
+                "batches": self._batches,
+                "requests": self._requests,
+                "avg_requests_per_batch": round(self._requests / self._batches, 2) if self._batches else 0.0,
+                "avg_items_per_batch": round(self._items / self._batches, 2) if self._batches else 0.0,
+                "largest_batch": self._largest,
+            }
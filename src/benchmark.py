@@ -0,0 +1,788 @@
+# benchmark.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Đo hiệu năng các thành phần của hệ thống RAG trên dữ liệu thật (docs.db, faiss.index)
+#   - Mỗi benchmark là 1 lệnh con:
+#       python src/benchmark.py db        # Kết nối SQLite dùng lại vs mở mới mỗi query
+#       python src/benchmark.py index     # Recall@k / latency / RAM các loại FAISS index so với flat
+#       python src/benchmark.py startup   # Thời gian khởi động server: nhận kết nối, sẵn sàng, câu hỏi đầu
+#       python src/benchmark.py rerank    # Reranker torch vs onnx / onnx_int8: latency + độ lệch điểm
+#       python src/benchmark.py embed     # Embedding torch vs onnx / onnx_int8: latency + độ lệch cosine
+#       python src/benchmark.py batching  # Gom lô giữa các request đồng thời (rerank / câu hỏi) vs gọi riêng lẻ
+#       python src/benchmark.py hybrid    # Vector vs hybrid (FAISS + BM25, RRF): recall và latency retrieve
+#       python src/benchmark.py cascade   # Cascade rerank (dừng sớm) vs rerank toàn bộ: latency, hit@n, tỉ lệ dừng
+#       python src/benchmark.py ingest    # Đọc + chunk file local song song: throughput theo số process
+#       python src/benchmark.py pdf       # PDF nhiều trăm trang: cách đọc cũ vs mới, đọc song song theo trang
+# ------------------------------------------------------------
+
+import os
+import argparse
+import random
+import time
+import sqlite3
+import socket
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = os.path.join(BASE_DIR, "..", "faiss.index")
+
+
+def _summary(samples_ms):
+    """Thống kê latency (ms): mean / p50 / p99"""
+    s = sorted(samples_ms)
+    if not s:
+        return {"mean": 0.0, "p50": 0.0, "p99": 0.0}
+    return {
+        "mean": sum(s) / len(s),
+        "p50": s[int(0.50 * (len(s) - 1))],
+        "p99": s[int(0.99 * (len(s) - 1))],
+    }
+
+
+def _print_row(name, stats, unit="ms"):
+    print(f"   {name:<34} mean={stats['mean']:8.3f}{unit}  p50={stats['p50']:8.3f}{unit}  p99={stats['p99']:8.3f}{unit}")
+
+
+# ==============================================================================
+# 1. SQLite: kết nối dùng lại (db.py) vs mở/đóng mỗi lần
+# ==============================================================================
+def bench_db(args):
+    import db
+
+    all_ids = [r[0] for r in db.get_connection().execute("SELECT id FROM documents").fetchall()]
+    if not all_ids:
+        print("⚠️ docs.db chưa có dữ liệu.")
+        return
+
+    rng = random.Random(args.seed)
+    workload = [rng.sample(all_ids, min(args.k, len(all_ids))) for _ in range(args.queries)]
+    print(f"📊 SQLite lookup: {args.queries} truy vấn x {args.k} ID ({len(all_ids)} documents)")
+
+    def connect_per_call(ids):
+        # Cách cũ: mở kết nối mới + câu IN (...) có độ dài thay đổi
+        placeholders = ",".join("?" * len(ids))
+        conn = sqlite3.connect(db.DB_PATH)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"SELECT * FROM documents WHERE id IN ({placeholders})", ids).fetchall()
+        conn.close()
+        return rows
+
+    results = {}
+    for name, fn in [("connect mỗi lần", connect_per_call), ("kết nối dùng lại (db.py)", db.get_documents_by_ids)]:
+        fn(workload[0])  # warmup
+        samples = []
+        for ids in workload:
+            start = time.perf_counter()
+            fn(ids)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = _summary(samples)
+        _print_row(name, results[name])
+
+    old, new = results["connect mỗi lần"]["mean"], results["kết nối dùng lại (db.py)"]["mean"]
+    print(f"   => Tiết kiệm {old - new:.3f} ms/truy vấn (x{old / max(new, 1e-9):.1f})")
+
+
+# ==============================================================================
+# 2. FAISS: các loại index xấp xỉ so với flat (recall@k, latency)
+# ==============================================================================
+def _load_corpus_vectors():
+    """Lấy toàn bộ vector + ID từ faiss.index hiện tại (phải là index flat)"""
+    import faiss
+    import numpy as np
+
+    index = faiss.read_index(INDEX_FILE)
+    base = faiss.downcast_index(index.index)
+    if not isinstance(base, faiss.IndexFlat):
+        raise SystemExit("❌ benchmark cần faiss.index loại flat để lấy vector gốc.")
+    xb = base.reconstruct_n(0, base.ntotal)
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+    return xb, ids
+
+
+def _load_queries(xb, ids, n, seed, use_model):
+    """
+    Câu hỏi benchmark: lấy ngẫu nhiên n đoạn văn trong docs.db, dùng 1 câu đầu làm câu hỏi
+    (encode bằng model "query: ..."), hoặc dùng luôn vector đoạn văn nếu --no-model.
+    """
+    import numpy as np
+
+    rng = random.Random(seed)
+    picks = rng.sample(range(len(ids)), min(n, len(ids)))
+    if not use_model:
+        return xb[picks]
+
+    import db
+    import model_registry
+    from config_loader import load_config
+
+    docs = db.get_documents_by_ids([int(ids[i]) for i in picks])
+    texts = [d["text"].split(".")[0][:200] for d in docs]
+    model = model_registry.get_sentence_transformer(load_config()["model"]["embedding_model"], backend="torch")
+    return model.encode([f"query: {t}" for t in texts], normalize_embeddings=True).astype("float32")
+
+
+def _recall_at_k(truth, found):
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / max(1, sum(len(t) for t in truth))
+
+
+def _time_search(index, xq, k, full_vectors=None, rescore_factor=0):
+    """
+    Latency từng câu hỏi (mỗi lần search 1 vector như /ask).
+    Có full_vectors: lấy rescore_factor * k ứng viên rồi rescore bằng vector gốc đọc từ đĩa.
+    """
+    import vector_index
+
+    samples, found = [], []
+    for q in xq:
+        start = time.perf_counter()
+        if full_vectors is None:
+            _, I = index.search(q[None, :], k)
+        else:
+            D, I = index.search(q[None, :], k * rescore_factor)
+            _, I = vector_index.rescore(q[None, :], D, I, full_vectors.read, k)
+        samples.append((time.perf_counter() - start) * 1000)
+        found.append([i for i in I[0] if i != -1])
+    return _summary(samples), found
+
+
+def bench_index(args):
+    import tempfile
+    import faiss
+    import vector_index
+    from index_store import FullVectorFile
+
+    xb, ids = _load_corpus_vectors()
+    xq = _load_queries(xb, ids, args.queries, args.seed, use_model=not args.no_model)
+    dim = xb.shape[1]
+    print(f"📊 FAISS index: {len(xb)} vector x {dim} chiều, {len(xq)} câu hỏi, recall@{args.k} so với flat")
+
+    flat = vector_index.create_index(dim, "flat")
+    flat.add_with_ids(xb, ids)
+    flat_stats, truth = _time_search(flat, xq, args.k)
+
+    def report(label, stats, found, build_s=None, size=None):
+        extra = ""
+        if build_s is not None:
+            extra += f"  build={build_s:6.2f}s"
+        if size is not None:
+            extra += f"  RAM={size / 1024 / 1024:7.2f}MB"
+        print(f"   {label:<26} recall={_recall_at_k(truth, found):.4f}  "
+              f"p50={stats['p50']:.3f}ms  p99={stats['p99']:.3f}ms{extra}")
+
+    report("flat", flat_stats, truth, size=len(faiss.serialize_index(flat)))
+
+    sweeps = {
+        "hnsw": ("ef_search", [16, 32, 64, 128, 256]),
+        "ivf_flat": ("nprobe", [1, 4, 8, 16, 32, 64]),
+        "ivf_pq": ("nprobe", [1, 4, 8, 16, 32, 64]),
+        "sq8": (None, [None]),
+        "sq_fp16": (None, [None]),
+        "pq": (None, [None]),
+    }
+
+    # Vector gốc cho rescore nằm trên đĩa như khi chạy thật (faiss.index.f32)
+    tmp_dir = tempfile.TemporaryDirectory()
+    full_vectors = FullVectorFile(os.path.join(tmp_dir.name, "bench.f32"), dim)
+    full_vectors.write(ids, xb)
+    print(f"   (vector float32 gốc trên đĩa cho rescore: {full_vectors.size() / 1024 / 1024:.2f}MB)")
+
+    for index_type in args.types:
+        param, values = sweeps[index_type]
+        start = time.perf_counter()
+        index = vector_index.create_index(dim, index_type, n_train=len(xb))
+        vector_index.train_index(index, xb)
+        index.add_with_ids(xb, ids)
+        build_s = time.perf_counter() - start
+        size = len(faiss.serialize_index(index))
+        for i, v in enumerate(values):
+            label = index_type
+            if param is not None:
+                vector_index.apply_search_params(index, **{param: v})
+                label += f" {param}={v}"
+            stats, found = _time_search(index, xq, args.k)
+            report(label, stats, found, build_s if i == 0 else None, size if i == 0 else None)
+            if index_type in vector_index.COMPRESSED_TYPES and args.rescore_factor:
+                stats, found = _time_search(index, xq, args.k, full_vectors, args.rescore_factor)
+                report(f"{label} +rescore x{args.rescore_factor}", stats, found)
+
+    full_vectors.close()
+    tmp_dir.cleanup()
+
+
+# ==============================================================================
+# 3. Khởi động server: thời gian tới khi nhận kết nối (/healthz), sẵn sàng (/readyz)
+#    và latency câu hỏi đầu tiên / câu hỏi sau đó
+# ==============================================================================
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, start, timeout, proc):
+    """Chờ tới khi url trả 200, trả về số giây tính từ start"""
+    import requests
+
+    deadline = start + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"❌ Server đã thoát (code {proc.returncode}).")
+        try:
+            r = requests.get(url, timeout=1)
+        except requests.RequestException:
+            r = None
+        if r is not None and r.status_code == 200:
+            return time.perf_counter() - start
+        if r is not None and r.headers.get("content-type", "").startswith("application/json") \
+                and r.json().get("status") == "error":
+            raise SystemExit(f"❌ Warmup lỗi: {r.json().get('error')}")
+        time.sleep(0.05)
+    raise SystemExit(f"❌ Quá {timeout}s mà {url} chưa sẵn sàng.")
+
+
+def bench_startup(args):
+    import requests
+
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    code = f"import uvicorn; uvicorn.run('server:app', host='127.0.0.1', port={port}, log_level='warning')"
+    print(f"📊 Khởi động server (port {port}), {args.runs} lần")
+
+    rows = {"nhận kết nối (/healthz)": [], "sẵn sàng (/readyz)": [],
+            "/ask đầu tiên": [], "/ask tiếp theo": []}
+    for run in range(args.runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-c", code], cwd=BASE_DIR,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            rows["nhận kết nối (/healthz)"].append(_wait_for(f"{base}/healthz", start, args.timeout, proc) * 1000)
+            rows["sẵn sàng (/readyz)"].append(_wait_for(f"{base}/readyz", start, args.timeout, proc) * 1000)
+            for i, key in enumerate(["/ask đầu tiên", "/ask tiếp theo"]):
+                # Câu hỏi khác nhau để không trúng cache câu trả lời
+                t = time.perf_counter()
+                requests.post(f"{base}/ask", json={"query": f"{args.query} ({run}-{i})"}, timeout=args.timeout)
+                rows[key].append((time.perf_counter() - t) * 1000)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    for name, samples in rows.items():
+        _print_row(name, _summary(samples))
+
+
+# ==============================================================================
+# 4. Reranker: backend torch vs onnx / onnx_int8 (latency + độ khớp điểm)
+# ==============================================================================
+def _sample_rerank_workload(n_queries, n_candidates, seed):
+    """
+    Mỗi câu hỏi = câu đầu của 1 đoạn văn ngẫu nhiên; ứng viên = đoạn văn đó + các đoạn
+    ngẫu nhiên khác (đủ n_candidates cặp như retrieval_top_k).
+    """
+    import db
+
+    conn = db.get_connection()
+    all_ids = [r[0] for r in conn.execute("SELECT id FROM documents").fetchall()]
+    if not all_ids:
+        raise SystemExit("⚠️ docs.db chưa có dữ liệu.")
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(n_queries):
+        ids = rng.sample(all_ids, min(n_candidates, len(all_ids)))
+        docs = db.get_documents_by_ids(ids)
+        query = docs[0]["text"].split(".")[0][:200]
+        workload.append([(query, d["text"]) for d in docs])
+    return workload
+
+
+def bench_rerank(args):
+    import numpy as np
+    import model_registry
+    from config_loader import load_config
+
+    config = load_config()
+    name = config["model"]["RERANK_MODEL"]
+    top_n = config["vector_db"].get("rerank_top_n", 5)
+    workload = _sample_rerank_workload(args.queries, args.candidates, args.seed)
+    print(f"📊 Reranker {name}: {len(workload)} câu hỏi x {args.candidates} cặp, "
+          f"torch vs {', '.join(args.backends)}")
+
+    def run(backend):
+        model = model_registry.get_cross_encoder(name, device="cpu", backend=backend)
+        model.predict(workload[0])  # warmup
+        samples, scores = [], []
+        for pairs in workload:
+            start = time.perf_counter()
+            scores.append(np.asarray(model.predict(pairs), dtype="float32"))
+            samples.append((time.perf_counter() - start) * 1000)
+        return _summary(samples), scores
+
+    ref_stats, ref_scores = run("torch")
+    _print_row("torch", ref_stats)
+    failed = False
+    for backend in args.backends:
+        stats, scores = run(backend)
+        _print_row(backend, stats)
+        diff = np.concatenate([np.abs(a - b) for a, b in zip(ref_scores, scores)])
+        top1 = np.mean([np.argmax(a) == np.argmax(b) for a, b in zip(ref_scores, scores)])
+        topn = np.mean([set(np.argsort(-a)[:top_n]) == set(np.argsort(-b)[:top_n])
+                        for a, b in zip(ref_scores, scores)])
+        ok = diff.max() <= args.tolerance
+        failed |= not ok
+        print(f"      x{ref_stats['mean'] / max(stats['mean'], 1e-9):.2f} so với torch | "
+              f"lệch điểm max={diff.max():.4f} mean={diff.mean():.4f} | "
+              f"top-1 khớp={top1:.1%} top-{top_n} khớp={topn:.1%} | "
+              f"{'✅' if ok else '❌'} tolerance {args.tolerance}")
+    if failed:
+        raise SystemExit(1)
+
+
+# ==============================================================================
+# 5. Embedding: backend torch vs onnx / onnx_int8 (latency + độ lệch cosine)
+# ==============================================================================
+def bench_embed(args):
+    import numpy as np
+    import db
+    import model_registry
+    from config_loader import load_config
+
+    config = load_config()
+    name = config["model"]["embedding_model"]
+    batch_size = config.get("ingest", {}).get("embed_batch_size", 64)
+
+    conn = db.get_connection()
+    all_ids = [r[0] for r in conn.execute("SELECT id FROM documents").fetchall()]
+    if not all_ids:
+        raise SystemExit("⚠️ docs.db chưa có dữ liệu.")
+    rng = random.Random(args.seed)
+    docs = db.get_documents_by_ids(rng.sample(all_ids, min(args.passages, len(all_ids))))
+    passages = [f"passage: {d['text']}" for d in docs]
+    queries = [f"query: {d['text'].split('.')[0][:200]}" for d in docs[:args.queries]]
+    print(f"📊 Embedding {name}: {len(passages)} đoạn văn, {len(queries)} câu hỏi, "
+          f"torch vs {', '.join(args.backends)}")
+
+    def run(backend):
+        model = model_registry.get_sentence_transformer(name, device="cpu", backend=backend)
+        model.encode(queries[:1], normalize_embeddings=True)  # warmup
+        samples, q_vecs = [], []
+        for q in queries:
+            # 1 câu hỏi mỗi lần như /ask
+            start = time.perf_counter()
+            q_vecs.append(model.encode([q], normalize_embeddings=True)[0])
+            samples.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        p_vecs = model.encode(passages, batch_size=batch_size, normalize_embeddings=True)
+        throughput = len(passages) / (time.perf_counter() - start)
+        return _summary(samples), throughput, np.asarray(q_vecs, dtype="float32"), p_vecs.astype("float32")
+
+    def report(label, stats, throughput):
+        print(f"   {label:<12} query p50={stats['p50']:7.2f}ms p99={stats['p99']:7.2f}ms | ingest {throughput:7.1f} đoạn/s")
+
+    ref_stats, ref_tp, ref_q, ref_p = run("torch")
+    report("torch", ref_stats, ref_tp)
+    # Top-k của câu hỏi trên vector đoạn văn torch (= index hiện có) làm chuẩn
+    truth = np.argsort(-(ref_q @ ref_p.T), axis=1)[:, :args.k]
+    failed = False
+    for backend in args.backends:
+        stats, tp, q, p = run(backend)
+        report(backend, stats, tp)
+        drift = np.concatenate([1 - np.sum(ref_q * q, axis=1), 1 - np.sum(ref_p * p, axis=1)])
+        found = np.argsort(-(q @ ref_p.T), axis=1)[:, :args.k]
+        ok = drift.max() <= args.tolerance
+        failed |= not ok
+        print(f"      x{ref_stats['p50'] / max(stats['p50'], 1e-9):.2f} query, x{tp / max(ref_tp, 1e-9):.2f} ingest | "
+              f"lệch cosine max={drift.max():.5f} mean={drift.mean():.5f} | "
+              f"recall@{args.k} trên index torch={_recall_at_k(truth, found):.4f} | "
+              f"{'✅' if ok else '❌'} tolerance {args.tolerance}")
+    if failed:
+        raise SystemExit(1)
+
+
+# ==============================================================================
+# 6. Micro-batching: nhiều request đồng thời gọi riêng lẻ vs gom lô qua MicroBatcher
+# ==============================================================================
+def _run_concurrent(workload, call, threads):
+    """Chia workload cho các thread, trả về (thời gian tổng, latency từng request, kết quả)"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def one(item):
+        start = time.perf_counter()
+        result = call(item)
+        return (time.perf_counter() - start) * 1000, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        out = list(pool.map(one, workload))
+    return time.perf_counter() - start, [o[0] for o in out], [o[1] for o in out]
+
+
+def _rerank_stage(args):
+    """Rerank: (workload, gọi riêng lẻ, tạo hàm gom lô theo cửa sổ, độ lệch kết quả)"""
+    import numpy as np
+    import qa
+    from batching import MicroBatcher
+
+    model = qa.get_reranker()
+    if model is None:
+        raise SystemExit("⚠️ use_reranker đang tắt trong config.yaml.")
+    workload = _sample_rerank_workload(args.requests, args.candidates, args.seed)
+    model.predict(workload[0])  # warmup
+    print(f"📊 Rerank: {len(workload)} request x {args.candidates} cặp, {args.threads} thread đồng thời")
+
+    def direct(pairs):
+        return np.asarray(model.predict(pairs), dtype="float32")
+
+    def batched(window_ms):
+        batcher = MicroBatcher(qa.rerank_pairs, window_ms, args.max_batch)
+        return batcher, lambda pairs: np.asarray(batcher.submit(pairs), dtype="float32")
+
+    def diff(a, b):
+        return float(np.abs(a - b).max())
+
+    return workload, direct, batched, diff
+
+
+def _query_stage(args):
+    """Câu hỏi: encode 1 câu + FAISS search 1 dòng vs gom lô encode + search nhiều dòng"""
+    import numpy as np
+    import db
+    import qa
+    import index_service
+    from batching import MicroBatcher
+
+    qa.ensure_index()
+    all_ids = [r[0] for r in db.get_connection().execute("SELECT id FROM documents").fetchall()]
+    rng = random.Random(args.seed)
+    docs = db.get_documents_by_ids(rng.sample(all_ids, min(args.requests, len(all_ids))))
+    # Câu hỏi khác nhau, không qua cache embedding của qa
+    workload = [f"{d['text'].split('.')[0][:200]} #{i}" for i, d in enumerate(docs)]
+    k = qa.RETRIEVAL_TOP_K
+    embedder = qa.get_embedder()
+    embedder.encode(["query: warmup"], normalize_embeddings=True)
+    print(f"📊 Câu hỏi: {len(workload)} request (encode + search top {k}), {args.threads} thread đồng thời")
+
+    def direct(query):
+        vec = embedder.encode([f"query: {query}"], normalize_embeddings=True).astype("float32")
+        return index_service.search(vec, k)[1][0]
+
+    def batched(window_ms):
+        embed_batcher = MicroBatcher(qa.encode_queries, window_ms, args.max_batch)
+        search_batcher = MicroBatcher(qa.search_many, window_ms, args.max_batch)
+        return embed_batcher, lambda q: search_batcher.submit([(embed_batcher.submit([q])[0], k)])[0][1]
+
+    def diff(a, b):
+        # Tỉ lệ ID top-k khác với khi gọi riêng lẻ
+        return 1 - len(set(a.tolist()) & set(b.tolist())) / max(1, len(a))
+
+    return workload, direct, batched, diff
+
+
+def bench_batching(args):
+    stage = {"rerank": _rerank_stage, "query": _query_stage}[args.stage]
+    workload, direct, batched, diff = stage(args)
+
+    total, samples, ref = _run_concurrent(workload, direct, args.threads)
+    print(f"   {'riêng lẻ':<26} {len(workload) / total:8.1f} request/s  "
+          f"p50={_summary(samples)['p50']:8.2f}ms  p99={_summary(samples)['p99']:8.2f}ms")
+
+    for window_ms in args.windows:
+        batcher, call = batched(window_ms)
+        total, samples, out = _run_concurrent(workload, call, args.threads)
+        max_diff = max(diff(a, b) for a, b in zip(ref, out))
+        st = batcher.stats()
+        print(f"   {f'gom lô {window_ms}ms':<26} {len(workload) / total:8.1f} request/s  "
+              f"p50={_summary(samples)['p50']:8.2f}ms  p99={_summary(samples)['p99']:8.2f}ms  "
+              f"{st['avg_requests_per_batch']:.1f} request/lô  lệch max={max_diff:.2e}")
+
+
+# ==============================================================================
+# 7. Retrieval: vector vs hybrid (FAISS + BM25) với các retrieval_top_k khác nhau
+# ==============================================================================
+def _sample_sentence_queries(n, seed):
+    """(câu hỏi, ID đoạn văn đúng): 1 câu >= 6 từ lấy ngẫu nhiên trong đoạn văn"""
+    import re
+    import db
+
+    all_ids = [r[0] for r in db.get_connection().execute("SELECT id FROM documents").fetchall()]
+    rng = random.Random(seed)
+    rng.shuffle(all_ids)
+    queries = []
+    for doc in db.get_documents_by_ids(all_ids[:n * 3]):
+        text = re.sub(r"<[^>]+>|\{\{[^}]*\}\}|[=\[\]|]", " ", doc["text"])
+        sentences = [s.strip() for s in re.split(r"[.\n]", text) if len(s.split()) >= 6]
+        if sentences:
+            queries.append((rng.choice(sentences)[:200], doc["id"]))
+        if len(queries) >= n:
+            break
+    return queries
+
+
+def bench_hybrid(args):
+    import qa
+
+    queries = _sample_sentence_queries(args.queries, args.seed)
+    n = qa.RERANK_TOP_N
+    print(f"📊 Retrieve: {len(queries)} câu hỏi (đoạn văn đúng = đoạn chứa câu), "
+          f"rerank {'bật' if qa.USE_RERANKER else 'tắt'}, hit@{n} sau rerank")
+    qa.retrieve(queries[0][0], top_k=1, rerank_top_n=1)  # warmup
+
+    for spec in args.configs:
+        mode, top_k = spec.split(":")
+        top_k = int(top_k)
+        samples, cand_hits, top_hits, pairs = [], 0, 0, 0
+        for query, doc_id in queries:
+            start = time.perf_counter()
+            # Lấy toàn bộ ứng viên đã xếp hạng để đo cả recall trước rerank
+            results = qa.retrieve(query, top_k=top_k, rerank_top_n=top_k, score_threshold=float("-inf"), mode=mode)
+            samples.append((time.perf_counter() - start) * 1000)
+            ids = [r["id"] for r in results]
+            cand_hits += doc_id in ids
+            top_hits += doc_id in ids[:n]
+            pairs += len(ids)
+        stats = _summary(samples)
+        print(f"   {spec:<14} recall ứng viên={cand_hits / len(queries):.3f}  hit@{n}={top_hits / len(queries):.3f}  "
+              f"cặp rerank={pairs / len(queries):5.1f}  p50={stats['p50']:8.2f}ms  p99={stats['p99']:8.2f}ms")
+
+
+# ==============================================================================
+# 8. Cascade rerank: dừng sớm theo ngưỡng vs rerank toàn bộ ứng viên
+# ==============================================================================
+def bench_cascade(args):
+    import qa
+
+    if not qa.USE_RERANKER:
+        print("❌ Cần bật model.use_reranker để so sánh cascade.")
+        sys.exit(1)
+    qa.RERANK_CASCADE = True
+    qa.cascade_stats.log_every = 0
+    queries = _sample_sentence_queries(args.queries, args.seed)
+    n = qa.RERANK_TOP_N
+    print(f"📊 Cascade rerank: {len(queries)} câu hỏi, top_k={qa.RETRIEVAL_TOP_K}, hit@{n}, "
+          f"reranker nhỏ: {qa.RERANK_SMALL_MODEL if qa.get_small_reranker() else 'không'}")
+    qa.retrieve(queries[0][0], top_k=1, rerank_top_n=1)  # warmup
+
+    def run(cascade):
+        samples, hits, tops = [], 0, []
+        for query, doc_id in queries:
+            start = time.perf_counter()
+            results = qa.retrieve(query, rerank_top_n=n, score_threshold=float("-inf"), cascade=cascade)
+            samples.append((time.perf_counter() - start) * 1000)
+            ids = [r["id"] for r in results]
+            hits += doc_id in ids
+            tops.append(ids)
+        return _summary(samples), hits / len(queries), tops
+
+    stats, hit, full_tops = run(False)
+    print(f"   {'rerank toàn bộ':<26} hit@{n}={hit:.3f}  p50={stats['p50']:8.2f}ms  p99={stats['p99']:8.2f}ms")
+
+    for skip_margin in args.skip_margins:
+        for small_margin in args.small_margins:
+            qa.CASCADE_SKIP_MARGIN, qa.CASCADE_SMALL_MARGIN = skip_margin, small_margin
+            qa.cascade_stats.clear()
+            stats, hit, tops = run(True)
+            # Mức trùng top 1 với rerank toàn bộ (chất lượng bị mất do dừng sớm)
+            agree = sum(a[:1] == b[:1] for a, b in zip(tops, full_tops)) / len(queries)
+            st = qa.cascade_stats.stats()
+            exits = " ".join(f"{k}={v:.2f}" for k, v in st["exit_rate"].items())
+            label = f"skip={skip_margin} small={small_margin}"
+            print(f"   {label:<26} hit@{n}={hit:.3f}  trùng top1={agree:.3f}  p50={stats['p50']:8.2f}ms  "
+                  f"p99={stats['p99']:8.2f}ms  dừng: {exits}  cặp lớn={st['avg_large_pairs']}")
+
+
+# ==============================================================================
+# 9. Ingest file local: đọc + chunk bằng process pool (không embed, không ghi DB)
+# ==============================================================================
+def _make_docx_corpus(folder, n_files, paragraphs, seed):
+    from docx import Document
+
+    rng = random.Random(seed)
+    words = ["lúa", "ngô", "sâu", "bệnh", "phân", "đất", "nước", "giống", "cây", "lá", "rễ", "thu hoạch"]
+    for i in range(n_files):
+        doc = Document()
+        for _ in range(rng.randint(paragraphs // 2, paragraphs * 3 // 2)):
+            doc.add_paragraph(" ".join(rng.choice(words) for _ in range(120)) + ".")
+        doc.save(os.path.join(folder, f"tai_lieu_{i:04d}.docx"))
+
+
+def bench_ingest(args):
+    import tempfile
+    import resource
+    import ingest
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.data_dir
+        if folder is None:
+            folder = tmp
+            _make_docx_corpus(folder, args.files, args.paragraphs, args.seed)
+        paths = ingest.find_local_files(folder)
+        print(f"📊 Đọc + chunk {len(paths)} file ({folder}), CPU: {os.cpu_count()}")
+        for workers in args.workers:
+            start = time.perf_counter()
+            files = chunks = 0
+            for _, entries, _ in ingest.iter_chunked_files(paths, workers):
+                files += 1
+                chunks += len(entries)
+            elapsed = time.perf_counter() - start
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(f"   workers={workers:<3} {files / elapsed:8.1f} file/s  {chunks / elapsed:9.1f} chunk/s  "
+                  f"{elapsed:6.2f}s  RSS đỉnh (process chính)={peak_mb:.0f}MB")
+
+
+# ==============================================================================
+# 10. PDF lớn: nối chuỗi cũ vs join, đọc song song theo khoảng trang + chunk dần
+# ==============================================================================
+def _make_pdf(path, pages, seed):
+    """PDF giả kiểu sổ tay nông nghiệp (font mặc định của PyMuPDF không có dấu tiếng Việt)"""
+    import fitz
+
+    rng = random.Random(seed)
+    words = ["lua", "ngo", "sau benh", "phan bon", "dat", "tuoi nuoc", "giong", "cay", "la", "re", "thu hoach"]
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        lines = [" ".join(rng.choice(words) for _ in range(14)) for _ in range(50)]
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), "\n".join(lines), fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def bench_pdf(args):
+    import tempfile
+    import tracemalloc
+    import fitz
+    import ingest
+    import extractors
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.files
+        if not paths:
+            paths = [os.path.join(tmp, "so_tay_nong_nghiep.pdf")]
+            _make_pdf(paths[0], args.pages, args.seed)
+        pages = sum(extractors.pdf_page_count(p) for p in paths)
+        print(f"📊 PDF: {len(paths)} file, {pages} trang, CPU: {os.cpu_count()}, "
+              f"song song từ {ingest.PDF_PARALLEL_MIN_PAGES} trang, {ingest.PDF_PAGES_PER_TASK} trang/việc")
+
+        def legacy_read(path):
+            text = ""
+            with fitz.open(path) as pdf:
+                for page in pdf:
+                    text += page.get_text("text")
+            return text.strip()
+
+        def report(label, fn):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            fn()
+            peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+            print(f"   {label:<34} {pages / elapsed:8.1f} trang/s  {elapsed:6.2f}s  RAM Python đỉnh={peak:6.1f}MB")
+
+        report("đọc: text += (cũ)", lambda: [legacy_read(p) for p in paths])
+        report("đọc: join", lambda: [extractors.read_pdf(p) for p in paths])
+        report("đọc + chunk cả chuỗi (1 process)",
+               lambda: [ingest.chunk_content(extractors.read_pdf(p), "pdf", p, force_update=True) for p in paths])
+        for workers in args.workers:
+            report(f"đọc theo trang + chunk dần, {workers} proc", lambda: list(ingest.iter_chunked_files(paths, workers)))
+
+
+COMMANDS = {
+    "db": bench_db,
+    "index": bench_index,
+    "startup": bench_startup,
+    "rerank": bench_rerank,
+    "embed": bench_embed,
+    "batching": bench_batching,
+    "hybrid": bench_hybrid,
+    "cascade": bench_cascade,
+    "ingest": bench_ingest,
+    "pdf": bench_pdf,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hệ thống RAG")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("db", help="SQLite: kết nối dùng lại vs mở mới mỗi query")
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--k", type=int, default=10, help="Số ID mỗi truy vấn (~ retrieval_top_k)")
+    p.add_argument("--seed", type=int, default=0)
+
+    index_types = ["hnsw", "ivf_flat", "ivf_pq", "sq8", "sq_fp16", "pq"]
+    p = sub.add_parser("index", help="FAISS: recall@k, latency và RAM của các loại index so với flat")
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--types", nargs="+", default=index_types, choices=index_types)
+    p.add_argument("--rescore-factor", type=int, default=4,
+                   help="Index nén: thêm dòng rescore top factor*k bằng vector gốc (0 = tắt)")
+    p.add_argument("--no-model", action="store_true",
+                   help="Dùng vector đoạn văn làm câu hỏi (không cần tải model embedding)")
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("startup", help="Thời gian khởi động server và latency câu hỏi đầu tiên")
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--query", default="Cách trồng lúa?")
+    p.add_argument("--timeout", type=float, default=300)
+
+    p = sub.add_parser("rerank", help="Reranker: latency + độ lệch điểm của onnx / onnx_int8 so với torch")
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--candidates", type=int, default=10, help="Số cặp mỗi câu hỏi (~ retrieval_top_k)")
+    p.add_argument("--backends", nargs="+", default=["onnx_int8"], choices=["onnx", "onnx_int8"])
+    p.add_argument("--tolerance", type=float, default=0.05, help="Độ lệch điểm tối đa cho phép so với torch")
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("embed", help="Embedding: latency + độ lệch cosine của onnx / onnx_int8 so với torch")
+    p.add_argument("--passages", type=int, default=500)
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--backends", nargs="+", default=["onnx", "onnx_int8"], choices=["onnx", "onnx_int8"])
+    p.add_argument("--tolerance", type=float, default=0.02,
+                   help="Độ lệch cosine (1 - cos) tối đa cho phép so với torch")
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("batching", help="Gom lô rerank / câu hỏi giữa các request đồng thời vs gọi riêng lẻ")
+    p.add_argument("--stage", choices=["rerank", "query"], default="rerank",
+                   help="rerank: reranker.predict | query: encode câu hỏi + FAISS search")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--candidates", type=int, default=10, help="Số cặp mỗi request (~ retrieval_top_k)")
+    p.add_argument("--threads", type=int, default=8, help="Số request đồng thời")
+    p.add_argument("--windows", type=float, nargs="+", default=[2, 5, 10], help="Cửa sổ gom lô (ms)")
+    p.add_argument("--max-batch", type=int, default=64)
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("hybrid", help="Vector vs hybrid (FAISS + BM25): recall và latency theo retrieval_top_k")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--configs", nargs="+", default=["vector:20", "vector:10", "hybrid:10", "hybrid:5"],
+                   help="Danh sách mode:top_k")
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("cascade", help="Cascade rerank (dừng sớm) vs rerank toàn bộ: latency, hit@n, tỉ lệ dừng từng tầng")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--skip-margins", type=float, nargs="+", default=[0.02, 0.05, 0.1],
+                   help="Các giá trị cascade_skip_margin cần thử")
+    p.add_argument("--small-margins", type=float, nargs="+", default=[0.3],
+                   help="Các giá trị cascade_small_margin cần thử")
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("ingest", help="Đọc + chunk file local bằng process pool: throughput theo số process")
+    p.add_argument("--data-dir", default=None, help="Thư mục file thật (mặc định: tạo file .docx giả)")
+    p.add_argument("--files", type=int, default=200)
+    p.add_argument("--paragraphs", type=int, default=20, help="Số đoạn trung bình mỗi file giả")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("pdf", help="PDF lớn: đọc cũ (text +=) vs mới, đọc song song theo khoảng trang")
+    p.add_argument("--files", nargs="*", default=[], help="File PDF thật (mặc định: tạo 1 sổ tay giả)")
+    p.add_argument("--pages", type=int, default=400, help="Số trang PDF giả")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# cache.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Chuẩn hóa câu hỏi để làm khóa cache (NFC, gộp khoảng trắng, không phân biệt hoa/thường)
+#   - LRU cache trong RAM, có giới hạn kích thước và đếm hit/miss
+#   - Cache câu trả lời theo độ tương đồng câu hỏi + gộp các request trùng đang chạy
+# ------------------------------------------------------------
+
+import re
+import time
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def clean_query(text):
+    """Chuẩn hóa nhẹ câu hỏi: Unicode NFC, gộp khoảng trắng (giữ nguyên hoa/thường)"""
+    text = unicodedata.normalize("NFC", text or "")
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def normalize_query(text):
+    """Chuẩn hóa câu hỏi làm khóa cache: clean_query + casefold"""
+    return clean_query(text).casefold()
+
+
+class LRUCache:
+    """LRU cache thread-safe. maxsize <= 0 nghĩa là tắt cache."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời theo độ tương đồng vector câu hỏi.
+    - Câu hỏi mới có cosine >= threshold với câu đã trả lời (cùng model) -> dùng lại câu trả lời
+    - Entry hết hạn sau ttl giây
+    - invalidate_paths(): xóa các entry đã trích dẫn full_path bị cập nhật
+    Vector đầu vào phải được normalize (inner product = cosine).
+    Chỉ nhớ seq invalidate của max_invalidated full_path gần nhất; câu trả lời bắt đầu trước
+    lần invalidate đã bị quên thì không lưu (thà bỏ lỡ cache còn hơn lưu câu trả lời cũ).
+    """
+
+    def __init__(self, maxsize=512, threshold=0.97, ttl=3600, max_invalidated=4096):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_invalidated = max_invalidated
+        self._entries = OrderedDict()  # key -> entry dict
+        self._matrix = None            # Ma trận vector (lazy), hàng i ứng với self._keys[i]
+        self._keys = []
+        self._next_key = 0
+        self._seq = 0                  # Tăng mỗi lần invalidate
+        self._invalidated_at = OrderedDict()  # full_path -> seq lần invalidate gần nhất (cũ -> mới)
+        self._forgotten_seq = 0        # seq lớn nhất đã bị bỏ khỏi _invalidated_at
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def begin(self):
+        """Gọi trước khi retrieve; truyền kết quả vào put() để bỏ qua câu trả lời đã cũ"""
+        with self._lock:
+            return self._seq
+
+    def lookup(self, vec, model):
+        if self.maxsize <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.vstack([self._entries[k]["vec"] for k in self._keys])
+                sims = self._matrix @ vec
+                for i in np.argsort(-sims):
+                    if sims[i] < self.threshold:
+                        break
+                    entry = self._entries[self._keys[i]]
+                    if entry["model"] == model:
+                        self._entries.move_to_end(self._keys[i])
+                        self.hits += 1
+                        return entry
+            self.misses += 1
+            return None
+
+    def put(self, vec, model, answer, sources, paths, seq=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            # Bài viết được trích dẫn đã bị cập nhật trong lúc đang sinh câu trả lời -> không lưu
+            if seq is not None and (seq < self._forgotten_seq
+                                    or any(self._invalidated_at.get(p, -1) > seq for p in paths)):
+                return
+            self._entries[self._next_key] = {
+                "vec": np.asarray(vec, dtype="float32"),
+                "model": model,
+                "answer": answer,
+                "sources": sources,
+                "paths": set(paths),
+                "created": time.monotonic(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate_paths(self, paths):
+        """Xóa các câu trả lời có trích dẫn một trong các full_path. Trả về số entry bị xóa."""
+        paths = set(paths)
+        with self._lock:
+            self._seq += 1
+            for p in paths:
+                self._invalidated_at[p] = self._seq
+                self._invalidated_at.move_to_end(p)
+            while len(self._invalidated_at) > self.max_invalidated:
+                _, self._forgotten_seq = self._invalidated_at.popitem(last=False)
+            stale = [k for k, e in self._entries.items() if e["paths"] & paths]
+            for k in stale:
+                del self._entries[k]
+            if stale:
+                self._matrix = None
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def _expire(self, now):
+        stale = [k for k, e in self._entries.items() if now - e["created"] > self.ttl]
+        for k in stale:
+            del self._entries[k]
+        if stale:
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class InflightRegistry:
+    """
+    Gộp các yêu cầu giống hệt nhau đang chạy song song: request đầu tiên (leader) thực thi,
+    các request đến sau cùng khóa chờ kết quả của leader thay vì tự chạy lại.
+    Dùng được cho cả code đồng bộ (run) và async (arun). Với luồng stream, gọi trực tiếp
+    join() / finish() vì leader phải yield dần trước khi có kết quả cuối.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def join(self, key):
+        """(future, leader): leader phải gọi finish() khi xong, request khác chờ future"""
+        with self._lock:
+            fut = self._futures.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut, False
+            fut = Future()
+            self._futures[key] = fut
+            return fut, True
+
+    def finish(self, key, fut, result=None, exc=None):
+        with self._lock:
+            self._futures.pop(key, None)
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+    def run(self, key, fn):
+        fut, leader = self.join(key)
+        if not leader:
+            return fut.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, fut, exc=e)
+            raise
+        self.finish(key, fut, result)
+        return result
+
+    async def arun(self, key, coro_fn):
+        fut, leader = self.join(key)
+        if not leader:
+            # shield: request đến sau bị hủy không kéo theo hủy kết quả của leader
+            return await asyncio.shield(asyncio.wrap_future(fut))
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self.finish(key, fut, exc=e)
+            raise
+        self.finish(key, fut, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._futures), "coalesced": self.coalesced}
@@ -0,0 +1,91 @@
+# check_embed_backends.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Encode một bộ câu cố định (câu hỏi + đoạn văn, có prefix "query: " / "passage: " như qa / ingest)
+#     bằng model embedding trong config với từng backend (torch, onnx, onnx_int8)
+#   - So với torch: độ lệch cosine (1 - cos) lớn nhất phải <= model.embedding_drift_tolerance,
+#     để đổi model.embedding_backend mà vẫn dùng được faiss.index đã xây bằng torch
+#   - In ✅ / ❌ từng backend, exit code 1 nếu có backend lệch quá (hoặc không tải được)
+#
+#   python src/check_embed_backends.py
+#   python src/check_embed_backends.py --backends onnx_int8 --tolerance 0.03
+#   (Cần: pip install "optimum[onnxruntime]"; lần đầu export ONNX vào model.onnx_dir)
+# ------------------------------------------------------------
+
+import sys
+import argparse
+
+import numpy as np
+import model_registry
+from config_loader import load_config
+
+config = load_config()
+MODEL_CFG = config.get("model", {})
+EMBEDDING_MODEL = MODEL_CFG.get("embedding_model", "intfloat/multilingual-e5-small")
+DRIFT_TOLERANCE = MODEL_CFG.get("embedding_drift_tolerance", 0.02)
+
+SENTENCES = [
+    "query: Cây lúa cần bón phân gì vào giai đoạn đẻ nhánh?",
+    "query: Cách phòng trừ sâu đục thân hại ngô",
+    "query: Thời vụ trồng cà phê ở Tây Nguyên",
+    "query: Vì sao lá sầu riêng bị vàng?",
+    "query: Đất phèn nên trồng cây gì",
+    "query: lua bi dao on phai lam sao",
+    "passage: Lúa ở giai đoạn đẻ nhánh cần nhiều đạm, nên bón thúc bằng urê kết hợp kali "
+    "khoảng 7 đến 10 ngày sau khi cấy.",
+    "passage: Sâu đục thân ngô phá hoại mạnh vào giai đoạn trổ cờ. Có thể dùng thuốc dạng hạt "
+    "rải vào nõn hoặc thả ong mắt đỏ để kiểm soát.",
+    "passage: Cà phê vối ở Tây Nguyên thường được trồng vào đầu mùa mưa, từ tháng 5 đến tháng 7, "
+    "khi đất đủ ẩm.",
+    "passage: Vàng lá trên sầu riêng có thể do thiếu dinh dưỡng, ngập úng hoặc nấm Phytophthora "
+    "gây thối rễ.",
+    "passage: Đất phèn có pH thấp, thích hợp trồng tràm, khóm (dứa) và một số giống lúa chịu phèn.",
+    "passage: Bệnh đạo ôn do nấm Pyricularia oryzae gây ra, vết bệnh hình thoi màu nâu xám trên lá.",
+    "passage: 1 ha cần 80–100 kg N, 60 kg P2O5 và 60 kg K2O.",
+    "passage: Tưới nước",
+]
+
+
+def encode(backend):
+    model = model_registry.get_sentence_transformer(EMBEDDING_MODEL, device="cpu", backend=backend)
+    return np.asarray(model.encode(SENTENCES, normalize_embeddings=True), dtype="float32")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra độ lệch embedding của onnx / onnx_int8 so với torch")
+    parser.add_argument("--backends", nargs="+", default=["onnx", "onnx_int8"], choices=["onnx", "onnx_int8"])
+    parser.add_argument("--tolerance", type=float, default=DRIFT_TOLERANCE,
+                        help="Độ lệch cosine (1 - cos) tối đa cho phép so với torch")
+    args = parser.parse_args()
+
+    print(f"🧪 {EMBEDDING_MODEL}: {len(SENTENCES)} câu, torch vs {', '.join(args.backends)}, "
+          f"tolerance {args.tolerance}")
+    ref = encode("torch")
+    failures = []
+    for backend in args.backends:
+        try:
+            vecs = encode(backend)
+        except Exception as e:
+            print(f"❌ {backend}: không tải / encode được ({e})")
+            failures.append(backend)
+            continue
+        if vecs.shape != ref.shape:
+            print(f"❌ {backend}: kích thước vector {vecs.shape} khác torch {ref.shape}")
+            failures.append(backend)
+            continue
+        drift = 1 - np.sum(ref * vecs, axis=1)
+        worst = int(np.argmax(drift))
+        ok = drift[worst] <= args.tolerance
+        print(f"{'✅' if ok else '❌'} {backend}: lệch cosine max={drift[worst]:.5f} mean={drift.mean():.5f}"
+              + ("" if ok else f" (câu: {SENTENCES[worst][:60]!r})"))
+        if not ok:
+            failures.append(backend)
+
+    if failures:
+        print(f"\n❌ {len(failures)} backend không đạt: {', '.join(failures)}")
+        sys.exit(1)
+    print("\n✅ Các backend embedding khớp với torch")
+
+
+if __name__ == "__main__":
+    main()
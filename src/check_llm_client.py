@@ -0,0 +1,187 @@
+# check_llm_client.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Kiểm tra llm_client.OllamaClient với một Ollama giả chạy trong process (không cần Ollama thật):
+#       retry 502/503/504 (đồng bộ + async) rồi bỏ cuộc sau max_retries, backoff của bản async,
+#       "keep_alive" có trong mọi request, giữ kết nối HTTP (1 TCP cho nhiều lời gọi),
+#       stream NDJSON và lỗi giữa stream
+#   - In ✅ / ❌ từng mục, exit code 1 nếu có mục sai
+#
+#   python src/check_llm_client.py
+# ------------------------------------------------------------
+
+import sys
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import llm_client
+
+KEEP_ALIVE = "7m"
+MAX_RETRIES = 2
+BACKOFF = 0.05
+
+
+class FakeOllama:
+    """/api/generate giả: fail_next request đầu trả về fail_status, ghi lại payload + cổng client"""
+
+    def __init__(self):
+        self.fail_next = 0
+        self.fail_status = 503
+        self.stream_error = False
+        self.requests = []
+        self.client_ports = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Giữ kết nối giữa các request
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                fake.requests.append(payload)
+                fake.client_ports.append(self.client_address[1])
+                if fake.fail_next > 0:
+                    fake.fail_next -= 1
+                    self._send(fake.fail_status, {"error": "busy"})
+                elif payload.get("stream"):
+                    self._stream(payload)
+                else:
+                    self._send(200, {"response": "ok:" + payload["prompt"], "done": True, "eval_count": 1})
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, payload):
+                lines = [{"response": tok, "done": False} for tok in ("Xin ", "chào")]
+                lines.append({"error": "model crashed"} if fake.stream_error else {"response": "", "done": True})
+                data = "".join(json.dumps(line) + "\n" for line in lines).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self, fail_next=0, fail_status=503, stream_error=False):
+        self.fail_next, self.fail_status, self.stream_error = fail_next, fail_status, stream_error
+        self.requests.clear()
+        self.client_ports.clear()
+
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'✅' if ok else '❌'} {name}" + (f" ({detail})" if detail else ""))
+    if not ok:
+        failures.append(name)
+
+
+def check_sync(fake, client):
+    fake.reset(fail_next=MAX_RETRIES)
+    data = client.generate("a", "m", options={"temperature": 0.1})
+    check("generate: retry 503 rồi thành công", data.get("response") == "ok:a" and len(fake.requests) == MAX_RETRIES + 1,
+          f"{len(fake.requests)} request")
+    check("generate: gửi keep_alive + options",
+          all(p.get("keep_alive") == KEEP_ALIVE for p in fake.requests) and fake.requests[-1].get("options") == {"temperature": 0.1})
+
+    fake.reset(fail_next=MAX_RETRIES + 1)
+    errors = client.metrics.errors
+    try:
+        client.generate("b", "m")
+        gave_up = False
+    except requests.HTTPError:
+        gave_up = True
+    check("generate: bỏ cuộc sau max_retries", gave_up and len(fake.requests) == MAX_RETRIES + 1
+          and client.metrics.errors == errors + 1, f"{len(fake.requests)} request")
+
+    fake.reset(fail_status=500, fail_next=1)
+    try:
+        client.generate("c", "m")
+        raised = False
+    except requests.HTTPError:
+        raised = True
+    check("generate: không retry lỗi 500", raised and len(fake.requests) == 1)
+
+    fake.reset()
+    for i in range(5):
+        client.generate(str(i), "m")
+    check("generate: dùng lại kết nối HTTP", len(set(fake.client_ports)) == 1,
+          f"{len(set(fake.client_ports))} kết nối cho 5 lời gọi")
+
+
+async def check_async(fake, client):
+    fake.reset(fail_next=MAX_RETRIES)
+    retries = client.metrics.retries
+    start = time.perf_counter()
+    data = await client.agenerate("a", "m")
+    elapsed = time.perf_counter() - start
+    min_wait = sum(BACKOFF * 2 ** i for i in range(MAX_RETRIES))
+    check("agenerate: retry 503 rồi thành công", data.get("response") == "ok:a"
+          and client.metrics.retries == retries + MAX_RETRIES, f"{len(fake.requests)} request")
+    check("agenerate: backoff tăng dần", elapsed >= min_wait, f"{elapsed:.3f}s >= {min_wait:.3f}s")
+    check("agenerate: gửi keep_alive", all(p.get("keep_alive") == KEEP_ALIVE for p in fake.requests))
+
+    fake.reset(fail_next=MAX_RETRIES + 1)
+    try:
+        await client.agenerate("b", "m")
+        gave_up = False
+    except Exception:
+        gave_up = True
+    check("agenerate: bỏ cuộc sau max_retries", gave_up and len(fake.requests) == MAX_RETRIES + 1)
+
+    fake.reset()
+    for i in range(5):
+        await client.agenerate(str(i), "m")
+    check("agenerate: dùng lại kết nối HTTP", len(set(fake.client_ports)) == 1,
+          f"{len(set(fake.client_ports))} kết nối cho 5 lời gọi")
+
+    fake.reset()
+    tokens = [c["response"] async for c in client.astream("a", "m") if c.get("response")]
+    check("astream: nhận từng token", tokens == ["Xin ", "chào"], str(tokens))
+    check("astream: stream=true + keep_alive", fake.requests[0].get("stream") is True
+          and fake.requests[0].get("keep_alive") == KEEP_ALIVE)
+
+    fake.reset(stream_error=True)
+    try:
+        async for _ in client.astream("a", "m"):
+            pass
+        raised = False
+    except RuntimeError:
+        raised = True
+    check("astream: lỗi giữa stream -> RuntimeError", raised)
+    await client.aclose()
+
+
+def main():
+    fake = FakeOllama()
+    client = llm_client.OllamaClient(base_url=fake.url, keep_alive=KEEP_ALIVE, max_retries=MAX_RETRIES,
+                                     retry_backoff=BACKOFF, read_timeout=5)
+    print(f"🧪 Ollama giả tại {fake.url}")
+    check_sync(fake, client)
+    asyncio.run(check_async(fake, client))
+    client.close()
+    fake.server.shutdown()
+
+    if failures:
+        print(f"\n❌ {len(failures)} mục sai: {', '.join(failures)}")
+        sys.exit(1)
+    print("\n✅ llm_client hoạt động đúng")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# check_server_stream.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Gọi /ask/stream của server.app trực tiếp qua httpx.ASGITransport (không cần chạy uvicorn),
+#     LLM là Ollama giả của check_llm_client, DB tạm (không đụng docs.db). retrieve / embed_query
+#     được thay bằng bản cố định nên không cần model hay faiss.index:
+#       định dạng SSE ("event: ...\ndata: <json>\n\n", text/event-stream),
+#       event sources gửi trước mọi token, kết thúc bằng done,
+#       Ollama lỗi giữa stream / lỗi ngay từ đầu -> event error (sau các token đã gửi) rồi done
+#   - In ✅ / ❌ từng mục, exit code 1 nếu có mục sai
+#
+#   python src/check_server_stream.py
+# ------------------------------------------------------------
+
+import os
+import sys
+import json
+import shutil
+import asyncio
+import hashlib
+import tempfile
+
+import httpx
+import numpy as np
+import config_loader
+
+# Trỏ vector_db.metadata_path sang DB tạm TRƯỚC khi import server (db tạo bảng ngay lúc import)
+TMP_DIR = tempfile.mkdtemp(prefix="check_stream_")
+_load_config = config_loader.load_config
+
+
+def _load_temp_config():
+    cfg = _load_config()
+    cfg.setdefault("vector_db", {})["metadata_path"] = os.path.join(TMP_DIR, "docs.db")
+    return cfg
+
+
+config_loader.load_config = _load_temp_config
+import db
+import qa
+import llm_client
+import server
+from check_llm_client import FakeOllama
+
+RETRIEVED = [
+    {"rank": 1, "source": "Wiki: Lúa", "rep_type": "wiki_content", "score": 0.91,
+     "text": "Lúa đẻ nhánh cần bón đạm.", "full_path": "wiki://Lúa"},
+    {"rank": 2, "source": "Wiki: Phân bón", "rep_type": "wiki_content", "score": 0.84,
+     "text": "Urê là phân đạm phổ biến.", "full_path": "wiki://Phân bón"},
+]
+TOKENS = ["Xin ", "chào"]  # Token mà FakeOllama stream về
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'✅' if ok else '❌'} {name}" + (f" ({detail})" if detail else ""))
+    if not ok:
+        failures.append(name)
+
+
+def _fixed_embed(query):
+    """Thay qa.embed_query: mỗi câu hỏi 1 vector riêng (không trúng cache câu trả lời của câu khác)"""
+    seed = int.from_bytes(hashlib.sha1(query.encode("utf-8")).digest()[:4], "little")
+    vec = np.random.default_rng(seed).standard_normal(16)
+    return (vec / np.linalg.norm(vec)).astype("float32")
+
+
+def parse_sse(body):
+    """Body text/event-stream -> list (event, data) hoặc None nếu sai định dạng"""
+    if not body.endswith("\n\n"):
+        return None
+    events = []
+    for block in body[:-2].split("\n\n"):
+        lines = block.split("\n")
+        if len(lines) != 2 or not lines[0].startswith("event: ") or not lines[1].startswith("data: "):
+            return None
+        try:
+            events.append((lines[0][len("event: "):], json.loads(lines[1][len("data: "):])))
+        except ValueError:
+            return None
+    return events
+
+
+async def ask_stream(client, query):
+    resp = await client.post("/ask/stream", json={"query": query})
+    return resp, parse_sse(resp.text)
+
+
+async def run_checks(fake, client):
+    fake.reset()
+    resp, events = await ask_stream(client, "Bón phân gì cho lúa?")
+    check("stream: 200 + text/event-stream", resp.status_code == 200
+          and resp.headers.get("content-type", "").startswith("text/event-stream"), resp.headers.get("content-type"))
+    check("stream: đúng định dạng SSE (event + data JSON, cách nhau dòng trống)", events is not None, repr(resp.text[:120]))
+    events = events or []
+    names = [name for name, data in events]
+    check("stream: sources trước mọi token, kết thúc bằng done",
+          names == ["sources"] + ["token"] * len(TOKENS) + ["done"], str(names))
+    check("stream: sources đúng tài liệu đã retrieve",
+          events and [s["source"] for s in events[0][1]] == [r["source"] for r in RETRIEVED])
+    check("stream: token đúng thứ tự từ Ollama", [data for name, data in events if name == "token"] == TOKENS)
+    check("stream: gọi Ollama với stream=true", len(fake.requests) == 1 and fake.requests[0].get("stream") is True)
+
+    fake.reset(stream_error=True)
+    resp, events = await ask_stream(client, "Sâu đục thân hại ngô?")
+    names = [name for name, data in events or []]
+    check("lỗi giữa stream: token đã gửi rồi error rồi done",
+          names == ["sources"] + ["token"] * len(TOKENS) + ["error", "done"], str(names))
+
+    fake.reset(fail_next=1, fail_status=500)
+    resp, events = await ask_stream(client, "Vì sao lá sầu riêng vàng?")
+    names = [name for name, data in events or []]
+    check("Ollama lỗi ngay từ đầu: sources, error, done", names == ["sources", "error", "done"], str(names))
+
+    fake.reset(stream_error=True)
+    resp, events = await ask_stream(client, "Sâu đục thân hại ngô?")
+    check("lỗi giữa stream: câu trả lời dở dang không bị cache", len(fake.requests) == 1,
+          f"{len(fake.requests)} request tới Ollama")
+
+    original = qa.retrieve
+    qa.retrieve = lambda query: []
+    fake.reset()
+    resp, events = await ask_stream(client, "Câu hỏi không có tài liệu")
+    qa.retrieve = original
+    check("không có tài liệu: sources rỗng, token NOT_FOUND, không gọi Ollama",
+          events == [("sources", []), ("token", qa.NOT_FOUND_ANSWER), ("done", {})] and not fake.requests, str(events))
+
+
+async def main_async(fake):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://server") as client:
+        await run_checks(fake, client)
+    await llm_client.get_client().aclose()
+
+
+def main():
+    fake = FakeOllama()
+    llm_client._client = llm_client.OllamaClient(base_url=fake.url, max_retries=0, read_timeout=5)
+    qa.embed_query = _fixed_embed
+    qa.retrieve = lambda query: RETRIEVED
+    print(f"🧪 Ollama giả tại {fake.url}, DB tạm {db.DB_PATH}")
+    try:
+        asyncio.run(main_async(fake))
+    finally:
+        fake.server.shutdown()
+        db.close_connections()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    if failures:
+        print(f"\n❌ {len(failures)} mục sai: {', '.join(failures)}")
+        sys.exit(1)
+    print("\n✅ /ask/stream hoạt động đúng")
+
+
+if __name__ == "__main__":
+    main()
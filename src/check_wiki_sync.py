@@ -0,0 +1,337 @@
+# check_wiki_sync.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Kiểm tra phần gọi Wiki của ingest.py với một MediaWiki api.php giả chạy trong process,
+#     trên DB + index tạm (không đụng docs.db, faiss.index; embedding thay bằng vector băm theo
+#     nội dung nên không cần model):
+#       wiki_request: retry lỗi HTTP / JSON hỏng với backoff tăng dần, bỏ cuộc sau wiki_retries,
+#                     lỗi API không retry
+#       full crawl: bị ngắt giữa chừng -> lưu checkpoint, lần sau chạy tiếp đúng từ checkpoint
+#       xóa trang: vượt wiki_max_delete_ratio thì không xóa, --dry-run không ghi gì
+#       incremental: theo recentchanges nhận đúng trang sửa / tạo mới / bị xóa, chỉ embed lại
+#                    trang đã đổi
+#   - In ✅ / ❌ từng mục, exit code 1 nếu có mục sai
+#
+#   python src/check_wiki_sync.py
+# ------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import faiss
+import numpy as np
+import requests
+import config_loader
+
+# Trỏ vector_db.metadata_path sang DB tạm TRƯỚC khi import db / ingest (db tạo bảng ngay lúc import)
+TMP_DIR = tempfile.mkdtemp(prefix="check_wiki_")
+_load_config = config_loader.load_config
+
+
+def _load_temp_config():
+    cfg = _load_config()
+    cfg.setdefault("vector_db", {})["metadata_path"] = os.path.join(TMP_DIR, "docs.db")
+    return cfg
+
+
+config_loader.load_config = _load_temp_config
+import db
+import ingest
+import index_service
+from index_store import IndexStore
+
+PAGE_SIZE = 3  # Số trang mỗi lô allpages (để crawl có nhiều lô)
+NOW = "2026-10-10T00:00:00Z"
+DIM = 16  # Số chiều vector băm thay cho model embedding
+
+
+class FakeWiki:
+    """
+    api.php giả: allpages (có continue), recentchanges, titles (prop=info), pageids (nội dung bản
+    mới nhất), curtimestamp; chèn lỗi theo yêu cầu
+    """
+
+    def __init__(self, pages):
+        self.pages = pages  # title -> (pageid, revid)
+        self.contents = {}  # title -> nội dung (mặc định sinh theo title + revid)
+        self.recent = []    # Các entry recentchanges (dict như API trả về)
+        self.now = NOW
+        self.fail_next = 0            # Số request tới trả về 500
+        self.bad_json_next = 0        # Số request tới trả về body không phải JSON
+        self.fail_allpages_from = None  # allpages từ vị trí này luôn lỗi 500
+        self.api_error = False
+        self.log = []  # (loại request, gapcontinue)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                q = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                start = int(q.get("gapcontinue", 0))
+                fake.log.append((fake.kind(q), start))
+                if fake.fail_next > 0 or (q.get("generator") == "allpages" and fake.fail_allpages_from is not None
+                                          and start >= fake.fail_allpages_from):
+                    fake.fail_next = max(0, fake.fail_next - 1)
+                    return self._send(500, b"error")
+                if fake.bad_json_next > 0:
+                    fake.bad_json_next -= 1
+                    return self._send(200, b"<html>proxy error</html>")
+                if fake.api_error:
+                    return self._send(200, json.dumps({"error": {"code": "badvalue"}}).encode())
+                self._send(200, json.dumps(fake.respond(q, start)).encode())
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api.php"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def kind(q):
+        if "generator" in q or "list" in q:
+            return q.get("generator") or q["list"]
+        if "titles" in q or "pageids" in q:
+            return "info" if q.get("prop") == "info" else "revisions"
+        return "curtimestamp" if "curtimestamp" in q else "other"
+
+    def content(self, title):
+        return self.contents.get(title, f"{title}: nội dung bản {self.pages[title][1]}.")
+
+    def _info(self, title):
+        pageid, revid = self.pages[title]
+        return {"pageid": pageid, "ns": 0, "title": title, "lastrevid": revid}
+
+    def respond(self, q, start):
+        out = {"batchcomplete": ""}
+        if "curtimestamp" in q:
+            out["curtimestamp"] = self.now
+        if q.get("generator") == "allpages":
+            titles = sorted(self.pages)[start:start + PAGE_SIZE]
+            out["query"] = {"pages": {str(self.pages[t][0]): self._info(t) for t in titles}}
+            if start + PAGE_SIZE < len(self.pages):
+                out["continue"] = {"gapcontinue": str(start + PAGE_SIZE), "continue": "gapcontinue||"}
+        elif q.get("list") == "recentchanges":
+            out["query"] = {"recentchanges": [rc for rc in self.recent if rc["timestamp"] >= q["rcstart"]]}
+        elif "titles" in q:
+            pages = {}
+            for i, title in enumerate(q["titles"].split("|"), 1):
+                if title in self.pages:
+                    pages[str(self.pages[title][0])] = self._info(title)
+                else:
+                    # Trang không tồn tại: key âm + "missing" như MediaWiki
+                    pages[str(-i)] = {"ns": 0, "title": title, "missing": ""}
+            out["query"] = {"pages": pages}
+        elif "pageids" in q:
+            by_id = {pageid: t for t, (pageid, revid) in self.pages.items()}
+            pages = {}
+            for pageid in map(int, q["pageids"].split("|")):
+                title = by_id.get(pageid)
+                if title is None:
+                    pages[str(pageid)] = {"pageid": pageid, "missing": ""}
+                    continue
+                pages[str(pageid)] = {"pageid": pageid, "ns": 0, "title": title, "revisions": [{
+                    "revid": self.pages[title][1], "timestamp": self.now,
+                    "slots": {"main": {"*": self.content(title)}}}]}
+            out["query"] = {"pages": pages}
+        return out
+
+    def allpages_starts(self):
+        return [start for kind, start in self.log if kind == "allpages"]
+
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'✅' if ok else '❌'} {name}" + (f" ({detail})" if detail else ""))
+    if not ok:
+        failures.append(name)
+
+
+def check_wiki_request(fake, session):
+    retries = ingest.WIKI_RETRIES
+    fake.fail_next = retries
+    fake.log.clear()
+    start = time.perf_counter()
+    data = ingest.wiki_request(session, {"curtimestamp": 1})
+    elapsed = time.perf_counter() - start
+    min_wait = sum(ingest.WIKI_BACKOFF_SECONDS * 2 ** i for i in range(retries))
+    check("wiki_request: retry lỗi 500 rồi thành công", data.get("curtimestamp") == NOW and len(fake.log) == retries + 1,
+          f"{len(fake.log)} request")
+    check("wiki_request: backoff tăng dần", elapsed >= min_wait, f"{elapsed:.3f}s >= {min_wait:.3f}s")
+
+    fake.fail_next = retries + 1
+    fake.log.clear()
+    try:
+        ingest.wiki_request(session, {"curtimestamp": 1})
+        gave_up = False
+    except requests.HTTPError:
+        gave_up = True
+    check("wiki_request: bỏ cuộc sau wiki_retries", gave_up and len(fake.log) == retries + 1, f"{len(fake.log)} request")
+
+    fake.bad_json_next = 1
+    fake.log.clear()
+    data = ingest.wiki_request(session, {"curtimestamp": 1})
+    check("wiki_request: retry khi JSON hỏng", data.get("curtimestamp") == NOW and len(fake.log) == 2)
+
+    fake.api_error = True
+    fake.log.clear()
+    try:
+        ingest.wiki_request(session, {"curtimestamp": 1})
+        raised = False
+    except RuntimeError:
+        raised = True
+    fake.api_error = False
+    check("wiki_request: lỗi API không retry", raised and len(fake.log) == 1, f"{len(fake.log)} request")
+
+
+def check_crawl_resume(fake):
+    # DB tạm đã có đúng revid của mọi trang -> crawl không phải tải nội dung / embed
+    db.set_wiki_revisions([(ingest._wiki_path(t), pid, rev, NOW) for t, (pid, rev) in fake.pages.items()])
+
+    fake.fail_allpages_from = 2 * PAGE_SIZE
+    fake.log.clear()
+    ingest.sync_wiki("full")
+    checkpoint = db.get_sync_state("wiki_crawl")
+    resume_from = json.loads(checkpoint)["continue"] if checkpoint else None
+    check("full crawl bị ngắt: lưu checkpoint", resume_from is not None
+          and resume_from.get("gapcontinue") == str(2 * PAGE_SIZE), str(resume_from))
+    check("full crawl bị ngắt: chưa ghi wiki_last_sync", db.get_sync_state("wiki_last_sync") is None)
+
+    fake.fail_allpages_from = None
+    fake.fail_next = 1  # Thêm 1 lỗi tạm thời lúc chạy tiếp
+    fake.log.clear()
+    ingest.sync_wiki("full")
+    starts = fake.allpages_starts()
+    check("chạy tiếp: bắt đầu đúng từ checkpoint", starts and min(starts) == 2 * PAGE_SIZE, f"allpages từ {starts}")
+    check("chạy tiếp: xong thì xóa checkpoint", db.get_sync_state("wiki_crawl") is None
+          and db.get_sync_state("wiki_last_sync") == NOW)
+    crawl_id = json.loads(checkpoint)["started"]
+    check("chạy tiếp: mọi trang được đánh dấu đã thấy", not db.get_wiki_unseen(crawl_id),
+          f"{len(db.get_wiki_unseen(crawl_id))} trang chưa thấy")
+    check("chạy tiếp: không xóa trang nào", len(db.get_wiki_revisions()) == len(fake.pages))
+
+
+def check_delete_guard(fake):
+    known = len(db.get_wiki_revisions())
+    for title in sorted(fake.pages)[:known // 2]:
+        del fake.pages[title]
+
+    ingest.sync_wiki("full", dry_run=True)
+    check("dry run: không ghi gì", len(db.get_wiki_revisions()) == known
+          and db.get_sync_state("wiki_crawl") is None)
+
+    ingest.sync_wiki("full")
+    check(f"xóa {known // 2}/{known} trang > wiki_max_delete_ratio: không xóa",
+          len(db.get_wiki_revisions()) == known, f"còn {len(db.get_wiki_revisions())} trang")
+
+
+embedded = []  # full_path của các chunk đã được embed
+
+
+def _hash_embed(db_entries, **kwargs):
+    """Thay ingest.embed_entries: vector băm theo nội dung chunk, ghi lại chunk nào được embed"""
+    embedded.extend(e["full_path"] for e in db_entries)
+    vecs = np.empty((len(db_entries), DIM), dtype="float32")
+    for i, entry in enumerate(db_entries):
+        seed = int.from_bytes(hashlib.sha1(entry["text"].encode("utf-8")).digest()[:4], "little")
+        vec = np.random.default_rng(seed).standard_normal(DIM)
+        vecs[i] = vec / np.linalg.norm(vec)
+    return vecs
+
+
+def check_incremental_sync():
+    fake = FakeWiki({f"Lúa {i:02d}": (200 + i, 1000 + i) for i in range(1, 13)})
+    ingest.WIKI_API_URL = fake.url
+    try:
+        # Bắt đầu lại từ DB không có trang wiki nào: lượt đầu là full crawl, embed mọi trang
+        db.delete_wiki_revisions(list(db.get_wiki_revisions()))
+        db.set_sync_state("wiki_last_sync", None)
+        db.set_sync_state("wiki_crawl", None)
+        embedded.clear()
+        ingest.sync_wiki("incremental")
+        check("lần đầu (chưa có mốc sync): embed mọi trang", sorted(set(embedded)) ==
+              sorted(map(ingest._wiki_path, fake.pages)), f"{len(set(embedded))}/{len(fake.pages)} trang")
+
+        edited, removed, created = "Lúa 03", "Lúa 07", "Lúa 13"
+        later = "2026-10-10T12:00:00Z"
+        fake.pages[edited] = (fake.pages[edited][0], 2003)
+        fake.contents[edited] = f"{edited}: đã sửa, bón thêm kali."
+        fake.pages[created] = (213, 1013)
+        removed_ids = [r["id"] for r in db.get_chunks_by_path(ingest._wiki_path(removed))]
+        del fake.pages[removed]
+        fake.recent = [
+            {"type": "edit", "ns": 0, "title": edited, "timestamp": later},
+            {"type": "new", "ns": 0, "title": created, "timestamp": later},
+            {"type": "log", "ns": 0, "title": removed, "logtype": "delete", "logaction": "delete", "timestamp": later},
+        ]
+        fake.now = "2026-10-11T00:00:00Z"
+        fake.log.clear()
+        embedded.clear()
+        ingest.sync_wiki("incremental")
+
+        kinds = {kind for kind, start in fake.log}
+        check("incremental: dùng recentchanges, không duyệt allpages",
+              "recentchanges" in kinds and "allpages" not in kinds, str(sorted(kinds)))
+        check("incremental: chỉ embed lại trang sửa + trang mới",
+              sorted(set(embedded)) == sorted(map(ingest._wiki_path, (edited, created))), str(sorted(set(embedded))))
+        revisions = db.get_wiki_revisions()
+        check("incremental: ghi revid mới của trang sửa", revisions.get(ingest._wiki_path(edited)) == 2003)
+        check("incremental: thêm trang mới", revisions.get(ingest._wiki_path(created)) == 1013
+              and len(db.get_chunks_by_path(ingest._wiki_path(created))) == 1)
+        chunks = db.get_chunks_by_path(ingest._wiki_path(edited))
+        check("incremental: nội dung trang sửa được cập nhật", [c["text"] for c in chunks] == [fake.contents[edited]])
+        index_ids = set(faiss.vector_to_array(index_service.get_index().id_map).tolist())
+        check("incremental: xóa chunk + vector + revid của trang bị xóa",
+              not db.get_chunks_by_path(ingest._wiki_path(removed)) and ingest._wiki_path(removed) not in revisions
+              and bool(removed_ids) and not index_ids & set(removed_ids))
+        check("incremental: index khớp docs.db", index_ids == db.get_all_ids(),
+              f"{len(index_ids)} vector, {len(db.get_all_ids())} đoạn")
+        check("incremental: ghi mốc sync mới", db.get_sync_state("wiki_last_sync") == fake.now)
+    finally:
+        fake.server.shutdown()
+
+
+def main():
+    fake = FakeWiki({f"Cây {i:02d}": (i, 100 + i) for i in range(1, 11)})
+    ingest.WIKI_API_URL = fake.url
+    ingest.WIKI_BACKOFF_SECONDS = 0.02
+    ingest.embed_entries = _hash_embed
+    # Index trong thư mục tạm (tạo mới, không đụng faiss.index)
+    index_service.store = IndexStore(os.path.join(TMP_DIR, "faiss.index"))
+    index_service.FULL_VECTORS_FILE = os.path.join(TMP_DIR, "faiss.index.f32")
+    index_service.load(DIM)
+    print(f"🧪 Wiki giả tại {fake.url}, DB tạm {db.DB_PATH}")
+    try:
+        check_wiki_request(fake, requests.Session())
+        check_crawl_resume(fake)
+        check_delete_guard(fake)
+        check_incremental_sync()
+    finally:
+        fake.server.shutdown()
+        db.close_connections()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    if failures:
+        print(f"\n❌ {len(failures)} mục sai: {', '.join(failures)}")
+        sys.exit(1)
+    print("\n✅ Đồng bộ Wiki hoạt động đúng")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import sqlite3
 import os
+import re
 import json
+import threading
+from contextlib import contextmanager
+import numpy as np
 from config_loader import load_config
 
 # Load config
@@ -12,54 +16,194 @@ DB_PATH = config.get("vector_db", {}).get("metadata_path", "docs.db")
 if not os.path.isabs(DB_PATH):
     DB_PATH = os.path.join(BASE_DIR, "..", DB_PATH)
 
+# Tham số SQLite (xem mục database trong config.yaml)
+DB_CFG = config.get("database", {})
+MMAP_SIZE = int(DB_CFG.get("mmap_size_mb", 256)) * 1024 * 1024
+CACHE_SIZE_KB = int(DB_CFG.get("cache_size_mb", 64)) * 1024
+BUSY_TIMEOUT_MS = int(DB_CFG.get("busy_timeout_ms", 5000))
+
+# Full-text index (FTS5, BM25) trên text + source, dùng cho retrieval_mode: hybrid.
+# remove_diacritics 2: "lua" khớp "lúa" (người dùng hay gõ thiếu dấu), reranker lo độ chính xác
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+# Bỏ các từ xuất hiện trong hơn tỉ lệ này số đoạn văn ("có", "cây"...): BM25 gần như không
+# tính điểm cho chúng nhưng SQLite phải xếp hạng toàn bộ đoạn chứa chúng
+FTS_MAX_DF = config.get("vector_db", {}).get("lexical_max_df", 0.3)
+fts_available = True  # False nếu bản SQLite không có FTS5
+FTS_DF_CACHE_SIZE = 10000  # Số từ tối đa trong cache document frequency của mỗi connection
+
+# ==============================================================================
+# QUẢN LÝ KẾT NỐI
+# - Mỗi thread giữ 1 kết nối riêng (sqlite3 không nên dùng chung connection giữa thread)
+# - WAL: đọc không bị chặn khi ingest đang ghi
+# - Ghi được tuần tự hóa bằng _write_lock + BEGIN IMMEDIATE
+# ==============================================================================
+_local = threading.local()
+_write_lock = threading.RLock()
+_connections = []
+_connections_lock = threading.Lock()
+_write_generation = 0  # Tăng sau mỗi transaction ghi (PRAGMA data_version không đổi khi chính connection ghi)
+
+# Câu SELECT theo danh sách ID cố định (ID truyền dạng JSON) -> SQLite chỉ prepare 1 lần
+# cho mỗi connection, thay vì mỗi độ dài IN (?, ?, ...) là một câu lệnh khác nhau
+_SELECT_BY_IDS = """
+    SELECT id, doc_uuid, text, source, rep_type, full_path FROM documents
+    WHERE id IN (SELECT value FROM json_each(?))
+"""
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,      # autocommit, transaction mở tường minh bằng transaction()
+        check_same_thread=False,   # Để close_connections() đóng được từ thread khác
+        cached_statements=256,
+    )
+    conn.row_factory = sqlite3.Row # Để truy cập theo tên cột
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_connection():
+    """Kết nối của thread hiện tại (tạo mới nếu chưa có hoặc sau khi fork process)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.fts_df = None
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction():
+    """Transaction ghi: chỉ 1 writer tại một thời điểm, rollback nếu lỗi"""
+    global _write_generation
+    with _write_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        _write_generation += 1
+
+def close_connections():
+    """Đóng toàn bộ kết nối đang mở (gọi khi tắt server)"""
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
 def init_db():
     """Khởi tạo database và bảng documents nếu chưa có"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY,
-            doc_uuid TEXT,
-            text TEXT,
-            source TEXT,
-            rep_type TEXT,
-            full_path TEXT
-        )
-    ''')
-    # Index để tìm kiếm nhanh theo full_path (tránh trùng lặp)
-    c.execute('CREATE INDEX IF NOT EXISTS idx_full_path ON documents(full_path)')
-    conn.commit()
-    conn.close()
-
-def get_doc_count():
-    """Lấy tổng số documents hiện có (dùng để tính ID tiếp theo cho FAISS)"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT MAX(id) FROM documents")
-    result = c.fetchone()[0]
-    conn.close()
-    return (result + 1) if result is not None else 0
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                doc_uuid TEXT,
+                text TEXT,
+                source TEXT,
+                rep_type TEXT,
+                full_path TEXT,
+                content_hash TEXT,
+                embedding BLOB,
+                embedding_model TEXT
+            )
+        ''')
+        # DB cũ thiếu cột: thêm cột rỗng (hash tính lại khi cần, embedding bổ sung bằng rebuild_index.py)
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(documents)").fetchall()}
+        for column, sql_type in (("content_hash", "TEXT"), ("embedding", "BLOB"), ("embedding_model", "TEXT")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE documents ADD COLUMN {column} {sql_type}")
+        # Index để tìm kiếm nhanh theo full_path (tránh trùng lặp)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_full_path ON documents(full_path)')
+        # Revision đã ingest của từng trang wiki (đồng bộ incremental, xem ingest.sync_wiki)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS wiki_pages (
+                full_path TEXT PRIMARY KEY,
+                page_id INTEGER,
+                revid INTEGER,
+                timestamp TEXT,
+                last_seen TEXT
+            )
+        ''')
+        if "last_seen" not in {r[1] for r in conn.execute("PRAGMA table_info(wiki_pages)").fetchall()}:
+            conn.execute("ALTER TABLE wiki_pages ADD COLUMN last_seen TEXT")
+        # Trạng thái đồng bộ dạng key/value (vd. mốc thời gian lần sync wiki gần nhất)
+        conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)')
+        _init_fts(conn)
+
+def _init_fts(conn):
+    """
+    Bảng FTS5 external-content (không lưu bản sao text, đọc từ documents).
+    DB cũ chưa có bảng FTS -> tạo rồi rebuild từ documents (1 lần).
+    """
+    global fts_available
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'documents_fts'").fetchone()
+    try:
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                text, source, content='documents', content_rowid='id', tokenize='{FTS_TOKENIZER}'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        fts_available = False
+        print(f"⚠️ SQLite không hỗ trợ FTS5 ({e}), tắt tìm kiếm từ khóa (hybrid).")
+        return
+    if not exists:
+        print("🔤 Đang tạo full-text index (FTS5) cho documents...")
+        conn.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')")
+
+def allocate_ids(n):
+    """
+    Cấp n ID liên tiếp cho documents / FAISS, trả về ID đầu tiên. Bộ đếm next_doc_id trong
+    sync_state chỉ tăng: ID của chunk đã xóa không bao giờ được cấp lại (HNSW không xóa được
+    vector cũ, replay delta log cũng dựa vào ID duy nhất).
+    """
+    with transaction() as conn:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = 'next_doc_id'").fetchone()
+        max_id = conn.execute("SELECT MAX(id) FROM documents").fetchone()[0]
+        start = max(int(row[0]) if row else 0, (max_id + 1) if max_id is not None else 0)
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('next_doc_id', ?)",
+                     (str(start + n),))
+    return start
 
 def get_all_full_paths():
     """Lấy danh sách tất cả các full_path đã xử lý"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT full_path FROM documents")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute("SELECT DISTINCT full_path FROM documents").fetchall()
+    return {r[0] for r in rows}
+
+def get_all_ids():
+    """Tất cả ID hiện có (dùng để đối chiếu với FAISS index)"""
+    rows = get_connection().execute("SELECT id FROM documents").fetchall()
     return {r[0] for r in rows}
 
+def _embedding_blob(vec):
+    """Vector -> BLOB float16 (1/2 dung lượng float32, đủ chính xác để dựng lại index)"""
+    return None if vec is None else np.asarray(vec, dtype=np.float16).tobytes()
+
 def add_documents_batch(documents):
     """
     Thêm nhiều documents vào DB.
-    documents: list of dict {'id': int, 'doc_uuid': str, 'text': str, ...}
+    documents: list of dict {'id': int, 'doc_uuid': str, 'text': str, ...,
+               'embedding': vector numpy (tùy chọn), 'embedding_model': tên model}
     """
     if not documents:
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
     data = []
     for doc in documents:
         # doc['id'] ở đây là FAISS ID (integer 0, 1, 2...)
@@ -69,16 +213,22 @@ def add_documents_batch(documents):
             doc['text'],
             doc['source'],
             doc['rep_type'],
-            doc['full_path']
+            doc['full_path'],
+            doc.get('content_hash'),
+            _embedding_blob(doc.get('embedding')),
+            doc.get('embedding_model')
         ))
 
-    c.executemany('''
-        INSERT INTO documents (id, doc_uuid, text, source, rep_type, full_path)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', data)
-    
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT INTO documents (id, doc_uuid, text, source, rep_type, full_path, content_hash,
+                                   embedding, embedding_model)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', data)
+        if fts_available:
+            conn.executemany(
+                "INSERT INTO documents_fts (rowid, text, source) VALUES (?, ?, ?)",
+                [(d[0], d[2], d[3]) for d in data])
 
 def get_documents_by_ids(ids):
     """
@@ -89,15 +239,7 @@ def get_documents_by_ids(ids):
         return []
 
     # SQLite không đảm bảo thứ tự trả về theo IN (...), nên ta lấy về rồi map lại
-    placeholders = ",".join("?" * len(ids))
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row # Để truy cập theo tên cột
-    c = conn.cursor()
-    
-    query = f"SELECT * FROM documents WHERE id IN ({placeholders})"
-    c.execute(query, ids)
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute(_SELECT_BY_IDS, (json.dumps([int(i) for i in ids]),)).fetchall()
 
     # Convert to dict map
     doc_map = {}
@@ -119,26 +261,189 @@ def get_documents_by_ids(ids):
             
     return results
 
+def load_embeddings(model):
+    """
+    Toàn bộ embedding đã lưu của model: (ids int64, vecs float32 N x dim).
+    Dòng chưa có embedding hoặc embedding của model khác bị bỏ qua (xem get_missing_embeddings).
+    """
+    rows = get_connection().execute(
+        "SELECT id, embedding FROM documents WHERE embedding IS NOT NULL AND embedding_model = ? ORDER BY id",
+        (model,)).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), None
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    vecs = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float16).reshape(len(rows), -1)
+    return ids, vecs.astype(np.float32)
+
+def get_missing_embeddings(model):
+    """Các dòng chưa có embedding của model: list dict {id, text}"""
+    rows = get_connection().execute(
+        "SELECT id, text FROM documents WHERE embedding IS NULL OR embedding_model IS NOT ? ORDER BY id",
+        (model,)).fetchall()
+    return [dict(r) for r in rows]
+
+def set_embeddings(ids, vecs, model):
+    """Ghi embedding cho các dòng đã có (bổ sung cho DB cũ / đổi model)"""
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE documents SET embedding = ?, embedding_model = ? WHERE id = ?",
+            [(_embedding_blob(v), model, int(i)) for i, v in zip(ids, vecs)])
+
+def _fts_df_cache(conn):
+    """
+    Cache document frequency (số đoạn chứa từ) + tổng số đoạn của connection hiện tại, để mỗi
+    câu hỏi không phải COUNT lại từng từ. Bỏ cache khi DB thay đổi: ghi trong process này
+    (_write_generation) hoặc process khác ghi (PRAGMA data_version).
+    """
+    version = (conn.execute("PRAGMA data_version").fetchone()[0], _write_generation)
+    cache = _local.fts_df
+    if cache is None or cache["version"] != version or len(cache["df"]) > FTS_DF_CACHE_SIZE:
+        cache = _local.fts_df = {"version": version, "df": {}, "doc_count": None}
+    return cache
+
+def _fts_terms(conn, query, max_df):
+    """
+    Các từ của câu hỏi (không trùng), bỏ từ không có trong index và từ quá phổ biến
+    (> max_df * số đoạn văn). Nếu mọi từ đều phổ biến thì giữ 3 từ hiếm nhất.
+    """
+    terms = list(dict.fromkeys(re.findall(r"\w+", query.lower())))
+    cache = _fts_df_cache(conn)
+    df = cache["df"]
+    for t in terms:
+        if t not in df:
+            df[t] = conn.execute("SELECT COUNT(*) FROM documents_fts WHERE documents_fts MATCH ?",
+                                 (f'"{t}"',)).fetchone()[0]
+    terms = [t for t in terms if df[t] > 0]
+    if max_df >= 1 or not terms:
+        return terms
+    if cache["doc_count"] is None:
+        cache["doc_count"] = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+    limit = max_df * cache["doc_count"]
+    rare = [t for t in terms if df[t] <= limit]
+    return rare or sorted(terms, key=df.get)[:3]
+
+def search_fts(query, limit, max_df=FTS_MAX_DF):
+    """
+    Tìm kiếm từ khóa BM25. Trả về list ID theo thứ tự liên quan giảm dần
+    (rỗng nếu không có FTS5 hoặc câu hỏi không có từ nào trong index).
+    """
+    if not fts_available:
+        return []
+    conn = get_connection()
+    terms = _fts_terms(conn, query, max_df)
+    if not terms:
+        return []
+    # Mỗi từ trong ngoặc kép (tránh lỗi cú pháp MATCH), nối bằng OR
+    match = " OR ".join(f'"{t}"' for t in terms)
+    rows = conn.execute(
+        "SELECT rowid FROM documents_fts WHERE documents_fts MATCH ? ORDER BY rank LIMIT ?",
+        (match, limit)).fetchall()
+    return [r[0] for r in rows]
+
+def get_chunks_by_path(full_path):
+    """Các chunk hiện có của 1 bài viết: list dict {id, text, source, content_hash}, theo ID"""
+    rows = get_connection().execute(
+        "SELECT id, text, source, content_hash FROM documents WHERE full_path = ? ORDER BY id",
+        (full_path,)).fetchall()
+    return [dict(r) for r in rows]
+
+def update_sources(updates):
+    """updates: list of (id, source mới) - chunk giữ nguyên nội dung nhưng đổi số thứ tự đoạn"""
+    if not updates:
+        return
+    with transaction() as conn:
+        for doc_id, source in updates:
+            if fts_available:
+                conn.execute('''
+                    INSERT INTO documents_fts (documents_fts, rowid, text, source)
+                    SELECT 'delete', id, text, source FROM documents WHERE id = ?
+                ''', (doc_id,))
+            conn.execute("UPDATE documents SET source = ? WHERE id = ?", (source, doc_id))
+            if fts_available:
+                conn.execute(
+                    "INSERT INTO documents_fts (rowid, text, source) SELECT id, text, source FROM documents WHERE id = ?",
+                    (doc_id,))
+
+def delete_documents_by_ids(ids):
+    """Xóa các chunk theo ID (chunk không còn trong bản mới của bài viết)"""
+    if not ids:
+        return
+    payload = (json.dumps([int(i) for i in ids]),)
+    with transaction() as conn:
+        if fts_available:
+            conn.execute('''
+                INSERT INTO documents_fts (documents_fts, rowid, text, source)
+                SELECT 'delete', id, text, source FROM documents WHERE id IN (SELECT value FROM json_each(?))
+            ''', payload)
+        conn.execute("DELETE FROM documents WHERE id IN (SELECT value FROM json_each(?))", payload)
+
 def delete_documents_by_path(full_path):
     """
     Xóa tất cả documents có full_path khớp (dùng khi cập nhật bài viết).
     Trả về danh sách ID đã xóa để đồng bộ xóa bên FAISS.
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # 1. Lấy danh sách ID cần xóa
-    c.execute("SELECT id FROM documents WHERE full_path = ?", (full_path,))
-    rows = c.fetchall()
-    deleted_ids = [r[0] for r in rows]
-    
-    if deleted_ids:
-        # 2. Xóa dữ liệu
-        c.execute("DELETE FROM documents WHERE full_path = ?", (full_path,))
-        conn.commit()
-    
-    conn.close()
+    with transaction() as conn:
+        # 1. Lấy danh sách ID cần xóa
+        rows = conn.execute("SELECT id FROM documents WHERE full_path = ?", (full_path,)).fetchall()
+        deleted_ids = [r[0] for r in rows]
+
+        if deleted_ids:
+            # 2. Xóa khỏi FTS (external-content cần đúng nội dung cũ) rồi xóa dữ liệu
+            if fts_available:
+                conn.execute('''
+                    INSERT INTO documents_fts (documents_fts, rowid, text, source)
+                    SELECT 'delete', id, text, source FROM documents WHERE full_path = ?
+                ''', (full_path,))
+            conn.execute("DELETE FROM documents WHERE full_path = ?", (full_path,))
+
     return deleted_ids
 
+# ==============================================================================
+# ĐỒNG BỘ WIKI (revision đã ingest, lượt full crawl gần nhất thấy trang, trạng thái sync)
+# ==============================================================================
+def get_wiki_revisions():
+    """{full_path: revid} của các trang wiki đã ingest"""
+    rows = get_connection().execute("SELECT full_path, revid FROM wiki_pages").fetchall()
+    return {r[0]: r[1] for r in rows}
+
+def set_wiki_revisions(pages, seen=None):
+    """pages: list of (full_path, page_id, revid, timestamp); seen: ID lượt full crawl (nếu có)"""
+    if not pages:
+        return
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO wiki_pages (full_path, page_id, revid, timestamp, last_seen) VALUES (?, ?, ?, ?, ?)",
+            [(*p, seen) for p in pages])
+
+def mark_wiki_seen(full_paths, crawl_id):
+    """Đánh dấu các trang (không đổi) đã thấy trong lượt full crawl crawl_id"""
+    if not full_paths:
+        return
+    with transaction() as conn:
+        conn.executemany("UPDATE wiki_pages SET last_seen = ? WHERE full_path = ?",
+                         [(crawl_id, p) for p in full_paths])
+
+def get_wiki_unseen(crawl_id):
+    """Các trang lượt full crawl crawl_id không thấy (đã bị xóa / đổi tên trên wiki)"""
+    rows = get_connection().execute(
+        "SELECT full_path FROM wiki_pages WHERE last_seen IS NOT ?", (crawl_id,)).fetchall()
+    return [r[0] for r in rows]
+
+def delete_wiki_revisions(full_paths):
+    with transaction() as conn:
+        conn.executemany("DELETE FROM wiki_pages WHERE full_path = ?", [(p,) for p in full_paths])
+
+def get_sync_state(key, default=None):
+    row = get_connection().execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_sync_state(key, value):
+    """value = None: xóa key"""
+    with transaction() as conn:
+        if value is None:
+            conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
 # Initialize on import (optional, but good for safety)
 init_db()
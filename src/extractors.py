@@ -3,11 +3,12 @@
 # Tác dụng:
 #   - Tự động đọc nội dung từ các định dạng tài liệu khác nhau (.docx, .txt, .pdf)
 #   - Trả về text thuần để đưa vào embedding
+#   - PDF đọc được theo từng khoảng trang (read_pdf_pages) để nhiều process đọc song song
+#     một file lớn, và để chunk dần từng trang thay vì nối thành 1 chuỗi khổng lồ
 # ------------------------------------------------------------
 
 import os
 from docx import Document
-from pathlib import Path
 
 try:
     import fitz  # PyMuPDF - đọc PDF
@@ -24,40 +25,42 @@ def read_txt(path):
 def read_docx(path):
     """Đọc file .docx"""
     doc = Document(path)
-    paragraphs = [p.text for p in doc.paragraphs if p.text.strip()]
+    paragraphs = [p.text.strip() for p in doc.paragraphs if p.text.strip()]
     return "\n".join(paragraphs)
 
 
-def read_pdf(path):
-    """Đọc file .pdf (nếu có PyMuPDF)"""
+def _require_fitz():
     if not fitz:
         raise ImportError("⚠️ Cần cài đặt PyMuPDF: pip install PyMuPDF")
 
-    text = ""
+
+def pdf_page_count(path):
+    _require_fitz()
     with fitz.open(path) as pdf:
-        for page in pdf:
-            text += page.get_text("text")
-    return text.strip()
+        return pdf.page_count
 
 
-# extractors.py
-from docx import Document
-import os
+def read_pdf_pages(path, start=0, end=None):
+    """Text của các trang [start, end) (mỗi phần tử 1 trang)"""
+    _require_fitz()
+    with fitz.open(path) as pdf:
+        end = pdf.page_count if end is None else min(end, pdf.page_count)
+        return [pdf[i].get_text("text") for i in range(start, end)]
+
+
+def read_pdf(path):
+    """Đọc file .pdf (nếu có PyMuPDF)"""
+    return "".join(read_pdf_pages(path)).strip()
+
+
+READERS = {
+    ".docx": read_docx,
+    ".txt": read_txt,
+    ".pdf": read_pdf,
+}
+
 
 def auto_extract(path: str) -> str:
-    """Tự động trích xuất nội dung từ file docx hoặc txt, UTF-8."""
-    ext = os.path.splitext(path)[1].lower()
-
-    if ext == ".docx":
-        try:
-            doc = Document(path)
-            paragraphs = [p.text.strip() for p in doc.paragraphs if p.text.strip()]
-            return "\n".join(paragraphs)
-        except Exception as e:
-            print(f"[!] Lỗi đọc file {path}: {e}")
-            return ""
-    elif ext == ".txt":
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
-    else:
-        return ""
+    """Tự động trích xuất nội dung theo đuôi file (.docx, .txt, .pdf), định dạng khác trả về rỗng."""
+    reader = READERS.get(os.path.splitext(path)[1].lower())
+    return reader(path) if reader else ""
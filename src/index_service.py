@@ -0,0 +1,255 @@
+# index_service.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Giữ DUY NHẤT một FAISS index trong RAM cho cả qa (tìm kiếm) và ingest (thêm/xóa)
+#     -> chunk mới tìm thấy được ngay, không ghi file rồi đọc lại, không giữ 2 bản trong RAM
+#   - Khóa đọc/ghi (reader/writer lock): nhiều request /ask search song song,
+#     add/remove của ingest chạy độc quyền
+#   - Lưu đĩa qua index_store (snapshot + delta log), compaction chạy nền trên bản clone
+#     của index (chỉ giữ khóa đọc lúc clone) nên không chặn search lẫn ingest
+#   - HNSW không xóa được vector: ID đã xóa thành tombstone (giữ trong RAM, tính lại lúc load
+#     = ID trong index mà không còn trong docs.db), search lấy dư rồi bỏ các ID đó
+#   - Index nén (sq8 / pq...) + vector_db.rescore: search lấy rescore_factor * k ứng viên,
+#     tính lại điểm bằng vector float32 gốc trong faiss.index.f32
+# ------------------------------------------------------------
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from config_loader import load_config
+import vector_index
+from index_store import IndexStore, FullVectorFile, reconcile_with_db, COMPACT_INTERVAL
+import db
+
+config = load_config()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = os.path.join(BASE_DIR, "..", "faiss.index")
+FULL_VECTORS_FILE = INDEX_FILE + ".f32"
+
+# Search lấy dư tối đa chừng này kết quả để bù tombstone (nhiều hơn -> nên rebuild_index.py)
+TOMBSTONE_OVERFETCH_MAX = config.get("vector_db", {}).get("tombstone_overfetch_max", 256)
+
+
+class RWLock:
+    """Reader/writer lock ưu tiên writer (writer đang chờ sẽ chặn reader mới)"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_locked(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+store = IndexStore(INDEX_FILE)
+_lock = RWLock()
+_load_lock = threading.Lock()
+_index = None
+_full_vectors = None  # FullVectorFile khi bật rescore cho index nén
+_tombstones = set()  # ID đã xóa nhưng vector còn trong index (HNSW)
+
+
+def is_loaded():
+    return _index is not None
+
+
+def exists():
+    """Đã có index trên đĩa (snapshot hoặc delta log) chưa"""
+    return store.exists()
+
+
+def load(dimension=None):
+    """
+    Load index (chỉ lần đầu, các lần sau trả về luôn). Chưa có file mà có dimension
+    -> tạo index rỗng theo config. Sau khi load, bỏ vector có ID không còn trong docs.db.
+    """
+    global _index
+    with _load_lock:
+        if _index is not None:
+            return _index
+        index = store.load(dimension)
+        if index is None:
+            raise FileNotFoundError("❌ Không tìm thấy file faiss.index! Hãy chạy ingest.py trước.")
+        # Đồng bộ với DB: bỏ vector mồ côi (crash giữa lúc ghi index và ghi DB)
+        db_ids = db.get_all_ids()
+        store.append_remove(reconcile_with_db(index, db_ids))
+        _set_tombstones(index, db_ids)
+        _index = index
+        _open_full_vectors(index)
+        print(f"📦 FAISS index: {vector_index.describe(index)}")
+        return _index
+
+
+def _set_tombstones(index, db_ids):
+    """Index không xóa được vector: mọi ID trong index mà không còn trong docs.db là tombstone"""
+    global _tombstones
+    _tombstones = set()
+    if vector_index.supports_remove(index) or index.ntotal == 0:
+        return
+    index_ids = faiss.vector_to_array(index.id_map)
+    _tombstones = set(np.setdiff1d(index_ids, np.fromiter(db_ids, dtype=np.int64, count=len(db_ids))).tolist())
+    if _tombstones:
+        _warn_tombstones(index)
+
+
+def _warn_tombstones(index):
+    print(f"⚠️ {len(_tombstones)} vector đã xóa vẫn nằm trong index {vector_index.index_type_of(index)} "
+          f"(bị lọc khi search), nên chạy rebuild_index.py để dọn.")
+
+
+def _open_full_vectors(index):
+    global _full_vectors
+    # Theo loại index sẽ dùng: vector thêm lúc còn index flat tạm cũng được ghi vector gốc
+    compressed = vector_index.target_type(index) in vector_index.COMPRESSED_TYPES
+    if not (vector_index.RESCORE and compressed) or _full_vectors is not None:
+        return
+    if index.ntotal and not os.path.exists(FULL_VECTORS_FILE):
+        print("⚠️ Chưa có faiss.index.f32: chỉ vector thêm từ giờ mới được rescore (ingest lại để rescore toàn bộ).")
+    _full_vectors = FullVectorFile(FULL_VECTORS_FILE, index.d)
+    print(f"🎯 Rescore top {vector_index.RESCORE_FACTOR}x ứng viên bằng vector float32 gốc")
+
+
+def reload():
+    """Đọc lại index từ đĩa (chỉ cần khi file bị thay đổi bởi process khác)"""
+    global _index
+    index = store.load()
+    if index is None:
+        print("⚠️ Không tìm thấy index để reload.")
+        return
+    with _lock.write_locked():
+        _index = index
+        _set_tombstones(index, db.get_all_ids())
+
+
+def _drop_tombstones(D, I, k):
+    """Bỏ các ID tombstone khỏi kết quả, giữ k cột đầu (thiếu thì -1 như FAISS)"""
+    D_out = np.full((len(I), k), -np.inf, dtype="float32")
+    I_out = np.full((len(I), k), -1, dtype=np.int64)
+    for q in range(len(I)):
+        keep = [j for j, id_ in enumerate(I[q].tolist()) if id_ != -1 and id_ not in _tombstones][:k]
+        D_out[q, :len(keep)] = D[q, keep]
+        I_out[q, :len(keep)] = I[q, keep]
+    return D_out, I_out
+
+
+def search(xq, k):
+    """Tìm kiếm (nhiều thread gọi song song được)"""
+    xq = np.ascontiguousarray(xq, dtype="float32")
+    with _lock.read_locked():
+        factor = 1 if _full_vectors is None else vector_index.RESCORE_FACTOR
+        if not _tombstones:
+            D, I = _index.search(xq, k * factor)
+        else:
+            # Lấy dư để sau khi bỏ tombstone vẫn đủ k kết quả
+            D, I = _index.search(xq, (k + min(len(_tombstones), TOMBSTONE_OVERFETCH_MAX)) * factor)
+            D, I = _drop_tombstones(D, I, k * factor)
+    if _full_vectors is None:
+        return D, I
+    return vector_index.rescore(xq, D, I, _full_vectors.read, k)
+
+
+def add(ids, vecs):
+    """Thêm vector (train index IVF nếu cần) + ghi delta log"""
+    global _index
+    ids = np.asarray(ids, dtype=np.int64)
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    with _lock.write_locked():
+        _index = vector_index.prepare_for_add(_index, vecs)
+        if _full_vectors is not None:
+            _full_vectors.write(ids, vecs)
+        _index.add_with_ids(vecs, ids)
+        store.append_add(ids, vecs)
+
+
+def remove(ids):
+    """Xóa vector theo ID + ghi delta log (HNSW: chỉ đánh dấu tombstone)"""
+    if len(ids) == 0:
+        return
+    with _lock.write_locked():
+        if vector_index.supports_remove(_index):
+            vector_index.remove_ids(_index, ids)
+        else:
+            before = len(_tombstones)
+            _tombstones.update(int(i) for i in ids)
+            if before <= TOMBSTONE_OVERFETCH_MAX < len(_tombstones):
+                _warn_tombstones(_index)
+        store.append_remove(ids)
+
+
+def compact():
+    """
+    Gộp delta log vào snapshot. Chỉ giữ khóa đọc trong lúc clone index + chốt log,
+    phần ghi file chạy trên bản clone nên add/remove và search không phải chờ
+    (đổi lại tốn thêm RAM bằng 1 bản index trong lúc compact).
+    """
+    with store.compact_lock:
+        with _lock.read_locked():
+            snapshot = faiss.clone_index(_index)
+            sealed = store.seal_log()
+        store.write_snapshot(snapshot, sealed)
+
+
+def stats():
+    """Cho /stats: số vector trong index, tombstone, thay đổi chưa compact"""
+    if _index is None:
+        return {"loaded": False}
+    return {
+        "loaded": True,
+        "type": vector_index.index_type_of(_index),
+        "ntotal": _index.ntotal,
+        "tombstones": len(_tombstones),
+        "pending_ops": store.pending_ops,
+    }
+
+
+def get_index():
+    return _index
+
+
+def start_background_compaction(interval=COMPACT_INTERVAL):
+    """Thread nền: định kỳ compact nếu delta log đủ lớn"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                if _index is not None and store.needs_compaction():
+                    compact()
+            except Exception as e:
+                print(f"❌ Lỗi compact index: {e}")
+
+    thread = threading.Thread(target=loop, name="index-compaction", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,321 @@
+# index_store.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Lưu FAISS index theo kiểu snapshot + delta log (append-only)
+#       faiss.index        : snapshot đầy đủ
+#       faiss.index.delta  : các thay đổi sau snapshot (vector mới + ID bị xóa)
+#   - Mỗi lần ingest chỉ ghi thêm phần thay đổi vào delta log (chi phí theo kích thước bài
+#     viết, không theo kích thước toàn bộ index)
+#   - Khi load: đọc snapshot rồi replay delta log
+#   - Compaction (định kỳ / khi log lớn): chốt log hiện tại thành đoạn faiss.index.delta.<n>
+#     (ghi mới đi vào log mới), ghi snapshot mới ra file tạm, ghi file đánh dấu
+#     faiss.index.compact (điểm commit) rồi mới os.replace snapshot và xóa các đoạn đã gộp.
+#     Crash ở bất kỳ bước nào: load hoàn tất hoặc bỏ lần compact đó, không replay trùng.
+#   - Đối chiếu với docs.db khi load: vector có ID không còn trong DB (crash giữa lúc ghi
+#     log và ghi DB) sẽ bị xóa.
+#   - FullVectorFile (faiss.index.f32): vector float32 gốc trên đĩa cho index nén
+#     (sq8 / pq...), chỉ đọc vài chục dòng mỗi truy vấn để rescore, không nằm trong RAM
+# ------------------------------------------------------------
+
+import os
+import re
+import time
+import zlib
+import struct
+import threading
+
+import faiss
+import numpy as np
+from config_loader import load_config
+import vector_index
+
+config = load_config()
+VDB_CFG = config.get("vector_db", {})
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = os.path.join(BASE_DIR, "..", "faiss.index")
+
+COMPACT_MAX_OPS = VDB_CFG.get("compact_max_ops", 500)
+COMPACT_MAX_MB = VDB_CFG.get("compact_max_mb", 64)
+COMPACT_INTERVAL = VDB_CFG.get("compact_interval_seconds", 300)
+
+OP_ADD = 1
+OP_REMOVE = 2
+
+# Header mỗi bản ghi: op (1 byte), số ID, số chiều, crc32 của phần dữ liệu
+_HEADER = struct.Struct("<BIII")
+
+
+def _fsync_dir(path):
+    """fsync thư mục chứa file để os.replace được ghi xuống đĩa"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # Windows không mở được thư mục
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IndexStore:
+    def __init__(self, index_path=INDEX_FILE):
+        self.index_path = index_path
+        self.log_path = index_path + ".delta"
+        self.tmp_path = index_path + ".tmp"
+        self.marker_path = index_path + ".compact"
+        self._lock = threading.Lock()
+        # Chỉ 1 lần compact tại một thời điểm (thread nền + lúc tắt server)
+        self.compact_lock = threading.Lock()
+        self.pending_ops = 0
+
+    def exists(self):
+        return os.path.exists(self.index_path) or bool(self._log_files())
+
+    def log_size(self):
+        return sum(os.path.getsize(path) for path in self._log_files())
+
+    def _sealed_logs(self):
+        """Các đoạn log đã chốt nhưng chưa gộp vào snapshot, theo thứ tự ghi"""
+        folder = os.path.dirname(os.path.abspath(self.log_path))
+        pattern = re.compile(re.escape(os.path.basename(self.log_path)) + r"\.(\d+)$")
+        found = []
+        for name in os.listdir(folder):
+            m = pattern.match(name)
+            if m:
+                found.append((int(m.group(1)), os.path.join(folder, name)))
+        return [path for _, path in sorted(found)]
+
+    def _log_files(self):
+        files = self._sealed_logs()
+        if os.path.exists(self.log_path):
+            files.append(self.log_path)
+        return files
+
+    # --- ĐỌC ---
+    def _recover(self):
+        """Hoàn tất (đã qua điểm commit) hoặc bỏ (chưa commit) lần compact bị crash giữa chừng"""
+        if os.path.exists(self.marker_path):
+            with open(self.marker_path, encoding="utf-8") as f:
+                merged = [line.strip() for line in f if line.strip()]
+            if os.path.exists(self.tmp_path):
+                os.replace(self.tmp_path, self.index_path)
+                _fsync_dir(self.index_path)
+            folder = os.path.dirname(os.path.abspath(self.log_path))
+            for name in merged:
+                path = os.path.join(folder, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            os.remove(self.marker_path)
+            print(f"♻️ Hoàn tất lần compact bị gián đoạn ({len(merged)} đoạn log).")
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def load(self, dimension=None):
+        """
+        Đọc snapshot + replay delta log. Nếu chưa có snapshot, tạo index rỗng theo
+        config với dimension (hoặc số chiều của bản ghi OP_ADD đầu tiên trong log).
+        Trả về None nếu không có gì để load và không biết dimension.
+        """
+        self._recover()
+        index = None
+        if os.path.exists(self.index_path):
+            index = faiss.read_index(self.index_path)
+        elif dimension is not None:
+            index = vector_index.new_index(dimension)
+
+        ops = 0
+        for path in self._log_files():
+            for op, ids, vecs in self._read_log(path):
+                if index is None:
+                    if op != OP_ADD:
+                        ops += 1
+                        continue  # Xóa trước khi có vector nào: không có gì để xóa
+                    index = vector_index.new_index(vecs.shape[1])
+                if op == OP_ADD:
+                    index = self._replay_add(index, ids, vecs)
+                else:
+                    vector_index.remove_ids(index, ids)
+                ops += 1
+        if index is None:
+            return None
+        self.pending_ops = ops
+        if ops:
+            print(f"📜 Đã replay {ops} thay đổi từ delta log.")
+
+        vector_index.apply_search_params(index)
+        return index
+
+    def _read_log(self, path):
+        """Đọc từng bản ghi hợp lệ. Bản ghi cuối bị ghi dở (crash) sẽ bị cắt bỏ."""
+        with open(path, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            op, n, dim, crc = _HEADER.unpack_from(data, offset)
+            body_len = n * 8 + (n * dim * 4 if op == OP_ADD else 0)
+            body = data[offset + _HEADER.size: offset + _HEADER.size + body_len]
+            if op not in (OP_ADD, OP_REMOVE) or len(body) < body_len or zlib.crc32(body) != crc:
+                break
+            ids = np.frombuffer(body[:n * 8], dtype=np.int64)
+            vecs = np.frombuffer(body[n * 8:], dtype=np.float32).reshape(n, dim) if op == OP_ADD else None
+            yield op, ids, vecs
+            offset += _HEADER.size + body_len
+
+        if offset < len(data):
+            print(f"⚠️ Delta log bị ghi dở ở byte {offset}, cắt bỏ phần hỏng.")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _replay_add(self, index, ids, vecs):
+        # Log chỉ chứa thay đổi sau snapshot (xem write_snapshot) và ID không bao giờ được cấp
+        # lại (db.allocate_ids) nên cứ add thẳng, không lọc theo ID đang có trong index
+        index = vector_index.prepare_for_add(index, vecs)
+        index.add_with_ids(np.ascontiguousarray(vecs), np.ascontiguousarray(ids))
+        return index
+
+    # --- GHI ---
+    def _append(self, op, ids, vecs=None):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        body = ids.tobytes()
+        dim = 0
+        if op == OP_ADD:
+            vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+            dim = vecs.shape[1]
+            body += vecs.tobytes()
+        record = _HEADER.pack(op, len(ids), dim, zlib.crc32(body)) + body
+        with self._lock:
+            with open(self.log_path, "ab") as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending_ops += 1
+
+    def append_add(self, ids, vecs):
+        if len(ids):
+            self._append(OP_ADD, ids, vecs)
+
+    def append_remove(self, ids):
+        if len(ids):
+            self._append(OP_REMOVE, ids)
+
+    def needs_compaction(self):
+        return (self.pending_ops >= COMPACT_MAX_OPS or self.log_size() >= COMPACT_MAX_MB * 1024 * 1024
+                or bool(self._sealed_logs()))
+
+    def seal_log(self):
+        """
+        Chốt log hiện tại thành đoạn .delta.<n> (ghi sau đó đi vào log mới).
+        Người gọi phải đảm bảo không có ghi đồng thời, và snapshot sắp ghi phải chứa đúng
+        mọi thay đổi tới thời điểm này. Trả về danh sách đoạn log mà snapshot đó thay thế.
+        """
+        with self._lock:
+            sealed = self._sealed_logs()
+            if os.path.exists(self.log_path):
+                last = int(sealed[-1].rsplit(".", 1)[1]) if sealed else 0
+                path = f"{self.log_path}.{last + 1}"
+                os.replace(self.log_path, path)
+                _fsync_dir(path)
+                sealed.append(path)
+            self.pending_ops = 0
+            return sealed
+
+    def write_snapshot(self, index, sealed):
+        """
+        Ghi snapshot mới (atomic) thay cho snapshot cũ + các đoạn log sealed.
+        index không được bị sửa trong lúc ghi (thường là bản clone).
+        """
+        start = time.perf_counter()
+        faiss.write_index(index, self.tmp_path)
+        with open(self.tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+
+        # Điểm commit: từ đây snapshot .tmp thay cho snapshot cũ + các đoạn log đã chốt
+        marker_tmp = self.marker_path + ".tmp"
+        with open(marker_tmp, "w", encoding="utf-8") as f:
+            f.write("".join(os.path.basename(path) + "\n" for path in sealed))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(marker_tmp, self.marker_path)
+        _fsync_dir(self.marker_path)
+
+        os.replace(self.tmp_path, self.index_path)
+        _fsync_dir(self.index_path)
+        for path in sealed:
+            os.remove(path)
+        os.remove(self.marker_path)
+        print(f"🗜️ Đã compact FAISS index ({index.ntotal} vector) trong {time.perf_counter() - start:.2f}s")
+
+    def compact(self, index):
+        """
+        Gộp toàn bộ delta log vào snapshot mới.
+        Người gọi phải đảm bảo index không bị sửa trong lúc compact.
+        """
+        with self.compact_lock:
+            self.write_snapshot(index, self.seal_log())
+
+
+class FullVectorFile:
+    """
+    File vector float32 không header: dòng thứ id là vector của id (ID trong docs.db tăng
+    dần nên file gần như liền mạch). ID đã xóa để lại dòng cũ, không bao giờ được đọc tới
+    vì không còn trong index. Dòng chưa ghi (toàn 0) coi như không có vector gốc.
+    """
+
+    def __init__(self, path, dimension):
+        self.path = path
+        self.dimension = dimension
+        self.row_bytes = dimension * 4
+        self._lock = threading.Lock()
+        self._f = open(path, "r+b" if os.path.exists(path) else "w+b")
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def write(self, ids, vecs):
+        ids = np.asarray(ids, dtype=np.int64)
+        vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+        order = np.argsort(ids)
+        with self._lock:
+            # Ghi theo từng đoạn ID liên tiếp (ingest cấp ID liền nhau -> thường chỉ 1 lần ghi)
+            start = 0
+            for end in range(1, len(order) + 1):
+                if end == len(order) or ids[order[end]] != ids[order[end - 1]] + 1:
+                    self._f.seek(int(ids[order[start]]) * self.row_bytes)
+                    self._f.write(vecs[order[start:end]].tobytes())
+                    start = end
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def read(self, ids):
+        """Trả về (vecs, found): found[i] = False nếu id chưa có vector gốc"""
+        vecs = np.zeros((len(ids), self.dimension), dtype=np.float32)
+        with self._lock:
+            for i, id_ in enumerate(np.asarray(ids, dtype=np.int64).tolist()):
+                self._f.seek(id_ * self.row_bytes)
+                buf = self._f.read(self.row_bytes)
+                if len(buf) == self.row_bytes:
+                    vecs[i] = np.frombuffer(buf, dtype=np.float32)
+        return vecs, vecs.any(axis=1)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def reconcile_with_db(index, db_ids):
+    """
+    Xóa vector có ID không còn trong docs.db (crash giữa lúc ghi index và ghi DB).
+    Trả về mảng ID đã xóa (để ghi vào delta log).
+    """
+    if index.ntotal == 0 or not vector_index.supports_remove(index):
+        return np.empty(0, dtype=np.int64)
+    index_ids = faiss.vector_to_array(index.id_map)
+    orphans = np.setdiff1d(index_ids, np.fromiter(db_ids, dtype=np.int64, count=len(db_ids)))
+    if len(orphans):
+        print(f"🧹 Xóa {len(orphans)} vector mồ côi (không có trong docs.db).")
+        index.remove_ids(orphans)
+    return orphans
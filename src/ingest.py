@@ -1,13 +1,25 @@
 import os
+import json
+import time
 import uuid
+import queue
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 import numpy as np
-import faiss
 import requests
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from extractors import auto_extract
+from extractors import auto_extract, pdf_page_count, read_pdf_pages
 from config_loader import load_config
+import vector_index
+import model_registry
+import index_service
 import db  # Import module database mới
 
 # --- CONFIG ---
@@ -18,12 +30,33 @@ INDEX_FILE = os.path.join(BASE_DIR, "..", "faiss.index")
 DATA_DIR = os.path.join(BASE_DIR, "..", "data_output")
 
 # Cấu hình API Wiki
-WIKI_API_URL = "http://localhost/wikicrop/api.php"
+INGEST_CFG = config.get("ingest", {})
+WIKI_API_URL = INGEST_CFG.get("wiki_api_url", "http://localhost/wikicrop/api.php")
+WIKI_SYNC_MODE = INGEST_CFG.get("wiki_sync", "incremental")
+WIKI_RC_MAX_AGE_DAYS = INGEST_CFG.get("wiki_rc_max_age_days", 90)
+WIKI_BATCH_PAGES = 50  # Giới hạn titles / pageids mỗi request của MediaWiki
+WIKI_TIMEOUT = INGEST_CFG.get("wiki_timeout_seconds", 60)
+WIKI_RETRIES = INGEST_CFG.get("wiki_retries", 3)
+WIKI_BACKOFF_SECONDS = INGEST_CFG.get("wiki_backoff_seconds", 1.0)
+# Lượt sync định xóa nhiều hơn tỉ lệ này số trang wiki đã có -> không xóa, chờ --confirm-delete
+WIKI_MAX_DELETE_RATIO = INGEST_CFG.get("wiki_max_delete_ratio", 0.1)
 
 MODEL_NAME = config["model"]["embedding_model"]
-print(f"🔄 Đang tải model: {MODEL_NAME}...")
-embedder = SentenceTransformer(MODEL_NAME)
-dimension = embedder.get_sentence_embedding_dimension()
+EMBEDDING_BACKEND = config["model"].get("embedding_backend", "torch")
+EMBED_BATCH_SIZE = INGEST_CFG.get("embed_batch_size", 64)
+# Số process đọc + chunk file local (0 = số CPU), số chunk mỗi lần ghi FAISS + SQLite
+INGEST_WORKERS = INGEST_CFG.get("workers", 0) or os.cpu_count() or 1
+COMMIT_EVERY_CHUNKS = INGEST_CFG.get("commit_every_chunks", 512)
+# PDF từ chừng này trang trở lên: chia thành khoảng pdf_pages_per_task trang, đọc song song
+PDF_PARALLEL_MIN_PAGES = INGEST_CFG.get("pdf_parallel_min_pages", 64)
+PDF_PAGES_PER_TASK = INGEST_CFG.get("pdf_pages_per_task", 16)
+
+# Model tải lazy, dùng chung với qa qua model_registry (server import cả 2 module -> chỉ tải 1 lần)
+def get_embedder():
+    return model_registry.get_sentence_transformer(MODEL_NAME, backend=EMBEDDING_BACKEND)
+
+def get_dimension():
+    return get_embedder().get_sentence_embedding_dimension()
 
 # --- CHUNKING ---
 text_splitter = RecursiveCharacterTextSplitter(
@@ -32,14 +65,17 @@ text_splitter = RecursiveCharacterTextSplitter(
     separators=["\n\n", "\n", ". ", " ", ""]
 )
 
-# --- LOAD FAISS ---
-if os.path.exists(INDEX_FILE):
-    print("📂 Tải index cũ...")
-    index = faiss.read_index(INDEX_FILE)
-else:
-    print("✨ Tạo index mới...")
-    # Dùng IndexIDMap để quản lý ID thủ công (khớp vói DB)
-    index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+# --- LOAD FAISS (lazy, dùng chung với qa qua index_service) ---
+def ensure_index():
+    if index_service.is_loaded():
+        return
+    if index_service.exists():
+        print("📂 Tải index cũ...")
+        index_service.load()
+    else:
+        print(f"✨ Tạo index mới ({vector_index.INDEX_TYPE})...")
+        # Dùng IndexIDMap để quản lý ID thủ công (khớp vói DB)
+        index_service.load(get_dimension())
 
 # Lấy danh sách nguồn đã xử lý từ DB
 processed_sources = db.get_all_full_paths()
@@ -51,15 +87,15 @@ def remove_from_processed(full_path):
 # ==============================================================================
 # PHẦN 1: XỬ LÝ NỘI DUNG (Chunk -> Embed)
 # ==============================================================================
-def process_content(text, source_name, full_identifier, source_type="file", force_update=False):
-    """Hàm chung để xử lý văn bản -> Chunk -> Embed"""
-    
+def chunk_content(text, source_name, full_identifier, source_type="file", force_update=False):
+    """Chunk văn bản -> danh sách db_entries (chưa có vector, chưa có ID)"""
+
     if not force_update:
         if full_identifier in processed_sources:
-            return [], []
+            return []
 
     if not text or not text.strip():
-        return [], []
+        return []
 
     # 1. Chunking
     if len(text) > 1200:
@@ -67,190 +103,610 @@ def process_content(text, source_name, full_identifier, source_type="file", forc
     else:
         chunks = [text]
 
-    vecs = []
+    return _make_entries(chunks, source_name, full_identifier, source_type)
+
+class PageChunker:
+    """
+    Chunk văn bản đến dần từng trang (PDF lớn) thay vì nối cả file thành 1 chuỗi: bộ đệm
+    đủ STREAM_BUFFER_CHARS thì cắt, giữ lại chunk cuối (có thể chưa trọn) ghép với trang sau.
+    """
+
+    STREAM_BUFFER_CHARS = 32000
+
+    def __init__(self, source_name, full_identifier, source_type="file"):
+        self.source_name = source_name
+        self.full_identifier = full_identifier
+        self.source_type = source_type
+        self._chunks = []
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        if len(self._buffer) >= self.STREAM_BUFFER_CHARS:
+            parts = text_splitter.split_text(self._buffer)
+            self._chunks.extend(parts[:-1])
+            self._buffer = parts[-1] if parts else ""
+
+    def close(self):
+        """Trả về db_entries như chunk_content"""
+        if self._buffer.strip():
+            if self._chunks or len(self._buffer) > 1200:
+                self._chunks.extend(text_splitter.split_text(self._buffer))
+            else:
+                self._chunks.append(self._buffer)
+        self._buffer = ""
+        return _make_entries(self._chunks, self.source_name, self.full_identifier, self.source_type)
+
+def _make_entries(chunks, source_name, full_identifier, source_type):
     # Thay vì lưu meta dict hoàn chỉnh, ta lưu dữ liệu raw để insert DB
     db_entries = []
-
-    # 2. Embedding từng chunk
     for i, chunk_text in enumerate(chunks):
-        doc_uuid = str(uuid.uuid4())
-        
         display_source = source_name
         if len(chunks) > 1:
             display_source += f" (Đoạn {i+1})"
 
-        embed_input = f"passage: {chunk_text}" 
-        vec = embedder.encode(embed_input, normalize_embeddings=True)
-
-        entry = {
-            "doc_uuid": doc_uuid,
+        db_entries.append({
+            "doc_uuid": str(uuid.uuid4()),
             "source": display_source,
             "rep_type": "wiki_content" if source_type == "wiki" else "file_content",
             "text": chunk_text,
-            "full_path": full_identifier
-        }
-        
-        vecs.append(vec)
-        db_entries.append(entry)
+            "full_path": full_identifier,
+            "content_hash": chunk_hash(chunk_text)
+        })
+
+    return db_entries
+
+def chunk_hash(text):
+    """Hash nội dung chunk (chỉ phụ thuộc text, là thứ duy nhất được embed)"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def apply_chunk_diff(db_entries, full_identifier):
+    """
+    So chunk mới của bài viết với chunk đang có trong DB theo content hash:
+    - chunk trùng hash: giữ nguyên ID + vector (chỉ sửa source nếu số thứ tự đoạn đổi)
+    - chunk cũ không còn: xóa khỏi DB + index (HNSW: vector cũ thành tombstone, bị lọc khi search);
+      chunk mới được cấp ID mới (db.allocate_ids), không dùng lại ID đã xóa
+    Trả về (các chunk mới cần embed + save_batch, số chunk giữ lại, số chunk đã xóa).
+    """
+    old_by_hash = {}
+    for row in db.get_chunks_by_path(full_identifier):
+        old_by_hash.setdefault(row["content_hash"] or chunk_hash(row["text"]), []).append(row)
+
+    to_add, renamed, reused = [], [], 0
+    for entry in db_entries:
+        rows = old_by_hash.get(entry["content_hash"])
+        if rows:
+            row = rows.pop(0)
+            reused += 1
+            if row["source"] != entry["source"]:
+                renamed.append((row["id"], entry["source"]))
+        else:
+            to_add.append(entry)
+
+    stale_ids = [row["id"] for rows in old_by_hash.values() for row in rows]
+    if stale_ids:
+        ensure_index()  # Load trước khi xóa trong DB (không thì vector bị coi là mồ côi lúc load)
+        db.delete_documents_by_ids(stale_ids)
+        remove_vectors(stale_ids)
+    db.update_sources(renamed)
+    if not db_entries:
+        remove_from_processed(full_identifier)
+    return to_add, reused, len(stale_ids)
+
+def update_content(text, source_name, full_identifier, source_type="file"):
+    """
+    Cập nhật 1 bài viết đã có (vd. /ingest khi bài viết được sửa): chỉ embed chunk mới.
+    Trả về (tổng số chunk, số chunk phải embed, số chunk giữ lại, số chunk đã xóa).
+    """
+    db_entries = chunk_content(text, source_name, full_identifier, source_type, force_update=True)
+    to_add, reused, removed = apply_chunk_diff(db_entries, full_identifier)
+    if to_add:
+        save_batch(embed_entries(to_add), to_add)
+    return len(db_entries), len(to_add), reused, removed
 
-    return vecs, db_entries
+def embed_entries(db_entries, batch_size=EMBED_BATCH_SIZE, show_progress=False):
+    """
+    Embed các chunk (có thể từ nhiều trang/file) theo lô lớn.
+    Sắp xếp theo độ dài để các chunk trong cùng lô dài gần bằng nhau (ít padding),
+    rồi ghi vector về đúng vị trí -> vecs[i] ứng với db_entries[i].
+    """
+    vecs = np.empty((len(db_entries), get_dimension()), dtype="float32")
+    if not db_entries:
+        return vecs
+
+    order = sorted(range(len(db_entries)), key=lambda i: len(db_entries[i]["text"]), reverse=True)
+    batches = range(0, len(order), batch_size)
+    if show_progress:
+        batches = tqdm(batches, desc="Embedding", unit="batch")
+
+    for start in batches:
+        idx = order[start:start + batch_size]
+        embed_inputs = [f"passage: {db_entries[i]['text']}" for i in idx]
+        vecs[idx] = get_embedder().encode(
+            embed_inputs,
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        )
+
+    return vecs
 
 # ==============================================================================
-# PHẦN 2: HÚT DỮ LIỆU TỪ MEDIAWIKI API
+# PHẦN 2: ĐỒNG BỘ DỮ LIỆU TỪ MEDIAWIKI API
+# - Lưu revid đã ingest của từng trang trong docs.db (bảng wiki_pages)
+# - incremental: chỉ hỏi recentchanges từ lần sync trước (sửa, tạo mới, xóa, đổi tên)
+# - full: duyệt revid hiện tại của TẤT CẢ trang (prop=info, không tải nội dung) theo từng lô
+#   500 trang; token continue lưu trong docs.db sau mỗi lô -> bị ngắt thì lần sau chạy tiếp
+# - Chỉ tải nội dung + embed lại trang có revid khác, xóa chunk của trang đã bị xóa
+# - Thread chính chỉ gọi API; chunk + embed + ghi chạy ở thread ghi (song song với mạng)
 # ==============================================================================
-def fetch_all_wiki_pages():
-    """Lấy TOÀN BỘ bài viết từ Wiki"""
-    print(f"🌐 Đang kết nối tới Wiki: {WIKI_API_URL}")
-    
-    session = requests.Session()
-    base_params = {
-        "action": "query",
-        "generator": "allpages",
-        "gaplimit": "max",
-        "prop": "revisions",
-        "rvprop": "content",
-        "rvslots": "main",
-        "format": "json"
-    }
-
-    results = []
-    last_continue = {}
-    page_count = 0
-
-    while True:
-        params = {**base_params, **last_continue}
+def wiki_request(session, params):
+    """
+    Gọi API MediaWiki (JSON). Lỗi mạng / HTTP / JSON hỏng: thử lại tối đa WIKI_RETRIES lần,
+    chờ tăng dần (backoff). Lỗi API -> RuntimeError (không thử lại).
+    """
+    for attempt in range(WIKI_RETRIES + 1):
         try:
-            resp = session.get(WIKI_API_URL, params=params)
+            resp = session.get(WIKI_API_URL, params={**params, "action": "query", "format": "json"}, timeout=WIKI_TIMEOUT)
+            resp.raise_for_status()
             data = resp.json()
-            
-            if "error" in data:
-                print(f"❌ API Error: {data['error']}")
-                break
+            break
+        except (requests.RequestException, ValueError) as e:
+            if attempt == WIKI_RETRIES:
+                raise
+            delay = WIKI_BACKOFF_SECONDS * 2 ** attempt
+            print(f"⚠️ Lỗi gọi Wiki API ({e}), thử lại sau {delay:.1f}s...")
+            time.sleep(delay)
+    if "error" in data:
+        raise RuntimeError(f"API Error: {data['error']}")
+    return data
+
+def _wiki_query_all(session, params, start_continue=None):
+    """Duyệt hết các trang kết quả (theo continue), trả về từng response"""
+    last_continue = start_continue or {}
+    while True:
+        data = wiki_request(session, {**params, **last_continue})
+        yield data
+        if "continue" not in data:
+            break
+        last_continue = data["continue"]
 
-            pages = data.get("query", {}).get("pages", {})
-            for page_id, page_data in pages.items():
-                title = page_data.get("title", "")
-                ns = page_data.get("ns", 0)
-                if ns != 0: continue
-
-                content = ""
-                try:
-                    revisions = page_data.get("revisions", [])
-                    if revisions:
-                        content = revisions[0]["slots"]["main"]["*"]
-                except KeyError:
-                    pass
-
-                if content:
-                    fake_url = f"wiki://{title}"
-                    results.append((title, content, fake_url))
-                    page_count += 1
-            
-            print(f"   ... Đã quét được {page_count} bài viết...")
-
-            if 'continue' in data:
-                last_continue = data['continue']
-            else:
-                break
+def _wiki_path(title):
+    return f"wiki://{title}"
 
-        except Exception as e:
-            print(f"❌ Lỗi khi quét Wiki: {e}")
-            break
-            
-    print(f"✅ Đã tải xong TẤT CẢ {len(results)} bài viết từ Wiki.")
-    return results
+def _parse_wiki_time(ts):
+    return datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
 
-def ingest_wiki():
-    print("\n--- 🌍 BẮT ĐẦU QUÉT WIKI ONLINE ---")
-    pages = fetch_all_wiki_pages()
-    
-    if not pages:
-        print("⚠️ Không tìm thấy bài viết nào trên Wiki hoặc lỗi kết nối.")
+def iter_all_page_revisions(session, start_continue=None):
+    """
+    Duyệt mọi bài viết (namespace 0), không tải nội dung. Mỗi lô trả về
+    ({title: (pageid, lastrevid)}, token continue của lô kế tiếp hoặc None nếu là lô cuối).
+    """
+    params = {"generator": "allpages", "gapnamespace": 0, "gaplimit": "max", "prop": "info"}
+    for data in _wiki_query_all(session, params, start_continue):
+        pages = data.get("query", {}).get("pages", {}).values()
+        yield {p["title"]: (p["pageid"], p["lastrevid"]) for p in pages}, data.get("continue")
+
+def fetch_page_revisions(session, titles):
+    """{title: (pageid, lastrevid)} của các tiêu đề còn tồn tại (namespace 0)"""
+    current = {}
+    titles = sorted(titles)
+    for i in range(0, len(titles), WIKI_BATCH_PAGES):
+        data = wiki_request(session, {"titles": "|".join(titles[i:i + WIKI_BATCH_PAGES]), "prop": "info"})
+        for page in data.get("query", {}).get("pages", {}).values():
+            if "missing" not in page and page.get("ns") == 0:
+                current[page["title"]] = (page["pageid"], page["lastrevid"])
+    return current
+
+def fetch_recent_titles(session, since):
+    """Tiêu đề có thay đổi từ mốc since: sửa, tạo mới, và log (xóa, khôi phục, đổi tên -> cả tên mới)"""
+    titles = set()
+    params = {"list": "recentchanges", "rcdir": "newer", "rcstart": since, "rclimit": "max",
+              "rctype": "edit|new|log", "rcprop": "title|ids|timestamp|loginfo"}
+    for data in _wiki_query_all(session, params):
+        for rc in data.get("query", {}).get("recentchanges", []):
+            if rc.get("ns") == 0:
+                titles.add(rc["title"])
+            target = rc.get("logparams", {})
+            if target.get("target_ns") == 0 and target.get("target_title"):
+                titles.add(target["target_title"])
+    return titles
+
+def fetch_wiki_contents(session, pageids):
+    """Nội dung bản mới nhất: từng (title, content, pageid, revid, timestamp), mỗi request WIKI_BATCH_PAGES trang"""
+    for i in range(0, len(pageids), WIKI_BATCH_PAGES):
+        data = wiki_request(session, {
+            "pageids": "|".join(str(p) for p in pageids[i:i + WIKI_BATCH_PAGES]),
+            "prop": "revisions",
+            "rvprop": "ids|timestamp|content",
+            "rvslots": "main",
+        })
+        for page in data.get("query", {}).get("pages", {}).values():
+            revisions = page.get("revisions", [])
+            if "missing" in page or not revisions:
+                continue
+            rev = revisions[0]
+            content = rev.get("slots", {}).get("main", {}).get("*", "")
+            yield page["title"], content, page["pageid"], rev["revid"], rev["timestamp"]
+
+def _delete_wiki_pages(full_paths):
+    """Xóa chunk + vector + revid của các trang không còn trên wiki. Trả về số chunk đã xóa."""
+    ensure_index()  # Load trước khi xóa trong DB (không thì vector bị coi là mồ côi lúc load)
+    removed = 0
+    for full_path in full_paths:
+        deleted_ids = db.delete_documents_by_path(full_path)
+        remove_from_processed(full_path)
+        if deleted_ids:
+            remove_vectors(deleted_ids)
+        removed += len(deleted_ids)
+    db.delete_wiki_revisions(full_paths)
+    return removed
+
+def _save_wiki_batch(pages, progress, crawl=None, seen=()):
+    """
+    Chạy trong thread ghi, 1 lô trang: chunk -> giữ chunk không đổi (content hash) -> embed +
+    lưu chunk mới -> ghi revid -> ghi checkpoint (crawl). Bị ngắt giữa chừng thì lô này chưa
+    có revid / checkpoint mới, lần sau làm lại.
+    seen: các trang không đổi của lô (chỉ đánh dấu đã thấy trong lượt full crawl này)
+    """
+    new_db_entries, revisions = [], []
+    for title, content, pageid, revid, ts in pages:
+        url = _wiki_path(title)
+        entries = chunk_content(content, f"Wiki: {title}", url, source_type="wiki", force_update=True)
+        new_db_entries.extend(apply_chunk_diff(entries, url)[0])
+        revisions.append((url, pageid, revid, ts))
+    if new_db_entries:
+        save_batch(embed_entries(new_db_entries), new_db_entries)
+
+    crawl_id = crawl["started"] if crawl else None
+    db.set_wiki_revisions(revisions, seen=crawl_id)
+    if crawl:
+        db.mark_wiki_seen(seen, crawl_id)
+        db.set_sync_state("wiki_crawl", json.dumps(crawl))
+    progress["pages"] += len(pages)
+    progress["chunks"] += len(new_db_entries)
+
+def _crawl_full(session, known, sync_time, write_queue, dry_run=False):
+    """
+    Lượt full crawl (tiếp tục từ checkpoint nếu lượt trước bị ngắt): đưa từng lô trang đã
+    đổi vào thread ghi. Trả về (crawl_id = mốc bắt đầu lượt crawl, các trang thấy trong lần chạy này).
+    dry_run: luôn crawl lại từ đầu, lô đưa vào thread ghi chỉ là pageid (không tải nội dung).
+    """
+    checkpoint = None if dry_run else db.get_sync_state("wiki_crawl")
+    if checkpoint:
+        crawl = json.loads(checkpoint)
+        print(f"↪️ Tiếp tục lượt full crawl bắt đầu lúc {crawl['started']} từ {crawl['continue']}")
+    else:
+        crawl = {"started": sync_time, "continue": None}
+
+    scanned, listed = 0, set()
+    for current, next_continue in iter_all_page_revisions(session, crawl["continue"]):
+        changed = sorted(pid for t, (pid, revid) in current.items() if known.get(_wiki_path(t)) != revid)
+        seen = [_wiki_path(t) for t, (pid, revid) in current.items() if known.get(_wiki_path(t)) == revid]
+        listed.update(map(_wiki_path, current))
+        crawl = {"started": crawl["started"], "continue": next_continue}
+        pages = changed if dry_run else list(fetch_wiki_contents(session, changed))
+        write_queue.put((pages, crawl, seen))
+        scanned += len(current)
+        print(f"   ... Đã quét được {scanned} bài viết ({len(changed)} trang đổi trong lô này)...")
+    return crawl["started"], listed
+
+def _count_wiki_batch(pages, progress, crawl=None, seen=()):
+    """Thread ghi của dry run: chỉ đếm, không ghi gì"""
+    progress["pages"] += len(pages)
+
+def _confirm_wiki_delete(deleted, wiki_paths, confirm_delete):
+    """
+    Chặn xóa hàng loạt (vd. wiki_api_url trỏ nhầm wiki, wiki trả về danh sách rỗng): xóa nhiều
+    hơn WIKI_MAX_DELETE_RATIO số trang wiki đã có thì chỉ báo, trừ khi có --confirm-delete.
+    """
+    ratio = len(deleted) / max(1, len(wiki_paths))
+    print(f"🗑️ {len(deleted)} trang không còn trên Wiki ({ratio:.0%} trong {len(wiki_paths)} trang đã có), "
+          f"vd: {', '.join(deleted[:5])}")
+    if ratio <= WIKI_MAX_DELETE_RATIO or confirm_delete:
+        return True
+    print(f"⛔ Vượt ngưỡng wiki_max_delete_ratio = {WIKI_MAX_DELETE_RATIO:.0%}: KHÔNG xóa. Kiểm tra wiki_api_url, "
+          f"chạy thử với --dry-run rồi chạy lại với --wiki-sync full --confirm-delete nếu đúng là cần xóa.")
+    return False
+
+def sync_wiki(mode=None, dry_run=False, confirm_delete=False):
+    """
+    Đồng bộ wiki -> docs.db + FAISS: chỉ tải, embed trang đã đổi và xóa trang đã bị xóa.
+    dry_run: chỉ báo số trang sẽ cập nhật / xóa, không ghi gì vào docs.db / index.
+    confirm_delete: cho phép xóa quá wiki_max_delete_ratio số trang.
+    Trang chỉ bị coi là đã xóa sau khi lượt full crawl đi hết toàn bộ wiki (hoặc theo recentchanges).
+    """
+    mode = mode or WIKI_SYNC_MODE
+    print(f"\n--- 🌍 ĐỒNG BỘ WIKI ({mode}{', dry run' if dry_run else ''}): {WIKI_API_URL} ---")
+    session = requests.Session()
+    known = db.get_wiki_revisions()
+    # Trang wiki đã có trong DB trước lượt sync (kể cả trang ingest trước khi có bảng wiki_pages)
+    existing = set(known) | {p for p in processed_sources if p.startswith("wiki://")}
+    progress = {"pages": 0, "chunks": 0}
+    deleted = []
+
+    write_queue, errors = queue.Queue(maxsize=2), []
+    save = _count_wiki_batch if dry_run else _save_wiki_batch
+    writer = _start_writer(write_queue, errors, lambda pages, crawl=None, seen=(): save(pages, progress, crawl, seen))
+    try:
+        sync_time = wiki_request(session, {"curtimestamp": 1})["curtimestamp"]
+        last_sync = db.get_sync_state("wiki_last_sync")
+        incremental = mode == "incremental" and last_sync is not None and \
+            db.get_sync_state("wiki_crawl") is None and \
+            _parse_wiki_time(sync_time) - _parse_wiki_time(last_sync) < timedelta(days=WIKI_RC_MAX_AGE_DAYS)
+
+        if incremental:
+            titles = fetch_recent_titles(session, last_sync)
+            print(f"🔎 Recentchanges từ {last_sync}: {len(titles)} trang có thay đổi")
+            current = fetch_page_revisions(session, titles)
+            # Trang nằm trong recentchanges nhưng không còn tồn tại -> đã bị xóa / đổi tên
+            alive = {_wiki_path(t) for t in current}
+            deleted = sorted(p for p in map(_wiki_path, titles) if p not in alive and (p in known or p in processed_sources))
+            changed = sorted(pid for t, (pid, revid) in current.items() if known.get(_wiki_path(t)) != revid)
+            for i in range(0, len(changed), WIKI_BATCH_PAGES):
+                batch = changed[i:i + WIKI_BATCH_PAGES]
+                write_queue.put((batch if dry_run else list(fetch_wiki_contents(session, batch)),))
+        else:
+            if mode == "incremental":
+                print("🔎 Chưa có mốc sync gần đây -> so sánh revid toàn bộ wiki")
+            sync_time, listed = _crawl_full(session, known, sync_time, write_queue, dry_run)
+    except Exception as e:
+        print(f"❌ Lỗi khi quét Wiki: {e} (các lô đã ghi được giữ lại, lần sau chạy tiếp)")
         return
-    
-    new_vectors = []
-    new_db_entries = []
-
-    for title, content, url in tqdm(pages, desc="Processing Wiki", unit="page"):
-        v, m = process_content(content, f"Wiki: {title}", url, source_type="wiki")
-        if v:
-            new_vectors.extend(v)
-            new_db_entries.extend(m)
-
-    if new_vectors:
-        save_batch(new_vectors, new_db_entries)
-        print(f"🎉 Đã thêm {len(new_db_entries)} đoạn văn từ Wiki vào bộ nhớ.")
+    finally:
+        write_queue.put(None)
+        writer.join()
+
+    if errors:
+        print(f"❌ Lỗi khi ghi dữ liệu Wiki: {errors[0]}")
+        return
+    if not incremental:
+        # Lượt full crawl đã đi hết wiki: trang đã có mà lượt crawl không thấy
+        if dry_run:
+            deleted = sorted(existing - listed)
+        else:
+            revisions = db.get_wiki_revisions()
+            deleted = sorted(set(db.get_wiki_unseen(sync_time)) |
+                             {p for p in processed_sources if p.startswith("wiki://") and p not in revisions})
+
+    if dry_run:
+        print(f"🧪 Dry run: sẽ cập nhật {progress['pages']} trang, xóa {len(deleted)} trang "
+              f"(trong {len(existing)} trang wiki đã có).")
+        for path in deleted[:20]:
+            print(f"   - {path}")
+        return
+
+    if deleted and _confirm_wiki_delete(deleted, existing, confirm_delete):
+        removed_chunks = _delete_wiki_pages(deleted)
+        print(f"🗑️ Đã xóa {len(deleted)} trang ({removed_chunks} chunk) không còn trên Wiki.")
+    else:
+        deleted = []
+
+    db.set_sync_state("wiki_last_sync", sync_time)
+    db.set_sync_state("wiki_crawl", None)
+    if progress["pages"] or deleted:
+        print(f"🎉 Wiki: cập nhật {progress['pages']} trang ({progress['chunks']} đoạn văn mới), xóa {len(deleted)} trang.")
     else:
-        print("⏩ Không có dữ liệu mới từ Wiki để cập nhật.")
+        print("⏩ Không có thay đổi nào trên Wiki.")
+
+def ingest_wiki():
+    sync_wiki()
 
 # ==============================================================================
 # PHẦN 3: HÚT DỮ LIỆU TỪ FILE LOCAL
 # ==============================================================================
-def ingest_local_files(root_folder=DATA_DIR):
-    print(f"\n--- 📂 BẮT ĐẦU QUÉT FILE LOCAL ({root_folder}) ---")
-    docx_files = []
+# Pipeline 3 tầng, RAM không tăng theo số file:
+#   1. Process pool: đọc + chunk file (giữ tối đa 2 * workers file đang xử lý / chờ)
+#   2. Thread chính: gom chunk đủ commit_every_chunks thì embed theo lô
+#   3. Thread ghi: save_batch (FAISS + SQLite) từng nhóm, song song với tầng 1-2
+# Mỗi nhóm chỉ gồm file trọn vẹn -> file có trong docs.db là file đã xong: chạy lại sau khi
+# crash sẽ bỏ qua các file đó (checkpoint) và tiếp tục từ file đầu tiên chưa ghi.
+# PDF lớn: các khoảng trang được đọc song song rồi chunk dần theo thứ tự trang (PageChunker).
+LOCAL_FILE_TYPES = (".docx", ".txt", ".pdf")
+
+def find_local_files(root_folder=DATA_DIR):
+    paths = []
     for dirpath, _, filenames in os.walk(root_folder):
         for f in filenames:
-            if f.lower().endswith(".docx") and not f.startswith("~$"):
-                docx_files.append(os.path.join(dirpath, f))
+            if f.lower().endswith(LOCAL_FILE_TYPES) and not f.startswith("~$"):
+                paths.append(os.path.join(dirpath, f))
+    return sorted(paths)
+
+def _extract_file(path):
+    """Chạy trong process con: đọc + chunk 1 file. Trả về (path, db_entries, lỗi)"""
+    try:
+        raw_text = auto_extract(path)
+        return path, chunk_content(raw_text, os.path.basename(path), path, source_type="file", force_update=True), None
+    except Exception as e:
+        return path, [], str(e)
+
+def _file_tasks(paths):
+    """Việc cho process pool: (path, start, end, là khoảng cuối). start = None: cả file."""
+    for path in paths:
+        pages = 0
+        if path.lower().endswith(".pdf"):
+            try:
+                pages = pdf_page_count(path)
+            except Exception:
+                pass  # Để _extract_file báo lỗi
+        if pages < PDF_PARALLEL_MIN_PAGES:
+            yield path, None, None, True
+            continue
+        for start in range(0, pages, PDF_PAGES_PER_TASK):
+            yield path, start, min(start + PDF_PAGES_PER_TASK, pages), start + PDF_PAGES_PER_TASK >= pages
+
+def _run_task(path, start, end):
+    """Chạy trong process con: cả file -> (path, db_entries, lỗi), khoảng trang PDF -> (path, [text từng trang], lỗi)"""
+    if start is None:
+        return _extract_file(path)
+    try:
+        return path, read_pdf_pages(path, start, end), None
+    except Exception as e:
+        return path, [], str(e)
+
+def _iter_task_results(tasks, workers):
+    """Chạy các việc (song song nếu workers > 1), trả (việc, kết quả) đúng thứ tự, tối đa 2 * workers việc chờ"""
+    if workers <= 1:
+        for task in tasks:
+            yield task, _run_task(*task[:3])
+        return
+    # spawn: process con không thừa kế thread (writer, torch) của process cha
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        tasks = iter(tasks)
+        pending = deque((t, pool.submit(_run_task, *t[:3])) for t in islice(tasks, workers * 2))
+        while pending:
+            task, future = pending.popleft()
+            for t in islice(tasks, 1):
+                pending.append((t, pool.submit(_run_task, *t[:3])))
+            yield task, future.result()
+
+def iter_chunked_files(paths, workers=INGEST_WORKERS):
+    """Đọc + chunk song song, trả (path, db_entries, lỗi) theo đúng thứ tự paths"""
+    chunker, pdf_error = None, None
+    for (path, start, _, last), (_, result, error) in _iter_task_results(_file_tasks(paths), workers):
+        if start is None:
+            yield path, result, error
+            continue
+        # Khoảng trang của PDF lớn: chunk dần, lỗi ở bất kỳ khoảng nào -> bỏ cả file
+        if chunker is None:
+            chunker, pdf_error = PageChunker(os.path.basename(path), path, source_type="file"), None
+        pdf_error = pdf_error or error
+        if not pdf_error:
+            for page in result:
+                chunker.feed(page)
+        if last:
+            yield path, ([] if pdf_error else chunker.close()), pdf_error
+            chunker = None
+
+def _start_writer(write_queue, errors, handle=None):
+    """Thread ghi: lấy tham số từ queue, gọi handle (mặc định save_batch) lần lượt. None = dừng."""
+    handle = handle or save_batch
+
+    def loop():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            if errors:
+                continue  # Đã lỗi: chỉ rút hết queue để thread chính không bị chặn
+            try:
+                handle(*item)
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=loop, name="ingest-writer", daemon=True)
+    thread.start()
+    return thread
+
+def ingest_local_files(root_folder=DATA_DIR, workers=INGEST_WORKERS, commit_every=COMMIT_EVERY_CHUNKS):
+    print(f"\n--- 📂 BẮT ĐẦU QUÉT FILE LOCAL ({root_folder}) ---")
+    paths = find_local_files(root_folder)
+    todo = [p for p in paths if p not in processed_sources]
+    if len(todo) < len(paths):
+        print(f"⏩ Bỏ qua {len(paths) - len(todo)} file đã có trong docs.db")
+    if not todo:
+        return
 
-    new_vectors = []
-    new_db_entries = []
-    
-    for path in tqdm(docx_files, desc="Processing Files", unit="file"):
-        try:
-            raw_text = auto_extract(path)
-            v, m = process_content(raw_text, os.path.basename(path), path, source_type="file")
-            if v:
-                new_vectors.extend(v)
-                new_db_entries.extend(m)
-        except Exception as e:
-            print(f"Lỗi file {path}: {e}")
-
-    if new_vectors:
-        save_batch(new_vectors, new_db_entries)
-        print(f"🎉 Đã thêm {len(new_db_entries)} đoạn văn từ File vào bộ nhớ.")
+    # maxsize=2: embed tối đa 2 nhóm trước thread ghi
+    write_queue, errors = queue.Queue(maxsize=2), []
+    writer = _start_writer(write_queue, errors)
+    buffer, total = [], 0
+    try:
+        for path, entries, error in tqdm(iter_chunked_files(todo, workers), total=len(todo), desc="Processing Files", unit="file"):
+            if error:
+                print(f"Lỗi file {path}: {error}")
+            buffer.extend(entries)
+            if len(buffer) >= commit_every:
+                write_queue.put((embed_entries(buffer), buffer))
+                total += len(buffer)
+                buffer = []
+            if errors:
+                break
+        if buffer and not errors:
+            write_queue.put((embed_entries(buffer), buffer))
+            total += len(buffer)
+    finally:
+        write_queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    if total:
+        print(f"🎉 Đã thêm {total} đoạn văn từ File vào bộ nhớ.")
 
 # --- Helper lưu đĩa ---
 def save_batch(vectors, db_entries):
     """
-    vectors: list of numpy arrays
+    vectors: list of numpy arrays (hoặc ma trận N x dim)
     db_entries: list of dicts (chưa có ID)
     """
-    if not vectors: return
+    if len(vectors) == 0: return
     
-    # Lấy ID bắt đầu hiện tại từ DB (để khớp với FAISS index)
-    start_id = db.get_doc_count()
+    # Cấp ID mới từ bộ đếm chỉ tăng trong DB (ID trong FAISS index khớp cột id của docs.db)
+    start_id = db.allocate_ids(len(db_entries))
     
-    # Gán ID cho các entry mới
+    vecs_np = np.vstack(vectors).astype("float32")
+
+    # Gán ID cho các entry mới, kèm embedding (lưu trong DB để dựng lại index không cần embed lại)
     final_db_entries = []
     for i, entry in enumerate(db_entries):
         entry['id'] = start_id + i
+        entry['embedding'] = vecs_np[i]
+        entry['embedding_model'] = MODEL_NAME
         final_db_entries.append(entry)
         # update tracking set
         processed_sources.add(entry['full_path'])
 
-    # 1. Thêm vào FAISS (với ID cụ thể)
-    vecs_np = np.vstack(vectors).astype("float32")
+    # 1. Thêm vào FAISS (với ID cụ thể) + ghi thêm vào delta log (không ghi lại cả index)
+    # Index dùng chung với qa nên chunk mới tìm thấy được ngay
     ids_np = np.array([e['id'] for e in final_db_entries], dtype=np.int64)
-    index.add_with_ids(vecs_np, ids_np)
-    
-    faiss.write_index(index, INDEX_FILE)
+    ensure_index()
+    index_service.add(ids_np, vecs_np)
 
     # 2. Thêm vào SQLite
     db.add_documents_batch(final_db_entries)
 
+def remove_vectors(ids):
+    """Xóa vector khỏi index (dùng khi cập nhật bài viết, sau khi đã xóa trong DB)"""
+    ensure_index()
+    index_service.remove(ids)
+
+def compact_index():
+    """Gộp delta log vào snapshot faiss.index"""
+    if index_service.is_loaded():
+        index_service.compact()
+
 # ==============================================================================
 # MAIN
 # ==============================================================================
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Học dữ liệu từ file local và Wiki")
+    parser.add_argument("--wiki-sync", choices=["incremental", "full"], default=WIKI_SYNC_MODE,
+                        help="incremental: theo recentchanges | full: so sánh revid mọi trang")
+    parser.add_argument("--wiki-url", default=WIKI_API_URL, help="URL api.php của MediaWiki")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Wiki: chỉ báo số trang sẽ cập nhật / xóa, không ghi gì")
+    parser.add_argument("--confirm-delete", action="store_true",
+                        help="Wiki: cho phép xóa nhiều hơn wiki_max_delete_ratio số trang đã có")
+    parser.add_argument("--skip-files", action="store_true", help="Bỏ qua quét file local")
+    parser.add_argument("--skip-wiki", action="store_true", help="Bỏ qua đồng bộ Wiki")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Thư mục file local")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Số process đọc + chunk file local")
+    args = parser.parse_args()
+    WIKI_API_URL = args.wiki_url
+
     # Đảm bảo DB được khởi tạo
     db.init_db()
     
-    # 1. Quét file docx
-    ingest_local_files()
+    # 1. Quét file local (.docx, .txt, .pdf)
+    if not args.skip_files:
+        ingest_local_files(args.data_dir, args.workers)
     
-    # 2. Quét bài viết trên Wiki
-    ingest_wiki()
+    # 2. Đồng bộ bài viết trên Wiki (chỉ trang thay đổi)
+    if not args.skip_wiki:
+        sync_wiki(args.wiki_sync, args.dry_run, args.confirm_delete)
+
+    # 3. Ghi snapshot index (gộp delta log)
+    compact_index()
     
-    print("\n✅ HOÀN TẤT TOÀN BỘ QUÁ TRÌNH HỌC DỮ LIỆU!")
\ No newline at end of file
+    print("\n✅ HOÀN TẤT TOÀN BỘ QUÁ TRÌNH HỌC DỮ LIỆU!")
@@ -0,0 +1,243 @@
+# llm_client.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Client Ollama dùng chung cho qa.py (trả lời) và utils.py (tóm tắt)
+#   - Giữ kết nối (connection pool, keep-alive HTTP) thay vì mở TCP mới mỗi lần gọi
+#   - Gửi "keep_alive" để Ollama giữ model trong RAM giữa các request
+#   - Retry có giới hạn (lỗi kết nối, 502/503/504) với backoff
+#   - Đo latency từng lời gọi (xem stats())
+# ------------------------------------------------------------
+
+import time
+import json
+import asyncio
+import threading
+from collections import deque
+
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config_loader import load_config
+
+config = load_config()
+LLM_CFG = config.get("llm", {})
+
+BASE_URL = LLM_CFG.get("base_url", "http://localhost:11434").rstrip("/")
+CONNECT_TIMEOUT = LLM_CFG.get("connect_timeout", 5)
+READ_TIMEOUT = LLM_CFG.get("read_timeout", 60)
+KEEP_ALIVE = LLM_CFG.get("keep_alive", "30m")
+MAX_RETRIES = LLM_CFG.get("max_retries", 2)
+RETRY_BACKOFF = LLM_CFG.get("retry_backoff", 0.5)
+POOL_SIZE = LLM_CFG.get("pool_size", 10)
+
+RETRY_STATUS = (502, 503, 504)
+
+
+class LatencyStats:
+    """Thống kê latency các lời gọi LLM (thread-safe)"""
+
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.total_seconds += seconds
+            self._recent.append(seconds)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            calls, errors, retries, total = self.calls, self.errors, self.retries, self.total_seconds
+
+        def pct(p):
+            if not recent:
+                return None
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 3)
+
+        return {
+            "calls": calls,
+            "errors": errors,
+            "retries": retries,
+            "avg_seconds": round(total / calls, 3) if calls else None,
+            "p50_seconds": pct(0.50),
+            "p95_seconds": pct(0.95),
+            "max_seconds": round(recent[-1], 3) if recent else None,
+        }
+
+
+class OllamaClient:
+    def __init__(self, base_url=BASE_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 keep_alive=KEEP_ALIVE, max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF,
+                 pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.generate_url = f"{self.base_url}/api/generate"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.pool_size = pool_size
+        self.metrics = LatencyStats()
+
+        # Client đồng bộ: requests.Session + pool + retry của urllib3
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,  # Không retry khi đã gửi xong mà chờ quá lâu (tránh nhân đôi 60s)
+            status=max_retries,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=None,  # Cho phép retry cả POST
+            backoff_factor=retry_backoff,
+            raise_on_status=False,
+        )
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # Client async: tạo lazy trong event loop đang chạy
+        self._async_client = None
+
+    # --- helpers ---
+    def _payload(self, prompt, model, options=None, stream=False):
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+        }
+        if options:
+            payload["options"] = options
+        return payload
+
+    def _timeout(self, timeout):
+        return timeout if timeout is not None else self.read_timeout
+
+    def _log_call(self, model, elapsed, data=None, ok=True):
+        self.metrics.record(elapsed, ok=ok)
+        if not ok:
+            print(f"⏱️ [LLM] {model}: lỗi sau {elapsed:.2f}s")
+            return
+        data = data or {}
+        # Ollama trả về thời gian tính bằng nano giây
+        load_s = data.get("load_duration", 0) / 1e9
+        print(f"⏱️ [LLM] {model}: {elapsed:.2f}s (load {load_s:.2f}s, {data.get('eval_count', 0)} tokens)")
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                transport=httpx.AsyncHTTPTransport(retries=self.max_retries),  # retry lỗi kết nối
+            )
+        return self._async_client
+
+    async def _apost(self, payload, timeout=None):
+        """POST async, retry thêm khi gặp 502/503/504"""
+        client = self._get_async_client()
+        for attempt in range(self.max_retries + 1):
+            resp = await client.post(self.generate_url, json=payload, timeout=self._timeout(timeout))
+            if resp.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                return resp
+            self.metrics.record_retry()
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    # --- API ---
+    def generate(self, prompt, model, options=None, timeout=None):
+        """Gọi /api/generate (đồng bộ), trả về JSON của Ollama"""
+        start = time.perf_counter()
+        try:
+            resp = self._session.post(
+                self.generate_url,
+                json=self._payload(prompt, model, options),
+                timeout=(self.connect_timeout, self._timeout(timeout)),
+            )
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception:
+            self._log_call(model, time.perf_counter() - start, ok=False)
+            raise
+        self._log_call(model, time.perf_counter() - start, data)
+        return data
+
+    async def agenerate(self, prompt, model, options=None, timeout=None):
+        """Bản async của generate()"""
+        start = time.perf_counter()
+        try:
+            resp = await self._apost(self._payload(prompt, model, options), timeout)
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception:
+            self._log_call(model, time.perf_counter() - start, ok=False)
+            raise
+        self._log_call(model, time.perf_counter() - start, data)
+        return data
+
+    async def astream(self, prompt, model, options=None, timeout=None):
+        """
+        Gọi /api/generate với "stream": true, yield từng dòng JSON (NDJSON) của Ollama.
+        Chỉ retry lỗi kết nối (transport), không retry khi đã bắt đầu nhận token.
+        """
+        start = time.perf_counter()
+        last = {}
+        ok = False
+        try:
+            payload = self._payload(prompt, model, options, stream=True)
+            client = self._get_async_client()
+            async with client.stream("POST", self.generate_url, json=payload, timeout=self._timeout(timeout)) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    yield chunk
+                    if chunk.get("done"):
+                        last = chunk
+                        break
+            ok = True
+        finally:
+            self._log_call(model, time.perf_counter() - start, last, ok=ok)
+
+    def stats(self):
+        return {
+            "base_url": self.base_url,
+            "keep_alive": self.keep_alive,
+            **self.metrics.snapshot(),
+        }
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def close(self):
+        self._session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Client dùng chung toàn process"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OllamaClient()
+    return _client
@@ -0,0 +1,198 @@
+# model_registry.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Mỗi model (embedding, reranker, KeyBERT) chỉ được tải MỘT lần cho toàn process,
+#     theo khóa (loại, tên model, device), rồi dùng chung cho qa / ingest / utils
+#   - Model trả về được bọc trong SharedModel: các hàm suy luận (encode / predict /
+#     extract_keywords) chạy tuần tự theo khóa riêng của từng model, vì tokenizer của
+#     HuggingFace không an toàn khi nhiều thread gọi cùng lúc ("Already borrowed")
+#   - memory_report(): dung lượng RAM của từng model (tham số + buffer)
+#   - Backend suy luận: torch (mặc định) | onnx | onnx_int8 (ONNX Runtime, lượng tử hóa
+#     int8 động). Model ONNX được export 1 lần vào model.onnx_dir rồi load thẳng.
+# ------------------------------------------------------------
+
+import os
+import glob
+import time
+import threading
+from config_loader import load_config
+
+config = load_config()
+MODEL_CFG = config.get("model", {})
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ONNX_DIR = os.path.normpath(os.path.join(BASE_DIR, "..", MODEL_CFG.get("onnx_dir", "onnx_models")))
+# Bộ lệnh CPU cho lượng tử hóa int8: avx512_vnni | avx512 | avx2 | arm64
+ONNX_QUANTIZATION = MODEL_CFG.get("onnx_quantization", "avx2")
+
+BACKENDS = ("torch", "onnx", "onnx_int8")
+
+_models = {}        # key -> SharedModel
+_load_locks = {}    # key -> Lock (tránh 2 thread cùng tải 1 model)
+_registry_lock = threading.Lock()
+
+# Các hàm suy luận cần khóa
+_LOCKED_METHODS = ("encode", "predict", "extract_keywords")
+
+
+class SharedModel:
+    """Bọc model dùng chung: thuộc tính đi thẳng tới model gốc, hàm suy luận có khóa"""
+
+    def __init__(self, model, lock, key, shares_weights=False, onnx_file=None):
+        self._model = model
+        self._lock = lock
+        self.key = key
+        self.load_seconds = 0.0
+        # True nếu trọng số thuộc model khác đã đếm rồi (KeyBERT dùng chung SentenceTransformer)
+        self.shares_weights = shares_weights
+        # File .onnx đang dùng (trọng số nằm trong ONNX Runtime, không phải torch)
+        self.onnx_file = onnx_file
+
+    @property
+    def raw(self):
+        return self._model
+
+    def __getattr__(self, name):
+        attr = getattr(self._model, name)
+        if name in _LOCKED_METHODS and callable(attr):
+            def locked(*args, **kwargs):
+                with self._lock:
+                    return attr(*args, **kwargs)
+            return locked
+        return attr
+
+    def memory_bytes(self):
+        if self.shares_weights:
+            return 0
+        if self.onnx_file:
+            return os.path.getsize(self.onnx_file)
+        return _module_bytes(self._model)
+
+
+def _module_bytes(model):
+    """Tổng dung lượng tham số + buffer của một torch module (0 nếu không đo được)"""
+    if hasattr(model, "parameters"):
+        total = sum(p.numel() * p.element_size() for p in model.parameters())
+        if hasattr(model, "buffers"):
+            total += sum(b.numel() * b.element_size() for b in model.buffers())
+        return total
+    if hasattr(model, "model"):
+        return _module_bytes(model.model)
+    return 0
+
+
+def _default_device(device):
+    if device:
+        return device
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _onnx_export_dir(name):
+    return os.path.join(ONNX_DIR, name.replace("/", "__"))
+
+
+def _find_quantized(export_dir):
+    files = glob.glob(os.path.join(export_dir, "onnx", f"model_*int8_{ONNX_QUANTIZATION}.onnx"))
+    return os.path.relpath(files[0], export_dir) if files else None
+
+
+def _load_with_backend(cls, name, device, backend):
+    """
+    Tải model sentence_transformers (SentenceTransformer / CrossEncoder) theo backend.
+    Trả về (model, file .onnx hoặc None). Lần đầu dùng onnx / onnx_int8: export từ
+    trọng số torch (cần optimum[onnxruntime]) vào ONNX_DIR, các lần sau load thẳng.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend không hợp lệ: {backend} (chọn một trong {BACKENDS})")
+    if backend == "torch":
+        return cls(name, device=device), None
+
+    export_dir = _onnx_export_dir(name)
+    if not os.path.exists(os.path.join(export_dir, "onnx", "model.onnx")):
+        print(f"🔧 Export {name} sang ONNX -> {export_dir} (chỉ chạy lần đầu)...")
+        cls(name, device=device, backend="onnx").save_pretrained(export_dir)
+    if backend == "onnx":
+        file_name = os.path.join("onnx", "model.onnx")
+    else:
+        file_name = _find_quantized(export_dir)
+        if file_name is None:
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            print(f"🔧 Lượng tử hóa int8 động ({ONNX_QUANTIZATION}) cho {name}...")
+            export_dynamic_quantized_onnx_model(
+                cls(export_dir, device=device, backend="onnx"), ONNX_QUANTIZATION, export_dir)
+            file_name = _find_quantized(export_dir)
+    model = cls(export_dir, device=device, backend="onnx", model_kwargs={"file_name": file_name})
+    return model, os.path.join(export_dir, file_name)
+
+
+def _get_or_load(key, loader):
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _registry_lock:
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+    with load_lock:
+        model = _models.get(key)
+        if model is None:
+            print(f"⏳ Đang tải model {key[1]} ({key[0]}, {', '.join(key[2:])})...")
+            start = time.perf_counter()
+            model = loader()
+            model.load_seconds = time.perf_counter() - start
+            _models[key] = model
+            print(f"   ✅ {key[1]}: {model.load_seconds:.1f}s, {model.memory_bytes() / 1024 / 1024:.0f}MB")
+        return model
+
+
+def get_sentence_transformer(name, device=None, backend="torch"):
+    """SentenceTransformer dùng chung (embedding cho qa, ingest; backbone cho KeyBERT)"""
+    device = "cpu" if backend == "onnx_int8" else _default_device(device)
+    key = ("sentence_transformer", name, device, backend)
+
+    def loader():
+        from sentence_transformers import SentenceTransformer
+        model, onnx_file = _load_with_backend(SentenceTransformer, name, device, backend)
+        return SharedModel(model, threading.Lock(), key, onnx_file=onnx_file)
+
+    return _get_or_load(key, loader)
+
+
+def get_cross_encoder(name, device=None, backend="torch"):
+    """CrossEncoder dùng chung (reranker). onnx_int8 luôn chạy CPU (int8 chậm hơn trên GPU)."""
+    device = "cpu" if backend == "onnx_int8" else _default_device(device)
+    key = ("cross_encoder", name, device, backend)
+
+    def loader():
+        from sentence_transformers import CrossEncoder
+        model, onnx_file = _load_with_backend(CrossEncoder, name, device, backend)
+        return SharedModel(model, threading.Lock(), key, onnx_file=onnx_file)
+
+    return _get_or_load(key, loader)
+
+
+def get_keybert(name, device=None, backend="torch"):
+    """KeyBERT dùng lại SentenceTransformer đã tải (không tải thêm bản trọng số thứ 2)"""
+    embedder = get_sentence_transformer(name, device, backend)
+    key = ("keybert",) + embedder.key[1:]
+
+    def loader():
+        from keybert import KeyBERT
+        # Chung khóa với embedder vì cùng một tokenizer / model bên dưới
+        return SharedModel(KeyBERT(model=embedder.raw), embedder._lock, key, shares_weights=True)
+
+    return _get_or_load(key, loader)
+
+
+def memory_report():
+    """Dung lượng từng model đã tải (KeyBERT dùng chung trọng số nên báo 0)"""
+    report = []
+    for (kind, name, device, backend), model in list(_models.items()):
+        report.append({
+            "kind": kind,
+            "name": name,
+            "device": device,
+            "backend": backend,
+            "memory_mb": round(model.memory_bytes() / 1024 / 1024, 1),
+            "load_seconds": round(model.load_seconds, 2),
+        })
+    return report
@@ -1,9 +1,15 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import faiss
-import requests
-from sentence_transformers import SentenceTransformer, CrossEncoder
 import os
 from config_loader import load_config
+import llm_client
+import model_registry
+import index_service
+from cache import LRUCache, SemanticAnswerCache, InflightRegistry, normalize_query, clean_query
+from batching import MicroBatcher
 import db  # Import module database mới
 
 # --- CẤU HÌNH ---
@@ -15,57 +21,277 @@ INDEX_FILE = os.path.join(BASE_DIR, "..", "faiss.index")
 # Config path to DB is handled inside db.py via config loader, so we just use db module.
 
 RERANK_MODEL = config["model"]["RERANK_MODEL"]
+RERANK_BACKEND = config["model"].get("rerank_backend", "torch")
+RERANK_SMALL_MODEL = config["model"].get("RERANK_SMALL_MODEL")  # Reranker nhỏ cho cascade (None = bỏ tầng này)
 MODEL_NAME = config["model"]["embedding_model"]
+EMBEDDING_BACKEND = config["model"].get("embedding_backend", "torch")
 
 # Config Performance
 USE_RERANKER = config["vector_db"].get("use_reranker", True)
 RETRIEVAL_TOP_K = config["vector_db"].get("retrieval_top_k", 30)
 RERANK_TOP_N = config["vector_db"].get("rerank_top_n", 5)
+RETRIEVAL_MODE = config["vector_db"].get("retrieval_mode", "vector")
+LEXICAL_TOP_K = config["vector_db"].get("lexical_top_k", 10)
+RRF_K = config["vector_db"].get("rrf_k", 60)
 
-# --- LOAD MODEL & DATA ---
-print(f"⏳ Đang tải models...\n   - Embedding: {MODEL_NAME}")
-embedder = SentenceTransformer(MODEL_NAME)
+# Config Cascade rerank (dừng sớm khi đã đủ chắc chắn)
+RERANK_CASCADE = config["vector_db"].get("rerank_cascade", False)
+CASCADE_SKIP_MARGIN = config["vector_db"].get("cascade_skip_margin", 0.05)
+CASCADE_SCORE_WINDOW = config["vector_db"].get("cascade_score_window", 0.1)
+CASCADE_SMALL_MARGIN = config["vector_db"].get("cascade_small_margin", 0.3)
+CASCADE_SMALL_KEEP = config["vector_db"].get("cascade_small_keep", 4)
+CASCADE_LOG_EVERY = config["vector_db"].get("cascade_log_every", 100)
 
-if USE_RERANKER:
-    print(f"   - Reranker: {RERANK_MODEL}")
-    reranker = CrossEncoder(RERANK_MODEL)
-else:
-    print("   - Reranker: OFF (Chế độ Fast Mode)")
-    reranker = None
+# Config Cache
+CACHE_CFG = config.get("cache", {})
+QUERY_EMBEDDING_CACHE_SIZE = CACHE_CFG.get("query_embedding_size", 2048)
+ANSWER_CACHE_SIZE = CACHE_CFG.get("answer_size", 512)
+ANSWER_SIMILARITY_THRESHOLD = CACHE_CFG.get("answer_similarity_threshold", 0.97)
+ANSWER_TTL = CACHE_CFG.get("answer_ttl_seconds", 3600)
 
-# Load FAISS
-if os.path.exists(INDEX_FILE):
-    index = faiss.read_index(INDEX_FILE)
-else:
-    raise FileNotFoundError("❌ Không tìm thấy file faiss.index! Hãy chạy ingest.py trước.")
+# Config Concurrency (dùng cho API async)
+CONCURRENCY_CFG = config.get("concurrency", {})
+CPU_WORKERS = CONCURRENCY_CFG.get("cpu_workers", 4)
+MAX_CONCURRENT_LLM = CONCURRENCY_CFG.get("max_concurrent_llm", 2)
+RERANK_BATCH_WINDOW_MS = CONCURRENCY_CFG.get("rerank_batch_window_ms", 5)
+RERANK_MAX_BATCH = CONCURRENCY_CFG.get("rerank_max_batch", 64)
+QUERY_BATCH_MAX_WAIT_MS = CONCURRENCY_CFG.get("query_batch_max_wait_ms", 2)
+QUERY_MAX_BATCH = CONCURRENCY_CFG.get("query_max_batch", 32)
+NOT_FOUND_ANSWER = "Xin lỗi, tôi không tìm thấy thông tin liên quan trong tài liệu của bạn (Điểm tin cậy quá thấp)."
+
+# Thread pool giới hạn cho các bước nặng CPU (embedding, FAISS, rerank)
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="qa-cpu")
+# Giới hạn số lời gọi Ollama chạy song song (Ollama tự xếp hàng nếu quá tải)
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM)
+
+# --- LOAD MODEL & DATA (lazy: chỉ tải khi dùng lần đầu hoặc khi warmup) ---
+def get_embedder():
+    return model_registry.get_sentence_transformer(MODEL_NAME, backend=EMBEDDING_BACKEND)
+
+def get_reranker():
+    """Reranker (None nếu tắt trong config -> Chế độ Fast Mode)"""
+    if not USE_RERANKER:
+        return None
+    return model_registry.get_cross_encoder(RERANK_MODEL, backend=RERANK_BACKEND)
+
+def get_small_reranker():
+    """Reranker nhỏ (tầng giữa của cascade), None nếu không dùng"""
+    if not (USE_RERANKER and RERANK_CASCADE and RERANK_SMALL_MODEL):
+        return None
+    return model_registry.get_cross_encoder(RERANK_SMALL_MODEL, backend=RERANK_BACKEND)
+
+def ensure_index():
+    """Load FAISS (snapshot + delta log), dùng chung 1 bản trong RAM với ingest"""
+    if not index_service.is_loaded():
+        index_service.load()
+
+def warmup(on_stage=None):
+    """
+    Tải trước model + index rồi chạy 1 câu hỏi giả để khởi động (JIT / cache của torch).
+    on_stage(tên, trạng thái, giây): callback báo tiến độ cho /readyz.
+    """
+    stages = [
+        ("embedder", get_embedder),
+        ("reranker", get_reranker),
+        ("small_reranker", get_small_reranker),
+        ("index", ensure_index),
+        ("warmup_query", lambda: retrieve("warmup", top_k=1, rerank_top_n=1)),
+    ]
+    for name, fn in stages:
+        if on_stage:
+            on_stage(name, "loading", None)
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            if on_stage:
+                on_stage(name, "error", time.perf_counter() - start)
+            raise
+        if on_stage:
+            on_stage(name, "done", time.perf_counter() - start)
 
 # Không load docs.json nữa vì đã chuyển sang SQLite (lazy load)
 
+# Cache vector câu hỏi (câu hỏi lặp lại nhiều -> khỏi encode lại)
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+# Cache câu trả lời theo độ tương đồng câu hỏi (bị xóa khi /ingest sửa bài viết đã trích dẫn)
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_SIMILARITY_THRESHOLD, ANSWER_TTL)
+# Các câu hỏi giống hệt nhau đang chạy song song dùng chung 1 lần gọi Ollama
+inflight_answers = InflightRegistry()
+inflight_streams = InflightRegistry()
+
+def _predict_sorted(model, pairs):
+    """
+    Điểm reranker cho danh sách cặp (câu hỏi, đoạn văn), giữ nguyên thứ tự.
+    Sắp theo độ dài trước khi predict để mỗi batch con ít padding (lô gộp từ nhiều request
+    có độ dài chênh lệch lớn).
+    """
+    order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+    scores = model.predict([pairs[i] for i in order], batch_size=RERANK_MAX_BATCH)
+    out = np.empty(len(pairs), dtype="float32")
+    out[order] = scores
+    return out
+
+def rerank_pairs(pairs):
+    return _predict_sorted(get_reranker(), pairs)
+
+def small_rerank_pairs(pairs):
+    return _predict_sorted(get_small_reranker(), pairs)
+
+# Gom cặp (câu hỏi, đoạn văn) của các request đồng thời thành 1 lần predict
+rerank_batcher = MicroBatcher(rerank_pairs, RERANK_BATCH_WINDOW_MS, RERANK_MAX_BATCH, name="rerank-batcher")
+small_rerank_batcher = MicroBatcher(small_rerank_pairs, RERANK_BATCH_WINDOW_MS, RERANK_MAX_BATCH, name="small-rerank-batcher")
+
+
+class CascadeStats:
+    """Số câu hỏi dừng ở từng tầng của cascade rerank và số cặp mỗi tầng phải chấm"""
+
+    STAGES = ("faiss", "small", "large")
+
+    def __init__(self, log_every=CASCADE_LOG_EVERY):
+        self.log_every = log_every
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._exits = dict.fromkeys(self.STAGES, 0)
+        self._candidates = self._small_pairs = self._large_pairs = 0
+
+    def record(self, stage, candidates, small_pairs, large_pairs):
+        with self._lock:
+            self._exits[stage] += 1
+            self._candidates += candidates
+            self._small_pairs += small_pairs
+            self._large_pairs += large_pairs
+            queries = sum(self._exits.values())
+        if self.log_every and queries % self.log_every == 0:
+            st = self.stats()
+            rates = ", ".join(f"{k} {v:.0%}" for k, v in st["exit_rate"].items())
+            print(f"📊 Cascade rerank ({queries} câu hỏi): dừng ở {rates} | "
+                  f"ứng viên {st['avg_candidates']}, cặp nhỏ {st['avg_small_pairs']}, cặp lớn {st['avg_large_pairs']}")
+
+    def stats(self):
+        with self._lock:
+            queries = sum(self._exits.values())
+            avg = lambda total: round(total / queries, 2) if queries else 0.0
+            return {
+                "queries": queries,
+                "exit_rate": {k: round(v / queries, 4) if queries else 0.0 for k, v in self._exits.items()},
+                "avg_candidates": avg(self._candidates),
+                "avg_small_pairs": avg(self._small_pairs),
+                "avg_large_pairs": avg(self._large_pairs),
+            }
+
+cascade_stats = CascadeStats()
+
+def _margin(scores):
+    """Khoảng cách điểm top 1 - top 2 (vô cùng nếu chỉ có 1 ứng viên)"""
+    top = sorted(scores, reverse=True)[:2]
+    return top[0] - top[1] if len(top) == 2 else float("inf")
+
+def _cascade_rerank(query, candidates, vector_scores, rerank_top_n):
+    """
+    Rerank nhiều tầng, dừng sớm khi đã đủ chắc chắn. Trả về list (candidate, score) đã sắp xếp.
+    1. FAISS: top 1 hơn top 2 >= cascade_skip_margin -> giữ thứ tự hiện tại, không rerank
+    2. Bỏ ứng viên có điểm FAISS thấp hơn top 1 quá cascade_score_window (luôn giữ
+       rerank_top_n ứng viên đầu và ứng viên chỉ đến từ BM25)
+    3. Reranker nhỏ chấm các ứng viên còn lại; top 1 hơn top 2 >= cascade_small_margin -> dừng
+    4. Reranker lớn chấm lại cascade_small_keep ứng viên tốt nhất của tầng 3
+    """
+    if _margin(list(vector_scores.values())) >= CASCADE_SKIP_MARGIN:
+        cascade_stats.record("faiss", len(candidates), 0, 0)
+        return [(c, vector_scores.get(c["id"], 0.0)) for c in candidates]
+
+    best = max(vector_scores.values(), default=0.0)
+    keep = [c for i, c in enumerate(candidates)
+            if i < rerank_top_n or vector_scores.get(c["id"], best) >= best - CASCADE_SCORE_WINDOW]
+    n_candidates, small_pairs = len(keep), 0
+
+    if get_small_reranker() is not None and len(keep) > CASCADE_SMALL_KEEP:
+        scores = small_rerank_batcher.submit([(query, c["text"]) for c in keep])
+        small_pairs = len(keep)
+        ranked = sorted(zip(keep, scores), key=lambda x: x[1], reverse=True)
+        if _margin(scores) >= CASCADE_SMALL_MARGIN:
+            cascade_stats.record("small", n_candidates, small_pairs, 0)
+            return ranked
+        keep = [c for c, _ in ranked[:max(CASCADE_SMALL_KEEP, rerank_top_n)]]
+
+    scores = rerank_batcher.submit([(query, c["text"]) for c in keep])
+    cascade_stats.record("large", n_candidates, small_pairs, len(keep))
+    return sorted(zip(keep, scores), key=lambda x: x[1], reverse=True)
+
 def reload_index():
-    """Reload FAISS index from disk (dùng sau khi Ingest)"""
-    global index
-    if os.path.exists(INDEX_FILE):
-        print("🔄 Reloading FAISS index...")
-        index = faiss.read_index(INDEX_FILE)
-    else:
-        print("⚠️ Không tìm thấy index để reload.")
+    """Reload FAISS index từ đĩa (chỉ cần khi process khác sửa index; /ingest không cần gọi)"""
+    index_service.reload()
+
+def encode_queries(keys):
+    """Encode nhiều câu hỏi (đã chuẩn hóa) trong 1 lần gọi model"""
+    # Thêm prefix query: cho E5
+    vecs = get_embedder().encode([f"query: {k}" for k in keys], batch_size=QUERY_MAX_BATCH,
+                                 normalize_embeddings=True).astype("float32")
+    return list(vecs)
+
+def search_many(items):
+    """
+    items: [(vector câu hỏi, top_k)] -> [(D, I)] cho từng câu hỏi.
+    1 lần index.search nhiều dòng với top_k lớn nhất, rồi cắt theo top_k của từng câu.
+    """
+    k = max(top_k for _, top_k in items)
+    D, I = index_service.search(np.vstack([vec for vec, _ in items]), k)
+    return [(D[i, :top_k], I[i, :top_k]) for i, (_, top_k) in enumerate(items)]
+
+# Gom câu hỏi của các request đồng thời: 1 lần encode và 1 lần FAISS search nhiều dòng
+query_embed_batcher = MicroBatcher(encode_queries, QUERY_BATCH_MAX_WAIT_MS, QUERY_MAX_BATCH, name="query-embed-batcher")
+search_batcher = MicroBatcher(search_many, QUERY_BATCH_MAX_WAIT_MS, QUERY_MAX_BATCH, name="search-batcher")
+
+def embed_query(query):
+    """
+    Vector (float32, đã normalize) của câu hỏi, có LRU cache theo câu hỏi đã chuẩn hóa.
+    Model được encode câu gốc (chỉ NFC + gộp khoảng trắng) vì tokenizer e5 phân biệt hoa/thường;
+    khóa cache casefold chỉ dùng để tra cứu.
+    Vector trả về là read-only vì được dùng chung giữa các request.
+    """
+    key = normalize_query(query)
+    vec = query_embedding_cache.get(key)
+    if vec is None:
+        vec = query_embed_batcher.submit([clean_query(query)])[0].copy()
+        vec.setflags(write=False)
+        query_embedding_cache.put(key, vec)
+    return vec
+
+def rrf_fuse(rankings, k=RRF_K):
+    """Reciprocal-rank fusion: điểm = tổng 1 / (k + hạng) qua các danh sách ID"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
 
 # ==============================================================================
 # 1. RETRIEVE & RERANK (CÓ LỌC NGƯỠNG ĐIỂM)
 # ==============================================================================
-def retrieve(query, top_k=RETRIEVAL_TOP_K, rerank_top_n=RERANK_TOP_N, score_threshold=0.0):
+def retrieve(query, top_k=RETRIEVAL_TOP_K, rerank_top_n=RERANK_TOP_N, score_threshold=0.0, mode=RETRIEVAL_MODE,
+             cascade=RERANK_CASCADE):
     """
     Tìm kiếm và lọc kết quả.
     - score_threshold: Ngưỡng điểm tối thiểu. Nếu điểm < 0 (hoặc thấp hơn), bỏ qua.
+    - mode: "vector" (chỉ FAISS) | "hybrid" (FAISS + BM25 trong SQLite, gộp bằng RRF)
+    - cascade: rerank nhiều tầng, dừng sớm (xem _cascade_rerank)
     """
-    # 1. Embedding Query (Thêm prefix query: cho E5)
-    qv = embedder.encode([f"query: {query}"], normalize_embeddings=True).astype("float32")
+    ensure_index()
+
+    # 1. Embedding Query (có cache)
+    qv = embed_query(query)
 
-    # 2. Tìm kiếm thô bằng FAISS
-    D, I = index.search(qv, top_k)
+    # 2. Tìm kiếm thô bằng FAISS (gom chung với các request đồng thời)
+    D, I = search_batcher.submit([(qv, top_k)])[0]
     
-    # Lấy ra danh sách ID hợp lệ, bỏ qua -1
-    valid_ids = [int(idx) for idx in I[0] if idx != -1]
+    # Lấy ra danh sách ID hợp lệ, bỏ qua -1 (và ID trùng: HNSW không xóa được vector cũ)
+    valid_ids = list(dict.fromkeys(int(idx) for idx in I if idx != -1))
+
+    # Hybrid: gộp với kết quả từ khóa (tên cây trồng, tên thuốc... khớp chính xác), giữ top_k
+    if mode == "hybrid":
+        valid_ids = rrf_fuse([valid_ids, db.search_fts(query, LEXICAL_TOP_K)])[:top_k]
     
     # Truy vấn nội dung từ SQLite theo ID
     candidates = db.get_documents_by_ids(valid_ids)
@@ -74,9 +300,12 @@ def retrieve(query, top_k=RETRIEVAL_TOP_K, rerank_top_n=RERANK_TOP_N, score_thre
         return []
 
     # 3. Rerank (Nếu bật)
-    if USE_RERANKER:
+    if USE_RERANKER and cascade:
+        vector_scores = {int(i): float(d) for d, i in zip(D, I) if i != -1}
+        ranked_candidates = _cascade_rerank(query, candidates, vector_scores, rerank_top_n)
+    elif USE_RERANKER:
         pairs = [(query, c["text"]) for c in candidates]
-        scores = reranker.predict(pairs)
+        scores = rerank_batcher.submit(pairs)
         
         # Ghép (candidate, score) lại và sort giảm dần
         ranked_candidates = sorted(zip(candidates, scores), key=lambda x: x[1], reverse=True)
@@ -100,11 +329,13 @@ def retrieve(query, top_k=RETRIEVAL_TOP_K, rerank_top_n=RERANK_TOP_N, score_thre
             break # Đã đủ số lượng cần lấy
 
         results.append({
+            "id": doc["id"],
             "rank": len(results) + 1,
             "source": doc["source"],
             "rep_type": doc["rep_type"],
             "score": float(score),
-            "text": doc["text"]
+            "text": doc["text"],
+            "full_path": doc["full_path"]
         })
 
     return results
@@ -145,51 +376,202 @@ def make_prompt(query: str, retrieved: list, role: str = "Chuyên gia nông nghi
 # ==============================================================================
 # 3. CALL OLLAMA 
 # ==============================================================================
+def _ollama_options(temperature):
+    return {
+        "temperature": temperature, 
+        "num_predict": 1024
+    }
+
 def call_ollama(prompt: str, model: str = "qwen2.5", temperature: float = 0.3) -> str:
     """
     Gọi Ollama. Mặc định dùng qwen2.5 (nếu máy yếu dùng qwen2.5:3b)
     Temperature thấp (0.3) để model bớt "sáng tạo" lung tung.
     """
-    url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False,
-        "options": {
-            "temperature": temperature, 
-            "num_predict": 1024
-        }
-    }
-
     try:
-        resp = requests.post(url, json=payload, timeout=60)
-        resp.raise_for_status()
-        return resp.json().get("response", "Lỗi: Model không phản hồi.")
+        return _generate(prompt, model, temperature)
     except Exception as e:
         return f"Lỗi kết nối Ollama: {e}"
 
+def _generate(prompt, model, temperature=0.3):
+    """Như call_ollama nhưng ném exception khi lỗi (để không cache câu trả lời lỗi)"""
+    data = llm_client.get_client().generate(prompt, model, options=_ollama_options(temperature))
+    return _response_text(data)
+
+async def _agenerate(prompt, model, temperature=0.3):
+    async with llm_semaphore:
+        data = await llm_client.get_client().agenerate(prompt, model, options=_ollama_options(temperature))
+    return _response_text(data)
+
+def _response_text(data):
+    """Ollama trả về rỗng cũng coi là lỗi (ném exception) để câu trả lời lỗi không bị cache"""
+    text = data.get("response")
+    if not text:
+        raise RuntimeError("Model không phản hồi.")
+    return text
+
+async def astream_ollama(prompt: str, model: str = "qwen2.5", temperature: float = 0.3):
+    """Gọi Ollama ở chế độ stream, yield từng đoạn token ngay khi nhận được."""
+    async with llm_semaphore:
+        async for chunk in llm_client.get_client().astream(prompt, model, options=_ollama_options(temperature)):
+            if chunk.get("response"):
+                yield chunk["response"]
+
+async def aclose():
+    """Đóng HTTP client async (gọi khi tắt server)"""
+    await llm_client.get_client().aclose()
+    cpu_executor.shutdown(wait=False)
+
 # ==============================================================================
 # 4. MAIN FLOW
 # ==============================================================================
+def _debug_retrieved(retrieved):
+    print(f"\n=== 🔍 Debug: Tìm thấy {len(retrieved)} tài liệu phù hợp ===")
+    for r in retrieved:
+        print(f"[{r['score']:.4f}] {r['source']} ({r['rep_type']})")
+    print("===================================================\n")
+
+def _source_info(retrieved):
+    """Thông tin nguồn gửi cho client (bỏ phần text dài)"""
+    return [
+        {"rank": r["rank"], "source": r["source"], "rep_type": r["rep_type"], "score": r["score"]}
+        for r in retrieved
+    ]
+
+def _cache_answer(qv, model, text, retrieved, seq):
+    answer_cache.put(qv, model, text, _source_info(retrieved), {r["full_path"] for r in retrieved}, seq)
+
+def _answer_uncached(query, qv, model, debug):
+    seq = answer_cache.begin()
+    retrieved = retrieve(query)
+
+    if debug:
+        _debug_retrieved(retrieved)
+
+    # 2. Tạo Prompt
+    prompt = make_prompt(query, retrieved)
+
+    # Nếu không có tài liệu nào qua được vòng gửi xe
+    if prompt is None:
+        return NOT_FOUND_ANSWER
+
+    # 3. Gọi LLM
+    text = _generate(prompt, model)
+    _cache_answer(qv, model, text, retrieved, seq)
+    return text
+
+async def _aanswer_uncached(query, qv, model, debug):
+    seq = answer_cache.begin()
+    loop = asyncio.get_running_loop()
+    retrieved = await loop.run_in_executor(cpu_executor, retrieve, query)
+
+    if debug:
+        _debug_retrieved(retrieved)
+
+    prompt = make_prompt(query, retrieved)
+    if prompt is None:
+        return NOT_FOUND_ANSWER
+
+    text = await _agenerate(prompt, model)
+    _cache_answer(qv, model, text, retrieved, seq)
+    return text
+
 def answer(query: str, model: str = "qwen2.5", debug: bool = True) -> str:
     try:
-        retrieved = retrieve(query)
+        # 1. Cache câu trả lời (câu hỏi giống/gần giống đã trả lời)
+        qv = embed_query(query)
+        cached = answer_cache.lookup(qv, model)
+        if cached:
+            return cached["answer"]
 
-        if debug:
-            print(f"\n=== 🔍 Debug: Tìm thấy {len(retrieved)} tài liệu phù hợp ===")
-            for r in retrieved:
-                print(f"[{r['score']:.4f}] {r['source']} ({r['rep_type']})")
-            print("===================================================\n")
+        key = (model, normalize_query(query))
+        return inflight_answers.run(key, lambda: _answer_uncached(query, qv, model, debug))
 
-        # 2. Tạo Prompt
-        prompt = make_prompt(query, retrieved)
-        
-        # Nếu không có tài liệu nào qua được vòng gửi xe
-        if prompt is None:
-            return "Xin lỗi, tôi không tìm thấy thông tin liên quan trong tài liệu của bạn (Điểm tin cậy quá thấp)."
+    except Exception as e:
+        return f"Lỗi hệ thống: {str(e)}"
 
-        # 3. Gọi LLM
-        return call_ollama(prompt, model=model)
+async def aanswer(query: str, model: str = "qwen2.5", debug: bool = True) -> str:
+    """
+    Bản async của answer() cho server:
+    - retrieve (embedding + FAISS + rerank) chạy trong cpu_executor
+    - gọi Ollama qua httpx async, giới hạn bởi llm_semaphore
+    - câu hỏi giống hệt nhau đang chạy song song dùng chung 1 lần sinh câu trả lời
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        qv = await loop.run_in_executor(cpu_executor, embed_query, query)
+        cached = answer_cache.lookup(qv, model)
+        if cached:
+            return cached["answer"]
+
+        key = (model, normalize_query(query))
+        return await inflight_answers.arun(key, lambda: _aanswer_uncached(query, qv, model, debug))
+
+    except Exception as e:
+        return f"Lỗi hệ thống: {str(e)}"
+
+async def astream_answer(query: str, model: str = "qwen2.5", debug: bool = True):
+    """
+    Bản streaming của aanswer(). Yield các event dạng dict:
+    - {"event": "sources", "data": [...]}  ngay khi retrieve xong
+    - {"event": "token",   "data": "..."}  từng đoạn câu trả lời từ Ollama
+    - {"event": "error",   "data": "..."}  nếu có lỗi
+    - {"event": "done",    "data": {}}     kết thúc
+    Câu hỏi giống hệt đang được stream: request đến sau chờ leader xong rồi nhận cả câu trả lời
+    trong 1 event token (không gọi Ollama lần nữa).
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        qv = await loop.run_in_executor(cpu_executor, embed_query, query)
+        cached = answer_cache.lookup(qv, model)
+        if cached:
+            yield {"event": "sources", "data": cached["sources"]}
+            yield {"event": "token", "data": cached["answer"]}
+        else:
+            key = (model, normalize_query(query))
+            fut, leader = inflight_streams.join(key)
+            if leader:
+                async for event in _astream_leader(query, qv, model, debug, key, fut):
+                    yield event
+            else:
+                # shield: request đến sau bị hủy không kéo theo hủy kết quả của leader
+                result = await asyncio.shield(asyncio.wrap_future(fut))
+                yield {"event": "sources", "data": result["sources"]}
+                yield {"event": "token", "data": result["answer"]}
 
     except Exception as e:
-        return f"Lỗi hệ thống: {str(e)}"
\ No newline at end of file
+        yield {"event": "error", "data": f"Lỗi hệ thống: {str(e)}"}
+
+    yield {"event": "done", "data": {}}
+
+async def _astream_leader(query, qv, model, debug, key, fut):
+    """Phần stream của request leader; luôn gọi inflight_streams.finish() dù thành công hay lỗi"""
+    try:
+        seq = answer_cache.begin()
+        loop = asyncio.get_running_loop()
+        retrieved = await loop.run_in_executor(cpu_executor, retrieve, query)
+
+        if debug:
+            _debug_retrieved(retrieved)
+
+        sources = _source_info(retrieved)
+        yield {"event": "sources", "data": sources}
+
+        prompt = make_prompt(query, retrieved)
+        if prompt is None:
+            text = NOT_FOUND_ANSWER
+            yield {"event": "token", "data": text}
+        else:
+            tokens = []
+            async for token in astream_ollama(prompt, model=model):
+                tokens.append(token)
+                yield {"event": "token", "data": token}
+            if not tokens:
+                raise RuntimeError("Model không phản hồi.")
+            text = "".join(tokens)
+            _cache_answer(qv, model, text, retrieved, seq)
+    except BaseException as e:
+        # client ngắt kết nối (GeneratorExit / CancelledError): báo lỗi thường cho các request đang chờ
+        exc = e if isinstance(e, Exception) else RuntimeError("Request stream gốc đã bị hủy")
+        inflight_streams.finish(key, fut, exc=exc)
+        raise
+    inflight_streams.finish(key, fut, {"answer": text, "sources": sources})
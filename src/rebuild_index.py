@@ -0,0 +1,160 @@
+# rebuild_index.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Dựng lại faiss.index (loại bất kỳ) từ embedding float16 lưu trong docs.db, không chạy
+#     lại model embedding: đổi index_type, khôi phục index hỏng, sửa lệch ID index <-> DB
+#   - Dòng chưa có embedding của model hiện tại (DB cũ, đổi model) được bổ sung trước:
+#     embed lại, hoặc chép từ index flat / hnsw hiện có (--from-index)
+#   - Kiểm tra index khớp DB: cùng tập ID, vector của mỗi chunk tìm lại được chính chunk đó
+#   - Tắt server trước khi chạy (server giữ index cũ trong RAM và ghi tiếp delta log)
+#
+#   python src/rebuild_index.py                    # Dựng lại theo vector_db.index_type
+#   python src/rebuild_index.py --index-type sq8   # Dựng sang loại khác
+#   python src/rebuild_index.py --verify-only      # Chỉ kiểm tra index hiện tại
+# ------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+
+import faiss
+import numpy as np
+from config_loader import load_config
+import vector_index
+from index_store import IndexStore, FullVectorFile
+from index_service import INDEX_FILE, FULL_VECTORS_FILE
+import db
+
+config = load_config()
+MODEL_NAME = config["model"]["embedding_model"]
+
+
+def backfill_embeddings(from_index=False):
+    """Bổ sung embedding cho các dòng còn thiếu. Trả về số dòng đã bổ sung."""
+    missing = db.get_missing_embeddings(MODEL_NAME)
+    if not missing:
+        return 0
+    print(f"🧩 {len(missing)} chunk chưa có embedding ({MODEL_NAME}) trong docs.db")
+    start = time.perf_counter()
+
+    if from_index:
+        index = IndexStore(INDEX_FILE).load()
+        stored = vector_index.reconstruct_all(index) if index is not None else None
+        if stored is None:
+            print("⚠️ Index hiện tại không lưu vector gốc (chỉ flat / hnsw), chuyển sang embed lại.")
+        else:
+            pos = {int(i): p for p, i in enumerate(stored[0])}
+            found = [row for row in missing if row["id"] in pos]
+            if found:
+                db.set_embeddings([r["id"] for r in found], stored[1][[pos[r["id"]] for r in found]], MODEL_NAME)
+                print(f"   📥 Chép {len(found)} vector từ faiss.index")
+            missing = [row for row in missing if row["id"] not in pos]
+
+    if missing:
+        import ingest  # Chỉ tải model embedding khi thật sự cần
+        vecs = ingest.embed_entries(missing, show_progress=True)
+        db.set_embeddings([r["id"] for r in missing], vecs, MODEL_NAME)
+        print(f"   🧠 Embed lại {len(missing)} chunk")
+    print(f"   ✅ Bổ sung embedding trong {time.perf_counter() - start:.1f}s")
+    return len(missing)
+
+
+def build_index(ids, vecs, index_type):
+    index = vector_index.create_index(vecs.shape[1], index_type, n_train=len(vecs))
+    vector_index.train_index(index, vecs)
+    vector_index.apply_search_params(index)
+    index.add_with_ids(np.ascontiguousarray(vecs), ids)
+    return index
+
+
+def verify(index, ids=None, vecs=None, sample=200, k=10, seed=0):
+    """
+    So index với docs.db. Trả về (ok, báo cáo): ok = cùng tập ID và tỉ lệ chunk (mẫu ngẫu
+    nhiên) tìm lại được chính nó trong top k >= 0.99 (index nén cho phép thấp hơn, chỉ cảnh báo).
+    """
+    db_ids = np.fromiter(db.get_all_ids(), dtype=np.int64)
+    index_ids = faiss.vector_to_array(index.id_map)
+    report = {
+        "index_type": vector_index.index_type_of(index),
+        "db_rows": len(db_ids),
+        "index_vectors": int(index.ntotal),
+        "missing_in_index": len(np.setdiff1d(db_ids, index_ids)),
+        "orphans_in_index": len(np.setdiff1d(index_ids, db_ids)),
+        "duplicate_ids": len(index_ids) - len(np.unique(index_ids)),
+    }
+    ok = not (report["missing_in_index"] or report["orphans_in_index"] or report["duplicate_ids"])
+
+    if ids is None:
+        ids, vecs = db.load_embeddings(MODEL_NAME)
+    if len(ids):
+        pick = np.random.default_rng(seed).choice(len(ids), min(sample, len(ids)), replace=False)
+        _, I = index.search(np.ascontiguousarray(vecs[pick]), k)
+        self_recall = float(np.mean([ids[p] in row for p, row in zip(pick, I)]))
+        report[f"self_recall@{k}"] = round(self_recall, 4)
+        if self_recall < 0.99 and not vector_index.is_compressed(index):
+            ok = False
+    return ok, report
+
+
+def print_report(ok, report):
+    for key, value in report.items():
+        print(f"   {key:<18} {value}")
+    print("✅ Index khớp với docs.db" if ok else "❌ Index KHÔNG khớp với docs.db (chạy rebuild_index.py để dựng lại)")
+
+
+def rebuild(index_type=vector_index.INDEX_TYPE, from_index=False):
+    backfill_embeddings(from_index)
+
+    start = time.perf_counter()
+    ids, vecs = db.load_embeddings(MODEL_NAME)
+    if not len(ids):
+        print("❌ docs.db chưa có chunk nào, hãy chạy ingest.py trước.")
+        return False
+    print(f"📖 Đọc {len(ids)} embedding ({vecs.shape[1]} chiều) từ docs.db: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    index = build_index(ids, vecs, index_type)
+    print(f"🏗️ Dựng {vector_index.describe(index)}: {time.perf_counter() - start:.2f}s")
+
+    ok, report = verify(index, ids, vecs)
+    print_report(ok, report)
+    if not ok:
+        print("⛔ Giữ nguyên faiss.index cũ.")
+        return False
+
+    # Ghi snapshot (atomic) + xóa delta log cũ
+    IndexStore(INDEX_FILE).compact(index)
+    if vector_index.RESCORE and vector_index.is_compressed(index):
+        if os.path.exists(FULL_VECTORS_FILE):
+            os.remove(FULL_VECTORS_FILE)
+        full_vectors = FullVectorFile(FULL_VECTORS_FILE, index.d)
+        full_vectors.write(ids, vecs)
+        full_vectors.close()
+    if index_type != vector_index.INDEX_TYPE:
+        print(f"ℹ️ Nhớ đổi vector_db.index_type thành \"{index_type}\" trong config.yaml")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng lại / kiểm tra FAISS index từ embedding trong docs.db")
+    parser.add_argument("--index-type", default=vector_index.INDEX_TYPE, choices=vector_index.INDEX_TYPES)
+    parser.add_argument("--from-index", action="store_true",
+                        help="Chunk thiếu embedding: chép vector từ faiss.index hiện tại (flat / hnsw) thay vì embed lại")
+    parser.add_argument("--verify-only", action="store_true", help="Chỉ kiểm tra faiss.index hiện tại")
+    args = parser.parse_args()
+
+    if args.verify_only:
+        index = IndexStore(INDEX_FILE).load()
+        if index is None:
+            print("❌ Không tìm thấy faiss.index.")
+            sys.exit(1)
+        ok, report = verify(index)
+        print_report(ok, report)
+    else:
+        ok = rebuild(args.index_type, args.from_index)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,32 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.requests import Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 import uvicorn
-import faiss
+import asyncio
 import json
-import numpy as np
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import qa      
 import ingest  
 import db # Import module DB
+import llm_client
+import index_service
+import model_registry
 from config_loader import load_config
 
+config = load_config()
+WARMUP_ON_STARTUP = config.get("server", {}).get("warmup", True)
+
 app = FastAPI()
 
+# Ingest chạy tuần tự trong 1 thread riêng (ghi index/DB không chạy song song),
+# để không chặn event loop và không tranh thread với /ask
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], 
@@ -40,12 +53,33 @@ async def ask_endpoint(request: QuestionRequest):
     if not request.query:
         raise HTTPException(status_code=400, detail="Câu hỏi rỗng")
     try:
-        bot_response = qa.answer(request.query)
+        bot_response = await qa.aanswer(request.query)
         return {"answer": bot_response}
     except Exception as e:
         print(f"❌ Lỗi server: {e}")
         return {"answer": "Xin lỗi, hệ thống đang gặp sự cố."}
 
+# --- API HỎI ĐÁP (STREAMING - Server-Sent Events) ---
+@app.post("/ask/stream")
+async def ask_stream_endpoint(request: QuestionRequest):
+    """
+    Trả về text/event-stream: event "sources" trước (ngay khi retrieve xong),
+    sau đó là các event "token" theo thời gian thực từ Ollama, cuối cùng là "done".
+    """
+    if not request.query:
+        raise HTTPException(status_code=400, detail="Câu hỏi rỗng")
+
+    async def event_stream():
+        async for item in qa.astream_answer(request.query):
+            data = json.dumps(item["data"], ensure_ascii=False)
+            yield f"event: {item['event']}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/ingest")
 async def ingest_endpoint(raw_request: Request):
     try:
@@ -66,52 +100,113 @@ async def ingest_endpoint(raw_request: Request):
         raise HTTPException(status_code=422, detail="Dữ liệu gửi lên không phải JSON hợp lệ")
 
     # --- BẮT ĐẦU XỬ LÝ (Dùng biến request_data) ---
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ingest_executor, _ingest_document, request_data)
+
+def _ingest_document(request_data: IngestRequest):
+    """Cập nhật bài viết: chỉ embed chunk có nội dung mới (chạy trong ingest_executor)"""
     print(f"📥 Đang xử lý bài viết: {request_data.title}")
     
     try:
-        # 1. XÓA DỮ LIỆU CŨ TỪ SQLite & Update Index
-        # Xóa khỏi DB và lấy IDs đã xóa
-        deleted_ids = db.delete_documents_by_path(request_data.url)
-        
-        # Cập nhật set tracking của ingest
-        ingest.remove_from_processed(request_data.url)
-
-        if deleted_ids:
-            print(f"   ♻️ Đã xóa {len(deleted_ids)} chunk cũ từ DB.")
-            # Xóa khỏi memory index của ingest
-            ingest.index.remove_ids(np.array(deleted_ids, dtype=np.int64))
-
-        # 2. TẠO DỮ LIỆU MỚI
-        vecs, db_entries = ingest.process_content(
+        # 1. So chunk mới với chunk cũ theo content hash: giữ chunk không đổi (ID + vector),
+        # xóa chunk không còn, embed + lưu chunk mới vào index dùng chung (qa tìm thấy ngay)
+        total, embedded, reused, removed = ingest.update_content(
             request_data.content, 
             f"Wiki: {request_data.title}", 
             request_data.url, 
-            source_type="wiki",
-            force_update=True 
+            source_type="wiki"
         )
+        if reused or removed:
+            print(f"   ♻️ Giữ {reused} chunk không đổi, xóa {removed} chunk cũ, embed {embedded} chunk mới.")
 
-        if not vecs:
+        # 2. Xóa các câu trả lời đã cache có trích dẫn bài viết này
+        if embedded or removed or total == 0:
+            qa.answer_cache.invalidate_paths([request_data.url])
+
+        if not total:
             print("⚠️ Nội dung rỗng sau khi xử lý.")
-            # Nếu có xóa mà không có mới -> Save index hiện tại (đã remove) xuống đĩa
-            if deleted_ids:
-                 faiss.write_index(ingest.index, ingest.INDEX_FILE)
-                 qa.reload_index()
             return {"status": "warning", "message": "Nội dung rỗng."}
 
-        # 3. LƯU VÀO DB & DISK 
-        # ingest.save_batch tự động add vào ingest.index, save disk và insert DB
-        ingest.save_batch(vecs, db_entries)
-        
-        # 4. RELOAD QA INDEX (Để chatbot tìm thấy ngay)
-        qa.reload_index()
-
         print(f"✅ Đã học xong: {request_data.title}")
-        return {"status": "success", "chunks": len(vecs)}
+        return {"status": "success", "chunks": total, "embedded": embedded, "reused": reused}
 
     except Exception as e:
         print(f"❌ Lỗi Ingest Logic: {e}")
         return {"status": "error", "message": str(e)}
 
+# --- THỐNG KÊ HIỆU NĂNG ---
+@app.get("/stats")
+async def stats_endpoint():
+    return {
+        "llm": llm_client.get_client().stats(),
+        "models": model_registry.memory_report(),
+        "index": index_service.stats(),
+        "query_embedding_cache": qa.query_embedding_cache.stats(),
+        "answer_cache": qa.answer_cache.stats(),
+        "inflight_answers": qa.inflight_answers.stats(),
+        "inflight_streams": qa.inflight_streams.stats(),
+        "query_embed_batcher": qa.query_embed_batcher.stats(),
+        "search_batcher": qa.search_batcher.stats(),
+        "rerank_batcher": qa.rerank_batcher.stats(),
+        "small_rerank_batcher": qa.small_rerank_batcher.stats(),
+        "rerank_cascade": qa.cascade_stats.stats(),
+    }
+
+# --- HEALTH / READINESS ---
+# Model + index được tải lazy: server nhận kết nối ngay, warmup chạy nền.
+# /readyz trả 503 kèm tiến độ từng bước cho tới khi warmup xong.
+_started_at = time.perf_counter()
+readiness = {"status": "starting", "stages": {}, "error": None, "ready_seconds": None}
+
+def _on_warmup_stage(name, status, seconds):
+    stage = {"status": status}
+    if seconds is not None:
+        stage["seconds"] = round(seconds, 2)
+    readiness["stages"][name] = stage
+
+def _run_warmup():
+    readiness["status"] = "warming_up"
+    try:
+        qa.warmup(_on_warmup_stage)
+    except Exception as e:
+        print(f"❌ Lỗi warmup: {e}")
+        readiness["status"] = "error"
+        readiness["error"] = str(e)
+        return
+    readiness["status"] = "ready"
+    readiness["ready_seconds"] = round(time.perf_counter() - _started_at, 2)
+    print(f"✅ Server sẵn sàng sau {readiness['ready_seconds']}s")
+
+@app.get("/healthz")
+async def healthz_endpoint():
+    """Liveness: process còn sống và event loop còn phản hồi"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz_endpoint():
+    """Readiness: 200 khi model + index đã tải xong, ngược lại 503"""
+    status_code = 200 if readiness["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=readiness)
+
+@app.on_event("startup")
+async def startup_event():
+    # Định kỳ gộp delta log vào snapshot faiss.index
+    index_service.start_background_compaction()
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=_run_warmup, name="warmup", daemon=True).start()
+    else:
+        # Không warmup: model tải ở request đầu tiên
+        readiness["status"] = "ready"
+        readiness["ready_seconds"] = round(time.perf_counter() - _started_at, 2)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await qa.aclose()
+    ingest_executor.shutdown(wait=True)
+    if index_service.is_loaded() and (index_service.store.pending_ops or index_service.store.needs_compaction()):
+        index_service.compact()
+    db.close_connections()
+
 if __name__ == "__main__":
     print("🚀 Server Chatbot RAG (Robust Mode) đang chạy tại http://localhost:8000")
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
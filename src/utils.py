@@ -1,8 +1,7 @@
-import requests
 import json
-import torch
-from keybert import KeyBERT
 from config_loader import load_config
+import llm_client
+import model_registry
 
 # --- LOAD CONFIG ---
 config = load_config()
@@ -10,17 +9,27 @@ config = load_config()
 # Lấy tên model từ config
 SUMMARY_MODEL_NAME = config["model"].get("summary_model") # Có thể là None
 KEYWORDS_MODEL_NAME = config["model"].get("keywords_model", "intfloat/multilingual-e5-small")
+EMBEDDING_BACKEND = config["model"].get("embedding_backend", "torch") # Cùng backend để dùng chung model embedding
 LLM_MODEL_NAME = config["model"].get("llm_model", "qwen2.5") # Dùng cho fallback
 
 # ==============================================================================
 # 1. KHỞI TẠO KEYBERT (Trích xuất từ khóa)
 # ==============================================================================
-print(f"Loading Keyword Model: {KEYWORDS_MODEL_NAME}...")
-try:
-    kw_model = KeyBERT(model=KEYWORDS_MODEL_NAME)
-except Exception as e:
-    print(f"⚠️ Lỗi tải KeyBERT: {e}. Sẽ bỏ qua bước trích xuất từ khóa.")
-    kw_model = None
+# Tải lazy ở lần trích xuất đầu tiên (server khởi động không phải chờ KeyBERT)
+kw_model = None
+_kw_model_failed = False
+
+def _get_kw_model():
+    global kw_model, _kw_model_failed
+    if kw_model is None and not _kw_model_failed:
+        print(f"Loading Keyword Model: {KEYWORDS_MODEL_NAME}...")
+        try:
+            # Dùng lại SentenceTransformer trong registry (thường trùng model embedding)
+            kw_model = model_registry.get_keybert(KEYWORDS_MODEL_NAME, backend=EMBEDDING_BACKEND)
+        except Exception as e:
+            print(f"⚠️ Lỗi tải KeyBERT: {e}. Sẽ bỏ qua bước trích xuất từ khóa.")
+            _kw_model_failed = True
+    return kw_model
 
 # ==============================================================================
 # 2. KHỞI TẠO MODEL TÓM TẮT (Xử lý thông minh)
@@ -31,6 +40,7 @@ hf_tokenizer = None
 if SUMMARY_MODEL_NAME:
     # TRƯỜNG HỢP 1: Có cấu hình model riêng (Tốn RAM)
     try:
+        import torch
         from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
         print(f"Loading Summary Model: {SUMMARY_MODEL_NAME}...")
         
@@ -89,8 +99,6 @@ def extract_summary(text, max_len=150):
 
 def _summarize_with_ollama(text):
     """Gọi API Ollama để tóm tắt"""
-    url = "http://localhost:11434/api/generate"
-    
     # Prompt ép Qwen tóm tắt ngắn gọn
     prompt = (
         f"Bạn là trợ lý tóm tắt văn bản. Hãy viết một đoạn tóm tắt ngắn gọn (khoảng 2-3 câu) "
@@ -98,24 +106,16 @@ def _summarize_with_ollama(text):
         f"Tóm tắt:"
     )
 
-    payload = {
-        "model": LLM_MODEL_NAME, # qwen2.5
-        "prompt": prompt,
-        "stream": False,
-        "options": {
-            "temperature": 0.3, # Thấp để tập trung
-            "num_predict": 150  # Giới hạn độ dài output
-        }
+    options = {
+        "temperature": 0.3, # Thấp để tập trung
+        "num_predict": 150  # Giới hạn độ dài output
     }
 
     try:
-        response = requests.post(url, json=payload, timeout=30)
-        if response.status_code == 200:
-            result = response.json().get("response", "").strip()
-            # Nếu model trả về rỗng hoặc lỗi, lấy text gốc cắt ngắn
-            return result if result else text[:300] + "..."
-        else:
-            return text[:300] + "..."
+        data = llm_client.get_client().generate(prompt, LLM_MODEL_NAME, options=options, timeout=30)
+        result = data.get("response", "").strip()
+        # Nếu model trả về rỗng hoặc lỗi, lấy text gốc cắt ngắn
+        return result if result else text[:300] + "..."
     except:
         return text[:300] + "..."
 
@@ -123,11 +123,12 @@ def _summarize_with_ollama(text):
 # HÀM TRÍCH XUẤT TỪ KHÓA
 # ==============================================================================
 def extract_keywords(text, top_k=10):
-    if not kw_model:
+    model = _get_kw_model()
+    if not model:
         return ""
         
     try:
-        keywords = kw_model.extract_keywords(
+        keywords = model.extract_keywords(
             text,
             keyphrase_ngram_range=(1, 2),    # Cụm 1-2 từ
             stop_words=None,                 
@@ -0,0 +1,248 @@
+# vector_index.py
+# ------------------------------------------------------------
+# Tác dụng:
+#   - Tạo FAISS index theo cấu hình vector_db.index_type trong config.yaml
+#       flat     : IndexFlatIP, quét toàn bộ (chính xác tuyệt đối, chậm dần khi dữ liệu lớn)
+#       hnsw     : IndexHNSWFlat, đồ thị HNSW (nhanh, không cần train, không hỗ trợ xóa)
+#       ivf_flat : IndexIVFFlat, chia cụm (cần train), tìm trong nprobe cụm gần nhất
+#       ivf_pq   : IndexIVFPQ, như ivf_flat nhưng nén vector bằng product quantization
+#       sq8      : IndexScalarQuantizer 8 bit, quét toàn bộ, RAM = 1/4 flat (cần train min/max)
+#       sq_fp16  : IndexScalarQuantizer float16, quét toàn bộ, RAM = 1/2 flat
+#       pq       : IndexPQ, quét toàn bộ trên mã PQ, RAM = pq_m byte/vector (cần train)
+#   - Luôn bọc trong IndexIDMap để ID trong FAISS khớp với cột id của docs.db
+#   - Loại cần train: dùng index flat tạm tới khi đủ vector (train_threshold) rồi mới train,
+#     tránh khóa nlist / pq_nbits theo vài chục vector của lần commit đầu tiên
+#   - Đặt tham số lúc search (efSearch, nprobe)
+#   - Rescore: tính lại điểm top ứng viên của index nén bằng vector float32 gốc
+# ------------------------------------------------------------
+
+import faiss
+import numpy as np
+from config_loader import load_config
+
+config = load_config()
+VDB_CFG = config.get("vector_db", {})
+
+INDEX_TYPE = VDB_CFG.get("index_type", "flat")
+HNSW_M = VDB_CFG.get("hnsw_m", 32)
+HNSW_EF_CONSTRUCTION = VDB_CFG.get("hnsw_ef_construction", 200)
+HNSW_EF_SEARCH = VDB_CFG.get("hnsw_ef_search", 64)
+IVF_NLIST = VDB_CFG.get("ivf_nlist", 256)
+IVF_NPROBE = VDB_CFG.get("ivf_nprobe", 16)
+PQ_M = VDB_CFG.get("pq_m", 16)
+PQ_NBITS = VDB_CFG.get("pq_nbits", 8)
+
+RESCORE = VDB_CFG.get("rescore", False)
+RESCORE_FACTOR = VDB_CFG.get("rescore_factor", 4)
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "sq_fp16", "pq")
+# Các loại lưu vector nén (điểm search là xấp xỉ -> có thể rescore)
+COMPRESSED_TYPES = ("ivf_pq", "sq8", "sq_fp16", "pq")
+
+# FAISS khuyến nghị ít nhất ~39 vector train cho mỗi cụm
+MIN_POINTS_PER_CENTROID = 39
+
+
+def needs_training(index_type=INDEX_TYPE):
+    return index_type in ("ivf_flat", "ivf_pq", "sq8", "pq")
+
+
+def _fit_pq_nbits(pq_nbits, n_train):
+    """PQ cần ít nhất 2^nbits vector train cho mỗi sub-quantizer -> giảm nbits nếu ít dữ liệu"""
+    if n_train is None or n_train >= 2 ** pq_nbits:
+        return pq_nbits
+    nbits = max(1, int(np.log2(max(2, n_train))))
+    print(f"⚠️ Chỉ có {n_train} vector để train, giảm pq_nbits {pq_nbits} -> {nbits}")
+    return nbits
+
+
+def create_index(dimension, index_type=INDEX_TYPE, n_train=None, hnsw_m=HNSW_M,
+                 ef_construction=HNSW_EF_CONSTRUCTION, nlist=IVF_NLIST, pq_m=PQ_M, pq_nbits=PQ_NBITS):
+    """
+    Tạo index rỗng (bọc IndexIDMap). Với loại IVF / PQ, n_train là số vector sẽ dùng để
+    train: nlist / pq_nbits được giảm xuống nếu dữ liệu quá ít.
+    """
+    if index_type == "flat":
+        base = faiss.IndexFlatIP(dimension)
+    elif index_type == "hnsw":
+        base = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        base.hnsw.efConstruction = ef_construction
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        if n_train is not None:
+            max_nlist = max(1, n_train // MIN_POINTS_PER_CENTROID)
+            if nlist > max_nlist:
+                print(f"⚠️ Chỉ có {n_train} vector để train, giảm ivf_nlist {nlist} -> {max_nlist}")
+                nlist = max_nlist
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == "ivf_flat":
+            base = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            pq_nbits = _fit_pq_nbits(pq_nbits, n_train)
+            base = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "sq8":
+        base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "sq_fp16":
+        base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "pq":
+        base = faiss.IndexPQ(dimension, pq_m, _fit_pq_nbits(pq_nbits, n_train), faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"index_type không hợp lệ: {index_type} (chọn một trong {INDEX_TYPES})")
+
+    # (faiss Python tự giữ tham chiếu tới quantizer/base nên không bị giải phóng sớm)
+    return faiss.IndexIDMap(base)
+
+
+def train_index(index, vectors):
+    """Train index (IVF / sq8 / pq) nếu chưa train. Với flat/hnsw/sq_fp16 không làm gì."""
+    if index.is_trained:
+        return
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    print(f"🏋️ Đang train FAISS index trên {len(vectors)} vector...")
+    index.train(vectors)
+
+
+def train_threshold(index_type=INDEX_TYPE, nlist=IVF_NLIST, pq_nbits=PQ_NBITS):
+    """Số vector tối thiểu để train đúng cấu hình (không phải giảm nlist / pq_nbits)"""
+    needed = {
+        "ivf_flat": nlist,
+        "ivf_pq": max(nlist, 2 ** pq_nbits),
+        "pq": 2 ** pq_nbits,
+        "sq8": 2 ** 8,  # 256 mức lượng tử mỗi chiều
+    }.get(index_type, 0)
+    return needed * MIN_POINTS_PER_CENTROID
+
+
+def new_index(dimension, index_type=INDEX_TYPE):
+    """Index rỗng cho dữ liệu mới: loại cần train bắt đầu bằng index flat tạm (xem prepare_for_add)"""
+    return create_index(dimension, "flat" if needs_training(index_type) else index_type)
+
+
+def target_type(index, index_type=INDEX_TYPE):
+    """Loại index sẽ dùng: index flat tạm (đang chờ đủ vector để train) -> loại trong config"""
+    current = index_type_of(index)
+    if current == "flat" and needs_training(index_type):
+        return index_type
+    return current
+
+
+def prepare_for_add(index, vectors, index_type=INDEX_TYPE):
+    """
+    Index loại IVF / sq8 / pq cần train trước khi add. Chưa đủ train_threshold vector thì giữ
+    index flat tạm (tìm chính xác); khi tổng số vector đạt ngưỡng -> tạo index thật với nlist /
+    pq_nbits đầy đủ, train trên toàn bộ vector đang có + batch mới rồi chuyển vector cũ sang.
+    Muốn train lại trên toàn bộ dữ liệu về sau: rebuild_index.py.
+    Trả về index (có thể là object mới).
+    """
+    if not index.is_trained:
+        index = create_index(index.d, "flat")  # Index rỗng chưa train (tạo bởi bản cũ)
+    if target_type(index, index_type) == "flat" or index_type_of(index) != "flat":
+        return index
+
+    total = index.ntotal + len(vectors)
+    if total < train_threshold(index_type):
+        return index
+    stored_ids, stored = reconstruct_all(index)
+    train = np.vstack([stored, np.asarray(vectors, dtype="float32")])
+    trained = create_index(index.d, index_type, n_train=len(train))
+    train_index(trained, train)
+    apply_search_params(trained)
+    if len(stored_ids):
+        trained.add_with_ids(stored, stored_ids)
+    print(f"🔁 Đủ {total} vector: chuyển index flat tạm sang {describe(trained)}")
+    return trained
+
+
+def _base_index(index):
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def apply_search_params(index, ef_search=HNSW_EF_SEARCH, nprobe=IVF_NPROBE):
+    """Đặt tham số lúc search: efSearch (HNSW) / nprobe (IVF)"""
+    base = _base_index(index)
+    ivf = faiss.try_extract_index_ivf(base)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = ef_search
+
+
+def index_type_of(index):
+    """Suy ra index_type (theo config) từ object FAISS"""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return "sq_fp16" if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    if isinstance(base, faiss.IndexPQ):
+        return "pq"
+    return "flat"
+
+
+def is_compressed(index):
+    return index_type_of(index) in COMPRESSED_TYPES
+
+
+def rescore(xq, D, I, fetch, k):
+    """
+    Tính lại điểm (inner product) của ứng viên bằng vector float32 gốc rồi lấy top k.
+    fetch(ids) -> (vecs, found): ID không có vector gốc giữ nguyên điểm xấp xỉ.
+    """
+    nq = len(xq)
+    D_out = np.full((nq, k), -np.inf, dtype="float32")
+    I_out = np.full((nq, k), -1, dtype=np.int64)
+    for q in range(nq):
+        valid = I[q] != -1
+        ids, scores = I[q][valid], D[q][valid].astype("float32")
+        if len(ids) == 0:
+            continue
+        vecs, found = fetch(ids)
+        scores[found] = vecs[found] @ xq[q]
+        order = np.argsort(-scores, kind="stable")[:k]
+        D_out[q, :len(order)] = scores[order]
+        I_out[q, :len(order)] = ids[order]
+    return D_out, I_out
+
+
+def reconstruct_all(index):
+    """
+    (ids, vecs float32) của toàn bộ vector trong index flat / hnsw (lưu vector gốc).
+    Loại khác (IVF, nén) trả về None: không đọc lại được hoặc chỉ được vector xấp xỉ.
+    """
+    if index_type_of(index) not in ("flat", "hnsw"):
+        return None
+    ids = faiss.vector_to_array(index.id_map)
+    if index.ntotal == 0:
+        return ids, np.empty((0, index.d), dtype="float32")
+    return ids, _base_index(index).reconstruct_n(0, index.ntotal)
+
+
+def supports_remove(index):
+    return not isinstance(_base_index(index), faiss.IndexHNSW)
+
+
+def remove_ids(index, ids):
+    """
+    Xóa vector theo ID. HNSW không hỗ trợ xóa: trả về 0, vector cũ nằm lại trong index
+    (index_service giữ tombstone để lọc khi search, db.get_documents_by_ids cũng bỏ ID đã xóa).
+    """
+    if len(ids) == 0 or not supports_remove(index):
+        return 0
+    return index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+
+def describe(index):
+    base = _base_index(index)
+    ivf = faiss.try_extract_index_ivf(base)
+    if ivf is not None:
+        return f"{type(base).__name__}(nlist={ivf.nlist}, nprobe={ivf.nprobe}, ntotal={index.ntotal})"
+    if isinstance(base, faiss.IndexHNSW):
+        return f"{type(base).__name__}(efSearch={base.hnsw.efSearch}, ntotal={index.ntotal})"
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexPQ)):
+        return f"{type(base).__name__}({index_type_of(index)}, {base.sa_code_size()} byte/vector, ntotal={index.ntotal})"
+    return f"{type(base).__name__}(ntotal={index.ntotal})"